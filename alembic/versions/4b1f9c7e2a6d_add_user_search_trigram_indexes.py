@@ -0,0 +1,30 @@
+"""Add trigram indexes for user search.
+
+Revision ID: 4b1f9c7e2a6d
+Revises: 9895fdfabb52
+Create Date: 2026-10-18 15:27:40.518903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1f9c7e2a6d'
+down_revision = '9895fdfabb52'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Build these without locking the users table. That can't happen inside
+    # a transaction.
+    op.execute("COMMIT;")
+    op.execute("CREATE INDEX CONCURRENTLY users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)")
+    op.execute("CREATE INDEX CONCURRENTLY users_email_address_trgm ON users USING gin (lower(email_address) gin_trgm_ops)")
+
+
+def downgrade():
+    op.drop_index("users_email_address_trgm", table_name="users")
+    op.drop_index("users_username_trgm", table_name="users")
@@ -0,0 +1,31 @@
+"""Add messages_spam_flag index.
+
+Revision ID: 9895fdfabb52
+Revises: 00bb708f712f
+Create Date: 2026-10-18 14:02:11.384210
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9895fdfabb52'
+down_revision = '00bb708f712f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The messages table is huge, so build this without locking it. That
+    # can't happen inside a transaction.
+    op.execute("COMMIT;")
+    op.create_index(
+        "messages_spam_flag", "messages", ["id"],
+        postgresql_where=sa.text("spam_flag IS NOT NULL"),
+        postgresql_concurrently=True,
+    )
+
+
+def downgrade():
+    op.drop_index("messages_spam_flag", table_name="messages")
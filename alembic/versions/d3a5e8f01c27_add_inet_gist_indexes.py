@@ -0,0 +1,39 @@
+"""Add GiST indexes on IP addresses.
+
+Revision ID: d3a5e8f01c27
+Revises: 4b1f9c7e2a6d
+Create Date: 2026-10-18 16:10:52.730166
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd3a5e8f01c27'
+down_revision = '4b1f9c7e2a6d'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Build these without locking the tables. That can't happen inside a
+    # transaction.
+    op.execute("COMMIT;")
+    op.create_index(
+        "users_last_ip", "users", ["last_ip"],
+        postgresql_using="gist",
+        postgresql_ops={"last_ip": "inet_ops"},
+        postgresql_concurrently=True,
+    )
+    op.create_index(
+        "ip_bans_address", "ip_bans", ["address"],
+        postgresql_using="gist",
+        postgresql_ops={"address": "inet_ops"},
+        postgresql_concurrently=True,
+    )
+
+
+def downgrade():
+    op.drop_index("ip_bans_address", table_name="ip_bans")
+    op.drop_index("users_last_ip", table_name="users")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+IP lookup benchmark.
+
+Fills temporary copies of ip_bans and users with random addresses, then times
+the inet containment lookups which the ban check and the admin pages do,
+first without an index and then with the GiST indexes from the model. Each
+lookup's plan is printed too, to check that the planner uses the index.
+
+The tables are temporary, so this only needs a database to connect to and
+doesn't touch the real tables.
+
+Usage: extras/benchmarks/ip_lookups.py [--bans 100000] [--users 1000000] [--lookups 200] [--seed 0]
+"""
+
+import argparse
+import random
+import time
+
+from newparp.model import engine
+
+
+# The same queries as get_ip_banned(), the admin user page and the IP search
+# in the admin user list.
+lookups = [
+    ("ban check", "SELECT EXISTS (SELECT 1 FROM bench_ip_bans WHERE address >>= %(address)s)", "address"),
+    ("user's bans", "SELECT * FROM bench_ip_bans WHERE address >>= %(address)s ORDER BY address", "address"),
+    ("users in range", "SELECT id FROM bench_users WHERE last_ip <<= %(network)s ORDER BY id LIMIT 50", "network"),
+]
+
+
+def random_address(rng):
+    return "%s.%s.%s.%s" % tuple(rng.randint(1, 254) for x in range(4))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0
+
+
+def run_lookups(connection, rng, count):
+    for name, query, parameter in lookups:
+        timings = []
+        for x in range(count):
+            address = random_address(rng)
+            parameters = {parameter: address if parameter == "address" else address.rsplit(".", 1)[0] + ".0/24"}
+            start = time.perf_counter()
+            connection.execute(query, parameters).fetchall()
+            timings.append(time.perf_counter() - start)
+        plan = connection.execute("EXPLAIN " + query, parameters).fetchall()
+        print("  %-16s mean %8.3fms, p99 %8.3fms" % (
+            name, sum(timings) / len(timings) * 1000, percentile(timings, 0.99) * 1000,
+        ))
+        for row in plan:
+            print("    " + row[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bans", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    connection = engine.connect()
+    connection.execute("SELECT setseed(%s)", (args.seed / 2 ** 31,))
+
+    # Mostly single addresses, with some /24 and /16 ranges.
+    start = time.perf_counter()
+    connection.execute("""
+        CREATE TEMPORARY TABLE bench_ip_bans AS
+        SELECT DISTINCT network(set_masklen(
+            '0.0.0.0'::inet + (random() * 4294967295)::bigint,
+            CASE WHEN random() < 0.9 THEN 32 WHEN random() < 0.9 THEN 24 ELSE 16 END
+        )) AS address
+        FROM generate_series(1, %(bans)s)
+    """, {"bans": args.bans})
+    connection.execute("""
+        CREATE TEMPORARY TABLE bench_users AS
+        SELECT id, '0.0.0.0'::inet + (random() * 4294967295)::bigint AS last_ip
+        FROM generate_series(1, %(users)s) AS id
+    """, {"users": args.users})
+    connection.execute("ALTER TABLE bench_ip_bans ADD PRIMARY KEY (address)")
+    connection.execute("ALTER TABLE bench_users ADD PRIMARY KEY (id)")
+    connection.execute("ANALYZE bench_ip_bans")
+    connection.execute("ANALYZE bench_users")
+    print("Created %s bans and %s users in %.1fs." % (args.bans, args.users, time.perf_counter() - start))
+
+    print("Without GiST indexes:")
+    run_lookups(connection, random.Random(args.seed), args.lookups)
+
+    start = time.perf_counter()
+    connection.execute("CREATE INDEX ON bench_ip_bans USING gist (address inet_ops)")
+    connection.execute("CREATE INDEX ON bench_users USING gist (last_ip inet_ops)")
+    connection.execute("ANALYZE bench_ip_bans")
+    connection.execute("ANALYZE bench_users")
+    print("Built GiST indexes in %.1fs." % (time.perf_counter() - start))
+
+    print("With GiST indexes:")
+    run_lookups(connection, random.Random(args.seed), args.lookups)
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
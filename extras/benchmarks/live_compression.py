@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Live worker compression benchmark.
+
+Generates a synthetic chat session: messages, user list updates and typing
+notifications, shaped like the frames ChatHandler sends. It then compresses
+the session the way permessage-deflate does in Tornado, with one compressor
+per socket which keeps its window between frames. That's repeated for each
+combination of compression level, mem_level and minimum frame size.
+
+For each combination it reports the bytes on the wire per frame, the ratio to
+the uncompressed size, the CPU time per frame and the compressor's memory per
+socket.
+
+This only uses zlib, so it doesn't need Redis or a database.
+
+Usage: extras/benchmarks/live_compression.py [--frames 5000] [--users 20] [--seed 0]
+"""
+
+import argparse
+import json
+import random
+import time
+import zlib
+
+
+words = (
+    "the of and to a in is you that it he was for on are as with his they at be this have from or one had by word "
+    "but not what all were we when your can said there use an each which she do how their if will up other about "
+    "out many then them these so some her would make like him into time has look two more write go see number no"
+).split()
+
+
+def random_text(rng):
+    return " ".join(rng.choice(words) for x in range(rng.randint(3, 60)))
+
+
+def make_users(rng, count):
+    return [{
+        "character": {
+            "name": "Character %s" % number,
+            "acronym": "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for x in range(2)),
+            "color": "%06x" % rng.randint(0, 0xffffff),
+        },
+        "meta": {
+            "number": number,
+            "group": rng.choice(("user", "user", "user", "mod3", "silent")),
+        },
+    } for number in range(1, count + 1)]
+
+
+def make_frames(rng, frame_count, user_count):
+    users = make_users(rng, user_count)
+    message_id = 1000000
+    frames = []
+    for x in range(frame_count):
+        kind = rng.random()
+        if kind < 0.6:
+            message_id += 1
+            user = rng.choice(users)
+            frames.append({"messages": [{
+                "id": message_id,
+                "user_number": user["meta"]["number"],
+                "posted": 1500000000.0 + message_id,
+                "type": rng.choice(("ic", "ic", "ooc", "me")),
+                "color": user["character"]["color"],
+                "acronym": user["character"]["acronym"],
+                "name": user["character"]["name"],
+                "text": random_text(rng),
+                "spam_flag": None,
+            }], "published": time.time()})
+        elif kind < 0.9:
+            frames.append({"typing": rng.sample(range(1, user_count + 1), rng.randint(0, 3))})
+        else:
+            frames.append({"messages": [], "users": users, "published": time.time()})
+    return [json.dumps(_).encode("utf8") for _ in frames]
+
+
+def compress_session(frames, level, mem_level, min_size):
+    """
+    Compresses the frames like Tornado's _PerMessageDeflateCompressor, with
+    frames smaller than min_size sent as they are.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+    wire_bytes = 0
+    start = time.process_time()
+    for frame in frames:
+        if len(frame) < min_size:
+            wire_bytes += len(frame)
+            continue
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        wire_bytes += len(data) - 4
+    return wire_bytes, time.process_time() - start
+
+
+def compressor_memory(mem_level):
+    # From zlib's documentation for deflate.
+    return (1 << (zlib.MAX_WBITS + 2)) + (1 << (mem_level + 9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    frames = make_frames(random.Random(args.seed), args.frames, args.users)
+    message_bytes = sum(len(_) for _ in frames)
+    print("%s frames, %.0f bytes per frame uncompressed." % (len(frames), message_bytes / len(frames)))
+    print("%5s %9s %8s %10s %7s %10s %10s" % ("level", "mem_level", "min_size", "wire/frame", "ratio", "cpu/frame", "memory"))
+
+    for level in (1, 6, 9):
+        for mem_level in (1, 5, 8):
+            for min_size in (0, 256, 1024):
+                wire_bytes, cpu_time = compress_session(frames, level, mem_level, min_size)
+                print("%5s %9s %8s %10.0f %7.3f %8.1fus %8.0fKB" % (
+                    level, mem_level, min_size,
+                    wire_bytes / len(frames),
+                    wire_bytes / message_bytes,
+                    cpu_time / len(frames) * 1000000,
+                    compressor_memory(mem_level) / 1024,
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the matchmaker's character name filters.
+
+Compares the old per-phrase substring loop against FilterMatcher on a
+generated corpus of filter lists and character names. Doesn't need Redis or
+Postgres.
+
+Usage: extras/benchmarks/matchmaker_filters.py [--searchers 200] [--seed 0]
+"""
+
+import argparse
+import random
+import time
+
+from newparp.helpers.filters import FilterMatcher
+
+
+# Names and fragments in the style of what people actually filter.
+character_names = [
+    "john egbert", "rose lalonde", "dave strider", "jade harley",
+    "jane crocker", "roxy lalonde", "dirk strider", "jake english",
+    "aradia megido", "tavros nitram", "sollux captor", "karkat vantas",
+    "nepeta leijon", "kanaya maryam", "terezi pyrope", "vriska serket",
+    "equius zahhak", "gamzee makara", "eridan ampora", "feferi peixes",
+    "damara megido", "rufioh nitram", "mituna captor", "kankri vantas",
+    "meulin leijon", "porrim maryam", "latula pyrope", "aranea serket",
+    "horuss zahhak", "kurloz makara", "cronus ampora", "meenah peixes",
+    "calliope", "caliborn", "jack noir", "the condesce", "doc scratch",
+    "lord english", "bro strider", "dad egbert", "mom lalonde", "davesprite",
+    "anonymous", "anonymous/other", "original character", "fantroll", "human oc",
+]
+extra_fragments = [
+    "oc", "fan", "troll", "kid", "sprite", "anon", "human", "alpha", "beta",
+    "ancestor", "dancestor", "grub", "cherub", "carapace", "lusus", "bro",
+    "mom", "dad", "god tier", "dream", "prospit", "derse",
+]
+
+
+def random_filter(rng):
+    name = rng.choice(character_names)
+    roll = rng.random()
+    if roll < 0.4:
+        return name
+    elif roll < 0.8:
+        # Part of a name, like "strider" or "serk".
+        word = rng.choice(name.split(" "))
+        length = rng.randint(min(3, len(word)), len(word))
+        start = rng.randint(0, len(word) - length)
+        return word[start:start + length]
+    return rng.choice(extra_fragments)
+
+
+def random_filter_list(rng):
+    # Most people have a handful of filters but a few hit the 200 limit.
+    roll = rng.random()
+    if roll < 0.5:
+        count = rng.randint(0, 5)
+    elif roll < 0.9:
+        count = rng.randint(5, 50)
+    else:
+        count = rng.randint(150, 200)
+    return sorted({random_filter(rng) for x in range(count)})
+
+
+def legacy_filtered(filters, name):
+    """The old implementation from tasks/matchmaker.py."""
+    name = name.lower().encode("utf8")
+    for search_filter in filters:
+        if search_filter.encode("utf8") in name:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--searchers", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    searchers = [(random_filter_list(rng), rng.choice(character_names)) for x in range(args.searchers)]
+    pairs = [(a, b) for a in searchers for b in searchers if a is not b]
+    filter_count = sum(len(filters) for filters, name in searchers)
+    print("%s searchers, %s filters, %s comparisons." % (len(searchers), filter_count, len(pairs) * 2))
+
+    start = time.perf_counter()
+    legacy_results = [
+        legacy_filtered(a[0], b[1]) or legacy_filtered(b[0], a[1])
+        for a, b in pairs
+    ]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matchers = {id(filters): FilterMatcher(filters) for filters, name in searchers}
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher_results = [
+        matchers[id(a[0])].search(b[1].lower()) is not None
+        or matchers[id(b[0])].search(a[1].lower()) is not None
+        for a, b in pairs
+    ]
+    matcher_time = time.perf_counter() - start
+
+    assert legacy_results == matcher_results, "Results don't match."
+
+    print("%s pairs filtered." % sum(matcher_results))
+    print("Substring loop: %.3fs (%.2fus per pair)" % (legacy_time, legacy_time / len(pairs) * 1000000))
+    print("FilterMatcher:  %.3fs (%.2fus per pair), plus %.3fs to build" % (
+        matcher_time, matcher_time / len(pairs) * 1000000, build_time,
+    ))
+
+
+if __name__ == "__main__":
+    main()
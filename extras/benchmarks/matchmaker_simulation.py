@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+Matchmaking simulation.
+
+Generates a deterministic population of searchers (styles, levels, age groups,
+picky choices, filters and blocks) and feeds them through the matchmaker one
+arrival at a time, against the Redis and Postgres configured in the
+environment. The Celery tasks run eagerly in this process, so new_searcher,
+compare and comparison_callback are exercised exactly as they're written.
+
+Reports matches per second, time to match in simulated seconds and how many
+tasks, Redis round trips and SQL queries each match costs. Only the work done
+inside the engine's searcher_arrived() is counted, not the simulation's own
+set up.
+
+This creates users, blocks and chats and uses the global searchers set, so
+only ever point it at a development database and Redis.
+
+Usage: extras/benchmarks/matchmaker_simulation.py [--searchers 300] [--seed 0]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from celery.signals import task_prerun
+from redis.connection import Connection
+from sqlalchemy import event
+from uuid import uuid4
+
+from newparp.helpers.matchmaker import delete_searcher, load_blocked_user_ids, store_searcher
+from newparp.model import sm, engine, allowed_level_options, AgeGroup, Block, SearchCharacter, User
+from newparp.model.connections import redis_pool, NewparpRedis
+from newparp.tasks import celery
+from newparp.tasks.matchmaker import new_searcher
+
+from matchmaker_filters import character_names, random_filter_list
+
+
+class Counters(object):
+    """Counts tasks, Redis round trips and SQL queries made by the matchmaker."""
+
+    def __init__(self):
+        self.tasks = 0
+        self.redis_calls = 0
+        self.sql_queries = 0
+
+    def install(self):
+        counters = self
+
+        def on_task_prerun(**kwargs):
+            counters.tasks += 1
+        task_prerun.connect(on_task_prerun, weak=False)
+
+        # Pipelines and scripts are sent in one go, so this counts round trips
+        # rather than commands.
+        send_packed_command = Connection.send_packed_command
+        def counting_send_packed_command(connection, command):
+            counters.redis_calls += 1
+            return send_packed_command(connection, command)
+        Connection.send_packed_command = counting_send_packed_command
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def on_before_cursor_execute(*args, **kwargs):
+            counters.sql_queries += 1
+
+    def snapshot(self):
+        return (self.tasks, self.redis_calls, self.sql_queries)
+
+    def difference(self, start):
+        return tuple(end - start for start, end in zip(start, self.snapshot()))
+
+
+class TaskEngine(object):
+    """
+    Runs the current Celery matchmaker. A replacement engine just needs to
+    implement searcher_arrived() and publish matches to searcher:<id> in the
+    same format.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        celery.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+
+    def searcher_arrived(self, searcher_id):
+        # Same as SearchHandler.open.
+        self.redis.sadd("searchers", searcher_id)
+        new_searcher.delay(searcher_id)
+
+
+engines = {
+    "tasks": TaskEngine,
+}
+
+
+def generate_population(rng, count, search_character_ids, block_rate):
+    population = []
+    for number in range(count):
+        roll = rng.random()
+        if roll < 0.7:
+            age_group = None
+        elif roll < 0.95:
+            age_group = AgeGroup.over_18
+        else:
+            age_group = AgeGroup.under_18
+        allowed_levels = sorted(allowed_level_options[age_group or AgeGroup.unknown])
+        levels = {_ for _ in allowed_levels if rng.random() < 0.5} or {"sfw"}
+
+        population.append({
+            "name": rng.choice(character_names),
+            "style": rng.choice(["script", "script", "paragraph", "either"]),
+            "levels": levels,
+            "age_group": age_group,
+            "filters": random_filter_list(rng),
+            # Most people take anyone, but some are picky.
+            "choices": (
+                set(rng.sample(search_character_ids, min(len(search_character_ids), rng.randint(1, 10))))
+                if rng.random() < 0.3 else set()
+            ),
+            "search_character_id": rng.choice(search_character_ids),
+            "blocks": {_ for _ in range(count) if _ != number and rng.random() < block_rate},
+        })
+    return population
+
+
+def create_users(db, redis, population, run_id):
+    users = []
+    for number, details in enumerate(population):
+        user = User(
+            username="sim_%s_%s" % (run_id, number),
+            password="!",
+            group="active",
+            last_ip="127.0.0.1",
+            name=details["name"],
+        )
+        db.add(user)
+        users.append(user)
+    db.flush()
+
+    for user, details in zip(users, population):
+        for blocked_number in details["blocks"]:
+            db.add(Block(blocking_user_id=user.id, blocked_user_id=users[blocked_number].id))
+    db.commit()
+
+    session_ids = []
+    for user in users:
+        session_id = str(uuid4())
+        redis.setex("session:%s" % session_id, 86400, user.id)
+        session_ids.append(session_id)
+    return users, session_ids
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--searchers", type=int, default=300, help="Number of searchers to simulate.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--arrival-rate", type=float, default=2.0, help="Searchers arriving per simulated second.")
+    parser.add_argument("--patience", type=float, default=120.0, help="Simulated seconds before a searcher gives up.")
+    parser.add_argument("--block-rate", type=float, default=0.01, help="Chance of any user blocking any other.")
+    parser.add_argument("--engine", choices=sorted(engines.keys()), default="tasks")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    db = sm()
+    redis = NewparpRedis(connection_pool=redis_pool)
+
+    search_character_ids = sorted(_ for _, in db.query(SearchCharacter.id))
+    population = generate_population(rng, args.searchers, search_character_ids, args.block_rate)
+    run_id = "%s_%s" % (args.seed, int(time.time()))
+    users, session_ids = create_users(db, redis, population, run_id)
+    print("Created %s users with %s blocks." % (len(users), sum(len(_["blocks"]) for _ in population)))
+
+    # Start from a clean slate.
+    for searcher_id in redis.smembers("searchers"):
+        delete_searcher(redis, searcher_id)
+    redis.delete("lock:matchmaker")
+
+    pubsub = redis.pubsub()
+    pubsub.psubscribe("searcher:*")
+
+    counters = Counters()
+    counters.install()
+    matchmaker = engines[args.engine](redis)
+
+    clock = 0.0
+    processing_time = 0.0
+    arrivals = {}
+    searcher_numbers = {}
+    matches = {}
+    times_to_match = []
+    expired = 0
+    # Only the matchmaker's own work is counted, not the set up above or the
+    # pubsub polling below.
+    counts = (0, 0, 0)
+
+    for number, (user, session_id, details) in enumerate(zip(users, session_ids, population)):
+        clock += rng.expovariate(args.arrival_rate)
+
+        # People give up if they wait too long.
+        for searcher_id, arrived in list(arrivals.items()):
+            if clock - arrived > args.patience:
+                delete_searcher(redis, searcher_id)
+                del arrivals[searcher_id]
+                expired += 1
+
+        # Create the searcher as the web process would.
+        searcher_id = str(uuid4())
+        store_searcher(
+            redis, searcher_id,
+            session_id=session_id,
+            search_character_id=details["search_character_id"],
+            character={"name": details["name"], "acronym": "??", "color": "000000"},
+            style=details["style"],
+            levels=details["levels"],
+            age_group=details["age_group"],
+            filters=details["filters"],
+            choices=details["choices"],
+        )
+        load_blocked_user_ids(redis, db, user.id)
+        arrivals[searcher_id] = clock
+        searcher_numbers[searcher_id] = number
+
+        # Keep searchers alive for the simulation rather than relying on pings.
+        for other_searcher_id in arrivals:
+            redis.expire("searcher:%s" % other_searcher_id, 30)
+
+        start_counts = counters.snapshot()
+        arrival_start = time.perf_counter()
+        matchmaker.searcher_arrived(searcher_id)
+        processing_time += time.perf_counter() - arrival_start
+        counts = tuple(total + _ for total, _ in zip(counts, counters.difference(start_counts)))
+
+        while True:
+            message = pubsub.get_message(timeout=0.01)
+            if message is None:
+                break
+            if message["type"] != "pmessage":
+                continue
+            matched_searcher_id = message["channel"][9:]
+            data = json.loads(message["data"])
+            matches.setdefault(data["url"], []).append(matched_searcher_id)
+            if matched_searcher_id in arrivals:
+                # Matching is instant in simulated time, so this is just
+                # how long they waited for a partner to arrive.
+                times_to_match.append(clock - arrivals.pop(matched_searcher_id))
+
+    for searcher_id in arrivals:
+        delete_searcher(redis, searcher_id)
+    pubsub.close()
+
+    # Sanity check: nobody should have been matched with someone they blocked.
+    blocked_matches = 0
+    for searcher_ids in matches.values():
+        numbers = [searcher_numbers[_] for _ in searcher_ids]
+        if len(numbers) == 2 and (
+            numbers[1] in population[numbers[0]]["blocks"]
+            or numbers[0] in population[numbers[1]]["blocks"]
+        ):
+            blocked_matches += 1
+
+    match_count = len(matches)
+    tasks, redis_calls, sql_queries = counts
+    print("Engine: %s" % args.engine)
+    print("%s matches, %s gave up, %s still searching." % (match_count, expired, len(arrivals)))
+    print("Matchmaker processing time: %.3fs (%.2f matches/sec)" % (
+        processing_time, match_count / processing_time if processing_time else 0,
+    ))
+    print("Time to match (simulated seconds): p50 %.1f, p90 %.1f, p99 %.1f" % (
+        percentile(times_to_match, 0.5), percentile(times_to_match, 0.9), percentile(times_to_match, 0.99),
+    ))
+    if match_count:
+        print("Per match: %.1f tasks, %.1f Redis round trips, %.1f SQL queries" % (
+            tasks / match_count, redis_calls / match_count, sql_queries / match_count,
+        ))
+    print("Matches between blocked users: %s" % blocked_matches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the spamless filter lists.
+
+Compares checking each compiled pattern in turn, as CheckSpamTask used to,
+against RegexSet, for blacklists and warnlists of increasing size. Doesn't
+need Redis or Postgres.
+
+Usage: extras/benchmarks/spamless_filters.py [--messages 2000] [--seed 0]
+"""
+
+import argparse
+import random
+import re
+import time
+
+from newparp.helpers.filters import RegexSet
+
+
+flags = re.IGNORECASE | re.MULTILINE
+
+words = [
+    "hello", "hi", "hey", "what", "are", "you", "doing", "lol", "okay", "sure",
+    "the", "a", "and", "to", "of", "in", "is", "it", "that", "this", "with",
+    "looks", "around", "smiles", "nods", "sighs", "walks", "over", "sits", "down",
+    "ooc", "brb", "back", "sorry", "thanks", "anyway", "maybe", "really", "yeah",
+]
+spam_words = [
+    "free", "money", "click", "here", "discord", "gg", "invite", "buy", "cheap",
+    "followers", "visit", "promo", "code", "win", "prize", "casino", "crypto",
+]
+
+
+def random_pattern(rng):
+    roll = rng.random()
+    if roll < 0.5:
+        # Plain phrases are the most common.
+        return re.escape(" ".join(rng.choice(spam_words) for x in range(rng.randint(1, 3))))
+    elif roll < 0.8:
+        return r"\b%s\b" % rng.choice(spam_words)
+    elif roll < 0.95:
+        return r"%s\s*%s" % (rng.choice(spam_words), rng.choice(spam_words))
+    return r"(%s)+\.(com|net|org)" % "|".join(rng.sample(spam_words, 3))
+
+
+def random_message(rng):
+    message = [rng.choice(words) for x in range(rng.randint(1, 40))]
+    if rng.random() < 0.05:
+        message.insert(rng.randint(0, len(message)), rng.choice(spam_words))
+    return " ".join(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--sizes", default="10,50,100,300,1000", help="Comma separated list sizes to try.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    messages = [random_message(rng) for x in range(args.messages)]
+    print("%s messages." % len(messages))
+
+    for size in [int(_) for _ in args.sizes.split(",")]:
+        patterns = [random_pattern(rng) for x in range(size)]
+        points = [rng.randint(1, 5) for _ in patterns]
+        compiled = [(re.compile(_, flags), weight) for _, weight in zip(patterns, points)]
+
+        start = time.perf_counter()
+        legacy_scores = [sum(len(phrase.findall(text)) * weight for phrase, weight in compiled) for text in messages]
+        legacy_matches = [any(phrase.search(text.lower()) for phrase, weight in compiled) for text in messages]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        regex_set = RegexSet(patterns, flags, weights=points)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        set_scores = [regex_set.score(text) for text in messages]
+        set_matches = [regex_set.search(text.lower()) is not None for text in messages]
+        set_time = time.perf_counter() - start
+
+        assert legacy_scores == set_scores, "Scores don't match."
+        assert legacy_matches == set_matches, "Matches don't match."
+
+        print("%4s patterns, %s messages matched: loop %.2fus/message, RegexSet %.2fus/message (%.3fs to build)" % (
+            size, sum(set_matches),
+            legacy_time / len(messages) * 1000000,
+            set_time / len(messages) * 1000000,
+            build_time,
+        ))
+
+
+if __name__ == "__main__":
+    main()
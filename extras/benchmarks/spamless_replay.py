@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+Spamless replay benchmark.
+
+Replays a corpus of messages through the spamless checks against a local
+Redis, without flagging anything in the database, and reports messages per
+second, per-check latency, Redis round trips per message and how many
+messages would be marked or silenced. Use it to try out new filter lists or
+changes to the checks before they reach live chats.
+
+The corpus is a JSON lines file of {"chat_id": ..., "message": {...}}, with
+messages in the format of Message.to_dict(). Export one from the messages
+table with --export, or leave out --corpus for a synthetic one. Filters come
+from the database unless --filters points to a JSON file like
+{"banned_names": ["..."], "blacklist": [["...", 5]], "warnlist": ["..."]}.
+
+The counters live in Redis database --redis-db (15 by default) rather than
+the one in REDIS_DB. Messages are replayed much faster than they were sent,
+so counters will run higher than they did at the time.
+
+Usage: extras/benchmarks/spamless_replay.py [--corpus messages.jsonl] [--filters filters.json]
+       extras/benchmarks/spamless_replay.py --export messages.jsonl [--limit 100000]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import time
+
+from redis.connection import Connection
+from sqlalchemy.orm import joinedload
+
+from newparp.model import sm, Message
+from newparp.model.connections import NewparpRedis
+from newparp.tasks.spamless import compile_lists, lists, reload_lists, SpamChecker
+
+from spamless_filters import random_message
+
+
+def export_corpus(path, limit):
+    db = sm()
+    messages = (
+        db.query(Message)
+        .options(joinedload(Message.chat_user))
+        .order_by(Message.id.desc())
+        .limit(limit).all()
+    )
+    with open(path, "w") as f:
+        for message in reversed(messages):
+            f.write(json.dumps({"chat_id": message.chat_id, "message": message.to_dict()}) + "\n")
+    print("Exported %s messages to %s." % (len(messages), path))
+
+
+def synthetic_corpus(rng, count):
+    """Mostly ordinary chatter, with the odd join flood and lightly mutated spam flood."""
+    corpus = []
+    while len(corpus) < count:
+        chat_id = rng.randint(1, 50)
+        user_number = rng.randint(1, 20)
+        roll = rng.random()
+        if roll < 0.01:
+            batch = [("join", "")] * rng.randint(5, 20)
+        elif roll < 0.03:
+            text = random_message(rng)
+            batch = [("ic", text + "!" * rng.randint(0, 3)) for x in range(rng.randint(5, 30))]
+        elif roll < 0.1:
+            batch = [(rng.choice(["join", "disconnect", "user_info"]), "")]
+        else:
+            batch = [(rng.choice(["ic", "ic", "ooc", "me"]), random_message(rng))]
+        for message_type, text in batch:
+            corpus.append({"chat_id": chat_id, "message": {
+                "id": len(corpus) + 1,
+                "user_number": user_number,
+                "type": message_type,
+                "color": "000000",
+                "acronym": "??",
+                "name": "user %s" % user_number,
+                "text": text,
+            }})
+    return corpus[:count]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="JSON lines file of messages to replay.")
+    parser.add_argument("--export", help="Export the latest messages to this file and exit.")
+    parser.add_argument("--limit", type=int, default=100000, help="Number of messages to export.")
+    parser.add_argument("--synthetic", type=int, default=20000, help="Size of the synthetic corpus.")
+    parser.add_argument("--filters", help="JSON file of filter lists to use instead of the database.")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--redis-db", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--show", type=int, default=10, help="Number of flagged messages to print.")
+    args = parser.parse_args()
+
+    if args.export:
+        export_corpus(args.export, args.limit)
+        return
+
+    redis = NewparpRedis(
+        host=os.environ["REDIS_HOST"],
+        port=int(os.environ["REDIS_PORT"]),
+        db=args.redis_db,
+        decode_responses=True,
+    )
+
+    if args.filters:
+        with open(args.filters) as f:
+            filter_lists = json.load(f)
+        lists.update(compile_lists(
+            [("banned_names", _, 0) for _ in filter_lists.get("banned_names", [])]
+            + [("blacklist", regex, points) for regex, points in filter_lists.get("blacklist", [])]
+            + [("warnlist", _, 0) for _ in filter_lists.get("warnlist", [])]
+        ))
+    else:
+        reload_lists(redis)
+    print("Filters: %s banned names, %s blacklist, %s warnlist." % (
+        len(lists["banned_names"]), len(lists["blacklist"]), len(lists["warnlist"]),
+    ))
+
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = [json.loads(_) for _ in f if _.strip()]
+    else:
+        corpus = synthetic_corpus(random.Random(args.seed), args.synthetic)
+    previous_flags = {_["message"]["id"]: _["message"].pop("spam_flag", None) for _ in corpus}
+    print("%s messages." % len(corpus))
+
+    # Time each check on its own.
+    timings = {"hash": [], "banned_names": [], "blacklist": [], "warnlist": []}
+    for item in corpus:
+        message = item["message"]
+        start = time.perf_counter()
+        hashlib.md5(":".join([message["color"], message["acronym"], message["text"]]).encode("utf-8").lower()).hexdigest()
+        timings["hash"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        lists["banned_names"].search((message["name"] or "").lower())
+        timings["banned_names"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        lists["blacklist"].score(message["text"])
+        timings["blacklist"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        lists["warnlist"].search(message["text"].lower())
+        timings["warnlist"].append(time.perf_counter() - start)
+
+    # Then the whole thing in batches, counting round trips.
+    redis_calls = [0]
+    send_packed_command = Connection.send_packed_command
+    def counting_send_packed_command(connection, command):
+        redis_calls[0] += 1
+        return send_packed_command(connection, command)
+    Connection.send_packed_command = counting_send_packed_command
+
+    checker = SpamChecker(redis)
+    marks = []
+    silences = []
+    start = time.perf_counter()
+    for offset in range(0, len(corpus), args.batch_size):
+        batch_marks, batch_silences = checker.classify([
+            (_["chat_id"], _["message"]) for _ in corpus[offset:offset + args.batch_size]
+        ])
+        marks += batch_marks
+        silences += batch_silences
+    total_time = time.perf_counter() - start
+    Connection.send_packed_command = send_packed_command
+
+    print("Replayed in %.3fs: %.0f messages/sec, %.3f Redis round trips per message." % (
+        total_time, len(corpus) / total_time, redis_calls[0] / len(corpus),
+    ))
+    for check, values in sorted(timings.items()):
+        print("  %-12s mean %7.2fus, p99 %7.2fus" % (
+            check, sum(values) / len(values) * 1000000, percentile(values, 0.99) * 1000000,
+        ))
+
+    # Blacklist reasons are "x" and the attempt count.
+    reasons = {}
+    for action, flagged in (("mark", marks), ("silence", silences)):
+        for chat_id, message, reason in flagged:
+            reasons.setdefault("%s %s" % (action, "blacklist" if reason.startswith("x") else reason), []).append(message)
+    print("%s would be marked, %s silenced." % (len(marks), len(silences)))
+    for reason, messages in sorted(reasons.items()):
+        print("  %-20s %s" % (reason, len(messages)))
+
+    flagged_ids = {message["id"] for chat_id, message, reason in marks + silences}
+    previously_flagged_ids = {message_id for message_id, flag in previous_flags.items() if flag}
+    if previously_flagged_ids:
+        print("Compared to the corpus: %s newly flagged, %s no longer flagged, %s still flagged." % (
+            len(flagged_ids - previously_flagged_ids),
+            len(previously_flagged_ids - flagged_ids),
+            len(flagged_ids & previously_flagged_ids),
+        ))
+
+    for chat_id, message, reason in (marks + silences)[:args.show]:
+        print("  [%s] chat %s #%s: %s" % (reason, chat_id, message["user_number"], message["text"][:80]))
+
+
+if __name__ == "__main__":
+    main()
@@ -157,6 +157,7 @@ app.add_url_rule("/search_characters/new", "rp_new_search_character_get", search
 app.add_url_rule("/search_characters/new", "rp_new_search_character_post", search_characters.new_search_character_post, methods=("POST",))
 app.add_url_rule("/search_characters/<int:id>", "rp_search_character", search_characters.search_character, methods=("GET",))
 app.add_url_rule("/search_characters/<int:id>.json", "rp_search_character_json", search_characters.search_character_json, methods=("GET",))
+app.add_url_rule("/search_characters/bundle/<bundle_hash>.json", "rp_search_characters_bundle", search_characters.search_characters_bundle, methods=("GET",))
 app.add_url_rule("/search_characters/<int:id>/save", "rp_save_search_character", search_characters.save_search_character, methods=("POST",))
 app.add_url_rule("/search_characters/<int:id>/delete", "rp_delete_search_character_get", search_characters.delete_search_character_get, methods=("GET",))
 app.add_url_rule("/search_characters/<int:id>/delete", "rp_delete_search_character_post", search_characters.delete_search_character_post, methods=("POST",))
@@ -249,7 +250,7 @@ app.add_url_rule("/admin/spamless/blacklist", "spamless_blacklist_post", spamles
 app.add_url_rule("/admin/spamless/warnlist", "spamless_warnlist", spamless.warnlist)
 app.add_url_rule("/admin/spamless/warnlist", "spamless_warnlist_post", spamless.warnlist_post, methods=("POST",))
 
-make_rules("spamless2", "/admin/spamless2", spamless2.home, formats=True, paging=True)
+make_rules("spamless2", "/admin/spamless2", spamless2.home, formats=True)
 
 make_rules("admin", "/admin/ip_bans", admin.ip_bans, formats=True, paging=True)
 app.add_url_rule("/admin/ip_bans/new", "admin_new_ip_ban", admin.new_ip_ban, methods=("POST",))
@@ -1,15 +1,15 @@
 import json
 import time
 
+from collections import namedtuple
 from flask import abort, g
 from functools import wraps
-from sqlalchemy import and_, func
+from sqlalchemy import and_
 from sqlalchemy.orm import joinedload
 
 from newparp.model import AgeGroup, allowed_level_options, Ban, Invite, ChatUser, Message
-from newparp.model.connections import NewparpRedis, redis_chat_pool
-from newparp.model.user_list import UserListStore
-from newparp.tasks import celery
+from newparp.model.connections import after_commit, NewparpRedis, redis_chat_pool
+from newparp.model.user_list import ChatAccessStore, ConnectionTokenStore, DraftStore, UserListStore
 
 
 class UnauthorizedException(Exception):
@@ -32,6 +32,23 @@ class KickedException(Exception):
     pass
 
 
+# What a join message needs to know about the person joining, so it can be
+# sent from a connection token without loading them from the database.
+JoinDetails = namedtuple("JoinDetails", ("user_id", "chat_id", "chat_type", "name", "acronym", "group", "is_admin"))
+
+
+def join_details(chat_user, user, chat):
+    return JoinDetails(
+        user_id=user.id,
+        chat_id=chat.id,
+        chat_type=chat.type,
+        name=chat_user.name,
+        acronym=chat_user.acronym,
+        group=chat_user.computed_group,
+        is_admin=user.is_admin,
+    )
+
+
 def require_socket(f):
     """Only allow this request if the user has a socket open."""
     @wraps(f)
@@ -52,7 +69,7 @@ def group_chat_only(f):
     return decorated_function
 
 
-def authorize_joining(db, context):
+def authorize_joining(db, redis, context):
     """Stuff to be verified before a person can join a chat.
 
     This includes checking whether they're banned, whether the chat is private,
@@ -67,6 +84,9 @@ def authorize_joining(db, context):
     if context.user is not None and context.user.is_admin:
         return
 
+    access = ChatAccessStore(redis, context.chat_id)
+    banned, invited, version = access.check(context.user_id)
+
     if context.chat.type == "group":
 
         if context.chat.publicity == "admin_only":
@@ -81,16 +101,20 @@ def authorize_joining(db, context):
             if context.user_id == context.chat.creator_id:
                 return
 
-            if db.query(func.count('*')).select_from(Invite).filter(and_(
-                Invite.chat_id == context.chat_id,
-                Invite.user_id == context.user_id,
-            )).scalar() != 1:
+            if invited is None:
+                invited_user_ids = [_ for _, in db.query(Invite.user_id).filter(Invite.chat_id == context.chat_id)]
+                access.load_invites(version, invited_user_ids)
+                invited = context.user_id in invited_user_ids
+
+            if not invited:
                 raise UnauthorizedException
 
-    if db.query(func.count('*')).select_from(Ban).filter(and_(
-        Ban.chat_id == context.chat_id,
-        Ban.user_id == context.user_id,
-    )).scalar() != 0:
+    if banned is None:
+        banned_user_ids = [_ for _, in db.query(Ban.user_id).filter(Ban.chat_id == context.chat_id)]
+        access.load_bans(version, banned_user_ids)
+        banned = context.user_id in banned_user_ids
+
+    if banned:
         raise BannedException
 
     if context.chat.type == "group":
@@ -104,44 +128,97 @@ def authorize_joining(db, context):
         raise TooManyPeopleException
 
 
+def authorize_reconnecting(redis, user_list, token):
+    """
+    The parts of authorize_joining which can be checked without the
+    database, for people reconnecting with a connection token. Returns False
+    if they fail any of them or the bans or invites aren't cached, so they
+    can go through authorize_joining instead.
+
+    Tokens are deleted when the chat's publicity or level changes, so they
+    don't need checking again here.
+    """
+    if token["is_admin"]:
+        return True
+
+    banned, invited, version = ChatAccessStore(redis, token["chat_id"]).check(token["user_id"])
+    if banned is None or banned:
+        return False
+
+    if token["publicity"] == "admin_only":
+        return False
+    if token["publicity"] == "private" and token["group"] != "creator" and not invited:
+        return False
+
+    return len(user_list.user_ids_online()) < 50
+
+
+def invalidate_chat_access(db, redis, chat_id):
+    """
+    Drops a chat's cached bans and invites once the current transaction has
+    been committed.
+    """
+    after_commit(db, ChatAccessStore(redis, chat_id).invalidate)
+
+
+def invalidate_chat_tokens(db, redis, chat_id):
+    """
+    Invalidates a chat's connection tokens once the current transaction has
+    been committed, so tokens minted before a settings change can't be used
+    after it.
+    """
+    after_commit(db, lambda: ConnectionTokenStore(redis).invalidate_all_tokens_for_chat(chat_id))
+
+
+def invalidate_user_tokens(db, redis, user_id, chat_id):
+    """
+    Invalidates someone's connection tokens for a chat once the current
+    transaction has been committed. Tokens remember the chat user's name and
+    group, so this is needed whenever they change.
+    """
+    after_commit(db, lambda: ConnectionTokenStore(redis).invalidate_connection_token(user_id, chat_id))
+
+
 def kick_check(redis, context):
     # If they've been kicked recently, don't let them in.
-    if redis.exists("kicked:%s:%s" % (context.chat.id, context.user.id)):
+    if redis.exists("kicked:%s:%s" % (context.chat_id, context.user_id)):
         raise KickedException
 
 
-def send_join_message(user_list, db, redis, context):
+def send_join_message(user_list, db, redis, details):
     """
     Send join message or delete previous disconnect message:
     * If the last message in the chat was a disconnect from this user, it's
       deleted.
     * If not, a join message is sent.
     * Either way, the user list is refreshed.
+
+    details is a JoinDetails.
     """
 
     # Queue their last_online update.
-    redis.hset("queue:usermeta", "chatuser:%s" % context.chat_user.user_id, json.dumps({
+    redis.hset("queue:usermeta", "chatuser:%s" % details.user_id, json.dumps({
         "last_online": str(time.time()),
-        "chat_id": context.chat_user.chat_id,
+        "chat_id": details.chat_id,
     }))
 
-    if context.chat_user.computed_group == "silent" or context.chat.type in ("pm", "roulette"):
-        send_userlist(user_list, db, context.chat)
+    if details.group == "silent" or details.chat_type in ("pm", "roulette"):
+        send_userlist(user_list, db, details.chat_type)
     else:
-        last_message = db.query(Message).filter(Message.chat_id == context.chat.id).order_by(Message.posted.desc()).first()
+        last_message = db.query(Message).filter(Message.chat_id == details.chat_id).order_by(Message.posted.desc()).first()
         # If they just disconnected, delete the disconnect message instead.
-        if last_message is not None and last_message.type in ("disconnect", "timeout") and last_message.user_id == context.user.id:
+        if last_message is not None and last_message.type in ("disconnect", "timeout") and last_message.user_id == details.user_id:
             delete_message(user_list, db, last_message, force_userlist=True)
         else:
             send_message(db, user_list.redis, Message(
-                chat_id=context.chat.id,
-                user_id=context.user.id,
+                chat_id=details.chat_id,
+                user_id=details.user_id,
                 type="join",
-                name=context.chat_user.name,
+                name=details.name,
                 text="%s [%s] joined chat. %s" % (
-                    context.chat_user.name,
-                    context.chat_user.acronym,
-                    "~~MxRP STAFF~~" if context.user.is_admin else ""
+                    details.name,
+                    details.acronym,
+                    "~~MxRP STAFF~~" if details.is_admin else ""
                 ),
             ), user_list)
 
@@ -166,8 +243,11 @@ def send_message(db, redis, message, user_list=None, force_userlist=False):
     redis_chat.expire(cache_key, 604800)
 
     # Prepare pubsub message
+    # The live worker uses the published time to measure how long messages
+    # take to reach the sockets, and strips it before sending them on.
     redis_message = {
         "messages": [message_dict],
+        "published": time.time(),
     }
 
     # Reload userlist if necessary.
@@ -205,9 +285,10 @@ def send_message(db, redis, message, user_list=None, force_userlist=False):
                 if message.chat.last_message <= chat_user.last_online:
                     redis.publish("channel:pm:%s" % chat_user.user_id, "{\"pm\":\"1\"}")
 
-    # And send the message to spamless last.
-    # 1 second delay to prevent the task from executing before we commit the message.
-    celery.send_task("newparp.tasks.spamless.CheckSpamTask", args=(message.chat_id, redis_message), countdown=1)
+    # And send the message to spamless last, once it's been committed so the
+    # worker can flag it.
+    spamless_message = json.dumps({"chat_id": message.chat_id, "message": message_dict})
+    after_commit(db, lambda: redis.lpush("spamless:queue", spamless_message))
 
 
 def send_temporary_message(redis, chat, to_id, user_number, message_type, text):
@@ -248,20 +329,33 @@ def get_userlist(user_list, db):
     ]
 
 
-def send_userlist(user_list, db, chat):
+def chat_user_options(user_list, chat_user):
+    """
+    Returns the chat user with their settings, and their draft from Redis if
+    there's a newer one there which hasn't been written to the database yet.
+    """
+    chat_user_dict = chat_user.to_dict(include_options=True)
+    draft = DraftStore(user_list.redis).get(chat_user.chat_id, chat_user.user_id)
+    if draft is not None:
+        chat_user_dict["draft"] = draft
+    return chat_user_dict
+
+
+def send_userlist(user_list, db, chat_type):
     # Update the userlist without sending a message.
-    if chat.type == "pm":
+    if chat_type == "pm":
         for user_id, in db.query(ChatUser.user_id).filter(ChatUser.chat_id == user_list.chat_id):
             user_list.redis.publish("channel:pm:%s" % user_id, "{\"pm\":\"1\"}")
     user_list.redis.publish("channel:%s" % user_list.chat_id, json.dumps({
         "messages": [],
         "users": get_userlist(user_list, db),
+        "published": time.time(),
     }))
 
 
 def send_quit_message(user_list, db, chat_user, user, chat, type="disconnect"):
     if chat_user.computed_group == "silent" or chat.type in ("pm", "roulette"):
-        send_userlist(user_list, db, chat)
+        send_userlist(user_list, db, chat.type)
     else:
         if type == "disconnect":
             text = "%s [%s] disconnected." % (chat_user.name, chat_user.acronym)
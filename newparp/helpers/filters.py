@@ -0,0 +1,212 @@
+import re
+import zlib
+
+from collections import deque
+
+
+class FilterMatcher(object):
+    """
+    Aho-Corasick automaton for checking whether any of a list of phrases
+    appears in a piece of text.
+
+    Building the automaton takes time proportional to the total length of the
+    phrases, but searching only depends on the length of the text, so a
+    matcher should be built once and reused for long filter lists. Empty
+    phrases are ignored.
+    """
+
+    def __init__(self, phrases):
+        # State 0 is the root. Each state has a dict of transitions, a failure
+        # link and the phrase which ends there (or at the end of its failure
+        # chain), if any.
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [None]
+
+        self.phrases = []
+        for phrase in phrases:
+            if not phrase:
+                continue
+            self.phrases.append(phrase)
+            state = 0
+            for character in phrase:
+                next_state = self.transitions[state].get(character)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append(None)
+                    self.transitions[state][character] = next_state
+                state = next_state
+            self.outputs[state] = phrase
+
+        # Breadth first so each state's failure link is resolved before its
+        # children need it.
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(character, 0)
+                if self.outputs[next_state] is None:
+                    self.outputs[next_state] = self.outputs[self.failures[next_state]]
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def search(self, text):
+        """Returns the first phrase found in the text, or None."""
+        if not self.phrases:
+            return None
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        state = 0
+        for character in text:
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            if outputs[state] is not None:
+                return outputs[state]
+        return None
+
+
+# Backreferences, named groups and global inline flags would change meaning
+# (or fail to compile) when a pattern is part of a bigger alternation.
+uncombinable_pattern = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)")
+
+# Plain ASCII phrases, optionally between word boundaries. Anything escaped
+# has to be punctuation so it's a literal character.
+literal_pattern = re.compile(
+    r"^(\\b)?((?:(?![\\.^$*+?{}\[\]|()])[\x20-\x7e]|\\[\x20-\x2f\x3a-\x40\x5b-\x60\x7b-\x7e])+)(\\b)?$"
+)
+unescape_pattern = re.compile(r"\\(.)")
+
+
+def is_ascii(text):
+    try:
+        text.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+class RegexSet(object):
+    """
+    A list of regular expressions which can all be checked against a piece
+    of text at once.
+
+    Plain phrases (the majority of most filter lists) go into a FilterMatcher
+    so ASCII text only needs one pass however many there are, and everything
+    else is combined into one alternation. Patterns which can't safely be
+    combined are checked separately.
+
+    Each pattern can have a weight for score(), which gives the same result
+    as adding up len(pattern.findall(text)) * weight for every pattern.
+    """
+
+    def __init__(self, patterns, flags=0, weights=None):
+        self.patterns = [re.compile(_, flags) for _ in patterns]
+        self.weights = list(weights) if weights is not None else [1] * len(self.patterns)
+
+        # Lowercasing is only the same as IGNORECASE when both sides are
+        # ASCII, so only case insensitive patterns can use the matcher.
+        literals = []
+        self.literal_patterns = []
+        others = []
+        self.separate = []
+        for pattern in self.patterns:
+            match = literal_pattern.match(pattern.pattern) if flags & re.IGNORECASE else None
+            if match:
+                literals.append(unescape_pattern.sub(r"\1", match.group(2)).lower())
+                self.literal_patterns.append(pattern)
+            elif uncombinable_pattern.search(pattern.pattern):
+                self.separate.append(pattern)
+            else:
+                others.append(pattern)
+        self.literals = FilterMatcher(literals) if literals else None
+
+        self.combined = None
+        if others:
+            try:
+                self.combined = re.compile("|".join("(?:%s)" % _.pattern for _ in others), flags)
+            except re.error:
+                self.separate += others
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, text):
+        """Returns a match for any of the patterns, or None."""
+        # The matcher can give false positives because of word boundaries,
+        # so anything it finds is checked properly.
+        if self.literals is not None and (
+            not is_ascii(text) or self.literals.search(text.lower()) is not None
+        ):
+            for pattern in self.literal_patterns:
+                match = pattern.search(text)
+                if match is not None:
+                    return match
+        if self.combined is not None:
+            match = self.combined.search(text)
+            if match is not None:
+                return match
+        for pattern in self.separate:
+            match = pattern.search(text)
+            if match is not None:
+                return match
+        return None
+
+    def score(self, text):
+        # Matches can overlap between patterns, so they still need counting
+        # individually, but most text doesn't match anything and can be
+        # skipped after one scan.
+        if self.search(text) is None:
+            return 0
+        return sum(
+            len(pattern.findall(text)) * weight
+            for pattern, weight in zip(self.patterns, self.weights)
+            if weight
+        )
+
+
+normalize_pattern = re.compile(r"[\W_]+")
+
+
+def similarity_bands(text, buckets=32, rows=4, shingle_size=5, min_length=40, max_length=1000):
+    """
+    Locality-sensitive hashes for finding near-duplicate text. Returns a list
+    of band strings, and texts which are mostly the same will usually have at
+    least one band in common. Short text returns an empty list because too
+    much of it is the same by chance.
+
+    This is a one permutation MinHash over character shingles of the
+    normalised text: each shingle is hashed once and the hash decides which
+    bucket it goes in, and the bucket minimums are split into bands. Bands
+    with an empty bucket are left out, because unrelated short texts would
+    share them.
+    """
+    data = normalize_pattern.sub(" ", text.lower()).strip().encode("utf-8")[:max_length]
+    if len(data) < min_length:
+        return []
+
+    mask = buckets - 1
+    shift = mask.bit_length()
+    minimums = [None] * buckets
+    for i in range(len(data) - shingle_size + 1):
+        shingle_hash = zlib.crc32(data[i:i + shingle_size])
+        bucket = shingle_hash & mask
+        value = shingle_hash >> shift
+        if minimums[bucket] is None or value < minimums[bucket]:
+            minimums[bucket] = value
+
+    bands = []
+    for band in range(buckets // rows):
+        band_minimums = minimums[band * rows:(band + 1) * rows]
+        if None in band_minimums:
+            continue
+        bands.append("%s:%s" % (band, "-".join("%x" % _ for _ in band_minimums)))
+    return bands
@@ -1,10 +1,63 @@
+import json
+
 from collections import namedtuple
-from newparp.model import AgeGroup
+from sqlalchemy import or_
+
+from newparp.model import AgeGroup, Block
+
+
+# Searchers are stored in a single hash at searcher:<id>, with the compound
+# fields JSON encoded. Searchers used to be spread across several keys
+# (searcher:<id>:session_id, searcher:<id>:character etc.), so the scripts
+# below fall back to those if the hash doesn't exist.
+legacy_searcher_keys = (
+    "session_id", "search_character_id", "character", "style", "levels",
+    "age_group", "filters", "choices",
+)
+
+
+def store_searcher(
+    redis, searcher_id, session_id, search_character_id, character, style,
+    levels, age_group=None, filters=(), choices=(),
+):
+    """Save a new searcher with a 30 second TTL."""
+    record = {
+        "session_id": session_id,
+        "search_character_id": search_character_id,
+        "character": json.dumps(character),
+        "style": style,
+        "levels": json.dumps(sorted(levels)),
+        "filters": json.dumps(list(filters)),
+        "choices": json.dumps(sorted(choices)),
+    }
+    if age_group is not None:
+        record["age_group"] = age_group.value
+    pipe = redis.pipeline()
+    pipe.hmset("searcher:%s" % searcher_id, record)
+    pipe.expire("searcher:%s" % searcher_id, 30)
+    pipe.execute()
+
+
+def delete_searcher(redis, searcher_id):
+    """Remove a searcher from the searchers set and delete its keys."""
+    pipe = redis.pipeline()
+    pipe.srem("searchers", searcher_id)
+    pipe.delete("searcher:%s" % searcher_id, *(
+        "searcher:%s:%s" % (searcher_id, _) for _ in legacy_searcher_keys
+    ))
+    pipe.execute()
 
 
 def validate_searcher_exists(redis, searcher_id):
     """Check whether a searcher's mandatory keys are present."""
-    return redis.eval("""local session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
+    return redis.eval("""local session_id = redis.call("hget", "searcher:"..ARGV[1], "session_id")
+    if session_id then
+        return {
+            session_id,
+            redis.call("get", "session:"..session_id),
+        }
+    end
+    session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
     return {
         session_id,
         redis.call("get",   "session:"..session_id),
@@ -17,7 +70,15 @@ def validate_searcher_exists(redis, searcher_id):
 
 def validate_searcher_is_searching(redis, searcher_id):
     """Check whether a searcher's mandatory keys are present and they're in the searchers set."""
-    return redis.eval("""local session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
+    return redis.eval("""local session_id = redis.call("hget", "searcher:"..ARGV[1], "session_id")
+    if session_id then
+        return {
+            redis.call("sismember", "searchers", ARGV[1]),
+            session_id,
+            redis.call("get", "session:"..session_id),
+        }
+    end
+    session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
     return {
         redis.call("sismember", "searchers", ARGV[1]),
         session_id,
@@ -30,9 +91,20 @@ def validate_searcher_is_searching(redis, searcher_id):
 
 
 def refresh_searcher(redis, searcher_id):
-    """Reset the expiry times on a searcher's keys."""
-    return redis.eval("""local session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
-    return {
+    """
+    Reset the expiry time on a searcher's keys. Returns a list which will be
+    all truthy if the searcher is still alive.
+    """
+    return redis.eval("""local session_id = redis.call("hget", "searcher:"..ARGV[1], "session_id")
+    if session_id then
+        return {
+            redis.call("get",       "session:"..session_id),
+            redis.call("sismember", "searchers", ARGV[1]),
+            redis.call("expire",    "searcher:"..ARGV[1], 30),
+        }
+    end
+    session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
+    local alive = {
         redis.call("get",       "session:"..session_id),
         redis.call("sismember", "searchers", ARGV[1]),
         redis.call("expire",    "searcher:"..ARGV[1]..":session_id",          30),
@@ -40,10 +112,12 @@ def refresh_searcher(redis, searcher_id):
         redis.call("expire",    "searcher:"..ARGV[1]..":character",           30),
         redis.call("expire",    "searcher:"..ARGV[1]..":style",               30),
         redis.call("expire",    "searcher:"..ARGV[1]..":levels",              30),
-        redis.call("expire",    "searcher:"..ARGV[1]..":age_group",           30),
-        redis.call("expire",    "searcher:"..ARGV[1]..":filters",             30),
-        redis.call("expire",    "searcher:"..ARGV[1]..":choices",             30),
-    }""", 0, searcher_id)
+    }
+    -- These are optional so they don't count towards being alive.
+    redis.call("expire", "searcher:"..ARGV[1]..":age_group", 30)
+    redis.call("expire", "searcher:"..ARGV[1]..":filters",   30)
+    redis.call("expire", "searcher:"..ARGV[1]..":choices",   30)
+    return alive""", 0, searcher_id)
 
 
 searcher = namedtuple("searcher", (
@@ -54,8 +128,20 @@ searcher = namedtuple("searcher", (
 
 def fetch_searcher(redis, searcher_id):
     """Fetch searcher keys for matching."""
-    searcher_keys = redis.eval("""local session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
+    searcher_keys = redis.eval("""local record = redis.call("hgetall", "searcher:"..ARGV[1])
+    if #record ~= 0 then
+        local session_id = redis.call("hget", "searcher:"..ARGV[1], "session_id")
+        return {
+            "record",
+            redis.call("sismember", "searchers", ARGV[1]),
+            session_id,
+            redis.call("get", "session:"..session_id),
+            record,
+        }
+    end
+    local session_id = redis.call("get", "searcher:"..ARGV[1]..":session_id") or ""
     return {
+        "legacy",
         redis.call("sismember", "searchers", ARGV[1]),
         session_id,
         redis.call("get",      "session:"..session_id),
@@ -67,16 +153,76 @@ def fetch_searcher(redis, searcher_id):
         redis.call("lrange",   "searcher:"..ARGV[1]..":filters", 0, -1),
         redis.call("smembers", "searcher:"..ARGV[1]..":choices"),
     }""", 0, searcher_id)
+
     # Hashes and sets get returned as lists so we need to convert them manually.
-    if searcher_keys[4]:
-        searcher_keys[4] = {k: v for k, v in zip(*(iter(searcher_keys[4]),) * 2)}
+    if searcher_keys[0] == "record":
+        searching, session_id, user_id, record = searcher_keys[1:]
+        record = {k: v for k, v in zip(*(iter(record),) * 2)}
+        searcher_keys = [
+            searching, session_id, user_id,
+            record["search_character_id"],
+            json.loads(record["character"]),
+            record["style"],
+            json.loads(record["levels"]),
+            record.get("age_group"),
+            json.loads(record["filters"]),
+            json.loads(record["choices"]),
+        ]
+    else:
+        searcher_keys = searcher_keys[1:]
+        if searcher_keys[4]:
+            searcher_keys[4] = {k: v for k, v in zip(*(iter(searcher_keys[4]),) * 2)}
+
+    if searcher_keys[3]:
+        searcher_keys[3] = int(searcher_keys[3])
     searcher_keys[6] = set(searcher_keys[6])
     if searcher_keys[7]:
         searcher_keys[7] = AgeGroup(searcher_keys[7])
-    searcher_keys[9] = set(searcher_keys[9])
+    searcher_keys[9] = set(int(_) for _ in searcher_keys[9])
     return searcher(searcher_id, *searcher_keys)
 
 
+def load_blocked_user_ids(redis, db, user_id):
+    """
+    Load the IDs of everyone a user has blocked or been blocked by, and cache
+    them so the matchmaker can check blocks without querying the database.
+    """
+    blocked_user_ids = set()
+    for blocking_user_id, blocked_user_id in db.query(
+        Block.blocking_user_id, Block.blocked_user_id,
+    ).filter(or_(
+        Block.blocking_user_id == user_id,
+        Block.blocked_user_id == user_id,
+    )):
+        blocked_user_ids.add(blocked_user_id if blocking_user_id == user_id else blocking_user_id)
+
+    # The set always contains 0 (which is never a user ID) so that users with
+    # no blocks still have a key and don't count as a cache miss.
+    pipe = redis.pipeline()
+    pipe.delete("blocks:%s" % user_id)
+    pipe.sadd("blocks:%s" % user_id, 0, *blocked_user_ids)
+    pipe.expire("blocks:%s" % user_id, 3600)
+    pipe.execute()
+
+    return blocked_user_ids
+
+
+def get_blocked_user_ids(redis, user_id):
+    """
+    Get a user's cached block relationships. Returns None if they haven't been
+    loaded.
+    """
+    blocked_user_ids = redis.smembers("blocks:%s" % user_id)
+    if not blocked_user_ids:
+        return None
+    return set(int(_) for _ in blocked_user_ids) - {0}
+
+
+def invalidate_blocked_user_ids(redis, *user_ids):
+    """Clear cached block relationships after a block is added or removed."""
+    redis.delete(*("blocks:%s" % _ for _ in user_ids))
+
+
 option_messages = {
     "script":       "This is a script style chat.",
     "paragraph":    "This is a paragraph style chat.",
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import time
+
+from collections import namedtuple
+from flask import g, Markup, render_template
+from sqlalchemy.orm import joinedload
+
+from newparp.model import Fandom, SearchCharacterGroup
+from newparp.model.connections import after_commit, db_connect
+
+
+CachedFandom = namedtuple("CachedFandom", ("id", "name", "groups"))
+CachedGroup = namedtuple("CachedGroup", ("id", "name", "characters"))
+CachedSearchCharacter = namedtuple("CachedSearchCharacter", ("id", "title", "name", "acronym", "color", "text_preview"))
+
+
+class FandomTree(object):
+    """
+    Every fandom with its groups and search characters, as plain tuples so
+    it can outlive the session it was loaded in, and the character picker
+    options rendered from it.
+
+    The bundle is every search character's settings as one JSON object
+    keyed by ID. Its hash goes in the URL, so browsers can cache it until
+    something changes.
+    """
+
+    def __init__(self, version, fandoms, bundle):
+        self.version = version
+        self.fandoms = fandoms
+        self.pickers = {}
+        self.bundle = bundle
+        self.bundle_hash = hashlib.sha1(bundle.encode("utf-8")).hexdigest()[:16]
+
+    def picker(self, value_prefix, selected_id):
+        """
+        Returns the <optgroup>s for a search character <select>, with the
+        given character selected. Option values are the character IDs after
+        value_prefix.
+        """
+        if value_prefix not in self.pickers:
+            self.pickers[value_prefix] = render_template(
+                "search_characters/picker.html",
+                fandoms=self.fandoms,
+                value_prefix=value_prefix,
+            )
+        option = 'value="%s%s">' % (value_prefix, selected_id)
+        return Markup(self.pickers[value_prefix].replace(option, option[:-1] + ' selected="selected">', 1))
+
+
+# Shared by every request in this process until the version changes.
+fandom_tree = {"tree": None}
+
+
+def load_fandom_tree():
+    """
+    Returns the FandomTree, loading it again if search characters have been
+    changed since this process last loaded it.
+    """
+    version = g.redis.get("search_characters:version")
+    tree = fandom_tree["tree"]
+    if tree is not None and tree.version == version:
+        return tree
+
+    db_connect()
+    fandoms = (
+        g.db.query(Fandom)
+        .order_by(Fandom.name)
+        .options(
+            joinedload(Fandom.groups)
+            .joinedload(SearchCharacterGroup.characters)
+        ).all()
+    )
+    tree = FandomTree(version, [
+        CachedFandom(fandom.id, fandom.name, [
+            CachedGroup(group.id, group.name, [
+                CachedSearchCharacter(
+                    character.id, character.title, character.name,
+                    character.acronym, character.color, character.text_preview,
+                )
+                for character in group.characters
+            ])
+            for group in fandom.groups
+        ])
+        for fandom in fandoms
+    ], json.dumps({
+        character.id: character.to_dict(include_options=True)
+        for fandom in fandoms
+        for group in fandom.groups
+        for character in group.characters
+    }, sort_keys=True, separators=(",", ":")))
+    fandom_tree["tree"] = tree
+    return tree
+
+
+def invalidate_fandom_tree():
+    """
+    Tells every process to reload the fandom tree and rebuild the bundle
+    once the current transaction has been committed.
+    """
+    redis = g.redis
+    after_commit(g.db, lambda: redis.set("search_characters:version", str(time.time())))
@@ -1,7 +1,6 @@
 import json
 import time
 
-from sqlalchemy import func
 from sqlalchemy.orm.session import Session
 
 from newparp.model import IPBan
@@ -9,7 +8,7 @@ from newparp.model.connections import NewparpRedis
 
 
 def queue_user_meta(context, redis: NewparpRedis, last_ip: str):
-    redis.hset("queue:usermeta", "user:%s" % (context.user.id), json.dumps({
+    redis.hset("queue:usermeta", "user:%s" % (context.user_id), json.dumps({
         "last_online": str(time.time()),
         "last_ip": last_ip,
     }))
@@ -23,9 +22,9 @@ def get_ip_banned(ip_address: str, db: Session, redis: NewparpRedis, use_cache:
         except (ValueError, TypeError):
             pass
 
-    ip_bans = db.query(func.count('*')).select_from(IPBan).filter(IPBan.address.op(">>=")(ip_address)).scalar()
-    banned = ip_bans > 0
-    redis.setex("bans:%s" % (ip_address), 60, ip_bans)
+    # EXISTS can stop at the first ban the GiST index finds.
+    banned = db.query(db.query(IPBan).filter(IPBan.address.op(">>=")(ip_address)).exists()).scalar()
+    redis.setex("bans:%s" % (ip_address), 60, int(banned))
 
     return banned
 
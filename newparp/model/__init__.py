@@ -8,8 +8,8 @@ from bcrypt import gensalt, hashpw
 from collections import OrderedDict
 from enum import Enum
 from pytz import timezone, utc
-from sqlalchemy import and_, create_engine
-from sqlalchemy.schema import Index
+from sqlalchemy import and_, create_engine, event
+from sqlalchemy.schema import DDL, Index
 from sqlalchemy.orm import (
     backref,
     relation,
@@ -1131,6 +1131,22 @@ class SpamFlag(Base):
 # Index to make usernames case insensitively unique.
 Index("users_username", func.lower(User.username), unique=True)
 
+# Trigram indexes for searching usernames and e-mail addresses in the admin
+# user list. Index() can't give an operator class to an expression, so these
+# are plain DDL, and they need the pg_trgm extension.
+event.listen(User.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+event.listen(User.__table__, "after_create", DDL(
+    "CREATE INDEX users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)"
+))
+event.listen(User.__table__, "after_create", DDL(
+    "CREATE INDEX users_email_address_trgm ON users USING gin (lower(email_address) gin_trgm_ops)"
+))
+
+# GiST indexes for IP address containment (<<= and >>=), for IP bans and
+# looking up users by IP range.
+Index("users_last_ip", User.last_ip, postgresql_using="gist", postgresql_ops={"last_ip": "inet_ops"})
+Index("ip_bans_address", IPBan.address, postgresql_using="gist", postgresql_ops={"address": "inet_ops"})
+
 # Index for user characters.
 Index("characters_user_id", Character.user_id)
 
@@ -1152,6 +1168,14 @@ Index("chat_users_number_unique", ChatUser.chat_id, ChatUser.number, unique=True
 # Index to make log rendering easier.
 Index("messages_chat_id", Message.chat_id, Message.posted)
 
+# Partial index for the spamless message log, so it doesn't have to look
+# through every message to find the flagged ones.
+Index(
+    "messages_spam_flag",
+    Message.id,
+    postgresql_where=Message.spam_flag != None,
+)
+
 # Index for searching characters by tag.
 Index("character_tags_tag_id", CharacterTag.tag_id)
 
@@ -5,7 +5,7 @@ from flask import abort, g, redirect, request
 from functools import wraps
 from redis import ConnectionPool, StrictRedis
 from redis.client import BasePipeline
-from sqlalchemy import and_, func
+from sqlalchemy import and_, event, func
 from sqlalchemy.orm.exc import NoResultFound
 from uuid import uuid4
 
@@ -27,6 +27,26 @@ def session_scope():
         session.close()
 
 
+def after_commit(db, callback):
+    """
+    Calls callback once the session's current transaction has been
+    committed. It's dropped if the transaction is rolled back, so it can't
+    run when a later one commits.
+    """
+    db.info.setdefault("after_commit", []).append(callback)
+
+
+@event.listens_for(sm, "after_commit")
+def run_after_commit(session):
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+
+@event.listens_for(sm, "after_rollback")
+def discard_after_commit(session):
+    session.info.pop("after_commit", None)
+
+
 # Redis DB for sessions, caching etc.
 redis_pool = ConnectionPool(
     host=os.environ["REDIS_HOST"],
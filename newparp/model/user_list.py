@@ -8,52 +8,82 @@ class ConnectionTokenStore(object):
     """
     Helper class for managing connection tokens.
 
-    The live process doesn't do any authentication. Instead it uses a token
-    generated by one of the chat endpoints.
+    The chat page gives the front end a token saying which user, chat and
+    user number it's just been authorised as, along with the details the
+    live process needs for a join message. Each connection which gets in is
+    sent a new token to reconnect with, and the one it used is deleted, so
+    reconnecting doesn't need the database. The live process still checks
+    the cached bans and invites and the user limit before accepting a token.
+
+    Redis keys used for tokens:
+    * connection:token:<token> - hash with the token's details.
+    * connection:chat:<chat_id> - sorted set of tokens issued for the chat,
+      scored by when they expire.
+    * connection:user:<user_id> - sorted set of tokens issued to the user,
+      scored by when they expire.
+    Tokens last a day. They're deleted through the sorted sets when
+    something they depend on changes, and expired ones are trimmed from the
+    sorted sets whenever a new one is added.
     """
-    expire_time       = 10 # is this long enough?
+    expire_time       = 86400
     forward_token_key = "connection:token:%s"
-    reverse_token_key = "connection:user:%s:%s"
+    chat_tokens_key   = "connection:chat:%s"
+    user_tokens_key   = "connection:user:%s"
+    fields = (
+        "user_id", "chat_id", "session_id", "user_number", "chat_type",
+        "publicity", "name", "acronym", "group", "is_admin",
+    )
 
     def __init__(self, redis):
         self.redis = redis
 
     create_connection_token_script = """
-        local forward = "connection:token:"..ARGV[3]
-        local reverse = "connection:user:"..ARGV[1]..":"..ARGV[2]
-        local existing_token = redis.call("get", reverse)
-        if existing_token then
-            redis.call("del", "connection:token:"..existing_token)
-        end
-        redis.call("hmset",  forward, "user_id", ARGV[1], "chat_id", ARGV[2], "session_id", ARGV[3])
+        local forward = "connection:token:"..ARGV[1]
+        local chat_tokens = "connection:chat:"..ARGV[3]
+        local user_tokens = "connection:user:"..ARGV[2]
+        redis.call("hmset", forward,
+            "user_id", ARGV[2], "chat_id", ARGV[3], "session_id", ARGV[4],
+            "user_number", ARGV[5], "chat_type", ARGV[6], "publicity", ARGV[7],
+            "name", ARGV[8], "acronym", ARGV[9], "group", ARGV[10], "is_admin", ARGV[11]
+        )
         redis.call("expire", forward, {expire_time})
-        redis.call("set",    reverse, ARGV[4])
-        redis.call("expire", reverse, {expire_time})
+        for _, key in ipairs({{chat_tokens, user_tokens}}) do
+            redis.call("zremrangebyscore", key, "-inf", ARGV[12])
+            redis.call("zadd",   key, ARGV[12] + {expire_time}, ARGV[1])
+            redis.call("expire", key, {expire_time})
+        end
     """.format(expire_time=expire_time)
 
-    def create_connection_token(self, user_id, chat_id, session_id):
+    def create_connection_token(self, session_id, user_number, publicity, details):
         """
-        Creates a connection token for the user in the chat. Returns a UUID to
-        be passed to the front end.
+        Creates a connection token for a JoinDetails from the chat helpers.
+        Returns a UUID to be passed to the front end.
         """
         token = str(uuid.uuid4())
-        self.redis.eval(self.create_connection_token_script, 0, user_id, chat_id, session_id, token)
+        self.redis.eval(
+            self.create_connection_token_script, 0, token,
+            details.user_id, details.chat_id, session_id, user_number,
+            details.chat_type, publicity or "", details.name or "",
+            details.acronym or "", details.group, 1 if details.is_admin else 0,
+            int(time.time()),
+        )
         return token
 
     use_connection_token_script = """
-        local user_id = redis.call("hget", "connection:token:"..ARGV[1], "user_id")
-        local chat_id = redis.call("hget", "connection:token:"..ARGV[1], "chat_id")
-        local chat_id = redis.call("hget", "connection:token:"..ARGV[1], "session_id")
-        if not user_id then return {} end
-
-        redis.call("del", "connection:token:"..ARGV[1], "connection:user:"..user_id..":"..chat_id)
-        return {user_id, chat_id, session_id}
+        local forward = "connection:token:"..ARGV[1]
+        local data = redis.call("hmget", forward, "user_id", "chat_id", "session_id", "user_number", "chat_type", "publicity", "name", "acronym", "group", "is_admin")
+        if not data[1] then return {} end
+
+        redis.call("del", forward)
+        redis.call("zrem", "connection:chat:"..data[2], ARGV[1])
+        redis.call("zrem", "connection:user:"..data[1], ARGV[1])
+        return data
     """
 
     def use_connection_token(self, token):
         """
-        Gets details for (and destroys) a token. Returns a (user_id, chat_id)
-        tuple.
+        Gets details for (and destroys) a token. Returns a dict keyed by
+        fields.
         """
         try:
             token_uuid = uuid.UUID(token)
@@ -62,40 +92,219 @@ class ConnectionTokenStore(object):
         data = self.redis.eval(self.use_connection_token_script, 0, token)
         if not data:
             raise InvalidToken("Token doesn't exist or already used.")
-        return int(data[0]), int(data[1]), data[2]
+        details = dict(zip(self.fields, data))
+        for key in ("user_id", "chat_id", "user_number"):
+            details[key] = int(details[key])
+        details["is_admin"] = details["is_admin"] == "1"
+        return details
 
     invalidate_connection_token_script = """
-        local reverse = "connection:user:"..ARGV[1]..":"..ARGV[2]
-        local token = redis.call("get", reverse)
-        if not token then return end
-
-        redis.call("del", reverse, "connection:token:"..token)
+        local chat_tokens = "connection:chat:"..ARGV[2]
+        local user_tokens = "connection:user:"..ARGV[1]
+        for _, token in ipairs(redis.call("zrange", user_tokens, 0, -1)) do
+            if redis.call("zscore", chat_tokens, token) then
+                redis.call("del", "connection:token:"..token)
+                redis.call("zrem", chat_tokens, token)
+                redis.call("zrem", user_tokens, token)
+            end
+        end
     """
 
     def invalidate_connection_token(self, user_id, chat_id):
         """
-        Invalidates a token by user_id and chat_id. For when a user is banned or
-        uninvited from a chat and we want to make sure they can't use a token
-        from before.
+        Invalidates a user's tokens for a chat. For when a user is banned,
+        uninvited, changes character or has their group changed, so the
+        token can't be used to skip the checks or send old details.
         """
         self.redis.eval(self.invalidate_connection_token_script, 0, user_id, chat_id)
 
+    invalidate_token_set_script = """
+        for _, token in ipairs(redis.call("zrange", ARGV[1], 0, -1)) do
+            redis.call("del", "connection:token:"..token)
+        end
+        redis.call("del", ARGV[1])
+    """
+
     def invalidate_all_tokens_for_user(self, user_id):
         """
         Invalidates all of a user's tokens. For when a user is deactivated or
         given a site-wide ban.
         """
-        next_index = 0
-        pattern = "connection:user:%s:*" % user_id
-        while True:
-            next_index, keys = redis.scan(next_index, pattern)
-            for key in keys:
-                token = self.redis.get(key)
-                if not token:
-                    continue
-                self.redis.delete(self.forward_token_key % token)
-            if next_index == 0:
-                break
+        self.redis.eval(self.invalidate_token_set_script, 0, self.user_tokens_key % user_id)
+
+    def invalidate_all_tokens_for_chat(self, chat_id):
+        """
+        Invalidates all tokens for a chat. For when its publicity or level
+        changes, so everyone has to be checked against the new settings.
+        """
+        self.redis.eval(self.invalidate_token_set_script, 0, self.chat_tokens_key % chat_id)
+
+
+class DraftStore(object):
+    """
+    Helper class for managing drafts.
+
+    Drafts are saved every few seconds while someone's typing, so they're
+    kept in Redis and written to the database in batches by the
+    flush_drafts task.
+
+    Redis keys used for drafts:
+    * chat:<chat_id>:draft:<user_id> - string, with the draft. Has a TTL so
+      it goes once it's been written to the database.
+    * queue:drafts - set of <chat_id>:<user_id> for drafts which haven't been
+      written to the database yet.
+    """
+    expire_time = 3600
+    draft_key   = "chat:%s:draft:%s"
+    queue_key   = "queue:drafts"
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def save(self, chat_id, user_id, text):
+        """Saves a draft and queues it for writing to the database."""
+        pipe = self.redis.pipeline()
+        pipe.setex(self.draft_key % (chat_id, user_id), self.expire_time, text)
+        pipe.sadd(self.queue_key, "%s:%s" % (chat_id, user_id))
+        pipe.execute()
+
+    def get(self, chat_id, user_id):
+        """
+        Returns a draft, or None if it's already been written to the
+        database.
+        """
+        return self.redis.get(self.draft_key % (chat_id, user_id))
+
+    def queued(self):
+        """
+        Returns a list of (chat_id, user_id, text) for the drafts in the
+        queue. The text is None if the draft has expired. This leaves them
+        queued, so call dequeue() once they've been written.
+        """
+        queued = self.redis.smembers(self.queue_key)
+        if not queued:
+            return []
+        queued = [tuple(int(_) for _ in item.split(":")) for item in queued]
+        texts = self.redis.mget([self.draft_key % item for item in queued])
+        return [
+            (chat_id, user_id, text)
+            for (chat_id, user_id), text in zip(queued, texts)
+        ]
+
+    # Drafts which have been saved again since they were read stay queued.
+    dequeue_script = """
+        for i = 3, #ARGV, 3 do
+            local text = redis.call("get", ARGV[i - 1])
+            if (text and "=" .. text or "-") == ARGV[i] then
+                redis.call("srem", ARGV[1], ARGV[i - 2])
+            end
+        end
+    """
+
+    def dequeue(self, drafts):
+        """
+        Removes drafts returned by queued() from the queue, unless they've
+        changed since.
+        """
+        args = []
+        for chat_id, user_id, text in drafts:
+            args += [
+                "%s:%s" % (chat_id, user_id),
+                self.draft_key % (chat_id, user_id),
+                "-" if text is None else "=" + text,
+            ]
+        if args:
+            self.redis.eval(self.dequeue_script, 0, self.queue_key, *args)
+
+
+class ChatAccessStore(object):
+    """
+    Helper class for caching who's banned from and invited to a chat, so
+    joining doesn't need to count them in the database.
+
+    Redis keys used for bans and invites:
+    * chat:<chat_id>:bans - set of banned user IDs.
+    * chat:<chat_id>:invites - set of invited user IDs.
+    * chat:<chat_id>:access_version - counter which goes up whenever the bans
+      or invites change.
+
+    Both sets also contain a placeholder so empty ones can be cached. Changes
+    delete the sets rather than updating them, and a set is only saved if
+    the version hasn't moved since it was read from the database, so a load
+    which raced with a change can't cache the old list.
+    """
+    expire_time = 3600
+    placeholder = "-"
+
+    def __init__(self, redis, chat_id):
+        self.redis   = redis
+        self.chat_id = chat_id
+        self.bans_key    = "chat:%s:bans"           % self.chat_id
+        self.invites_key = "chat:%s:invites"        % self.chat_id
+        self.version_key = "chat:%s:access_version" % self.chat_id
+
+    def check(self, user_id):
+        """
+        Returns a (banned, invited, version) tuple for a user. Banned or
+        invited is None if that set needs loading, in which case the version
+        needs passing to load_bans or load_invites.
+
+        Guests have no user ID and can't be banned or invited, so only
+        whether the sets are loaded is checked for them.
+        """
+        pipe = self.redis.pipeline()
+        pipe.sismember(self.bans_key, self.placeholder)
+        pipe.sismember(self.invites_key, self.placeholder)
+        pipe.get(self.version_key)
+        if user_id is not None:
+            pipe.sismember(self.bans_key, user_id)
+            pipe.sismember(self.invites_key, user_id)
+            bans_loaded, invites_loaded, version, banned, invited = pipe.execute()
+        else:
+            bans_loaded, invites_loaded, version = pipe.execute()
+            banned, invited = False, False
+        return (
+            banned if bans_loaded else None,
+            invited if invites_loaded else None,
+            version or "0",
+        )
+
+    load_script = """
+        if (redis.call("get", ARGV[2]) or "0") ~= ARGV[3] then return end
+        if redis.call("exists", ARGV[1]) == 1 then return end
+        for i = 5, #ARGV do
+            redis.call("sadd", ARGV[1], ARGV[i])
+        end
+        redis.call("expire", ARGV[1], ARGV[4])
+    """
+
+    def load_bans(self, version, user_ids):
+        """
+        Caches the user IDs banned from the chat, unless they've changed
+        since the version was read.
+        """
+        self.redis.eval(
+            self.load_script, 0, self.bans_key, self.version_key, version,
+            self.expire_time, self.placeholder, *user_ids
+        )
+
+    def load_invites(self, version, user_ids):
+        """
+        Caches the user IDs invited to the chat, unless they've changed since
+        the version was read.
+        """
+        self.redis.eval(
+            self.load_script, 0, self.invites_key, self.version_key, version,
+            self.expire_time, self.placeholder, *user_ids
+        )
+
+    def invalidate(self):
+        """Drops the cached bans and invites after either of them changes."""
+        pipe = self.redis.pipeline()
+        pipe.incr(self.version_key)
+        pipe.expire(self.version_key, self.expire_time * 2)
+        pipe.delete(self.bans_key, self.invites_key)
+        pipe.execute()
 
 
 class UserListStore(object):
@@ -321,15 +321,35 @@ var msparp = (function() {
 		return false;
 	}
 
+	// Search characters, from the bundle if it's loaded yet
+	var search_characters = null;
+	function load_search_characters() {
+		var bundle_url = $("#player_select").data("bundle-url");
+		if (bundle_url) {
+			$.get(bundle_url, {}, function(data) { search_characters = data; });
+		}
+	}
+	function get_search_character(id, callback) {
+		if (search_characters && search_characters[id]) {
+			callback(search_characters[id]);
+		} else {
+			$.get("/search_characters/"+id+".json", {}, callback);
+		}
+	}
+
 	// Event handlers for character form
 	function initialize_character_form() {
 		// Search character dropdown
+		load_search_characters();
 		$("select[name=search_character_id]").change(function() {
-			$.get("/search_characters/"+this.value+".json", {}, update_character);
+			get_search_character(this.value, update_character);
 		});
 		$("select[name=id]").change(function() {
-			var url = this.value[0] == "s" ? "search_characters" : "characters";
-			$.get("/" + url + "/" + this.value.substr(2) + ".json", {}, update_character);
+			if (this.value[0] == "s") {
+				get_search_character(this.value.substr(2), update_character);
+			} else {
+				$.get("/characters/" + this.value.substr(2) + ".json", {}, update_character);
+			}
 		});
 		// Text preview
 		var text_preview_container = $("#text_preview_container");
@@ -630,7 +650,7 @@ var msparp = (function() {
 			});
 		},
 		// Chat window
-		"chat": function(chat, user, character_shortcuts, latest_message_id, latest_time, token) {
+		"chat": function(chat, user, character_shortcuts, latest_message_id, latest_time, token, connection_token) {
 
 			$.ajaxSetup({data: {"token": token}});
 
@@ -639,6 +659,7 @@ var msparp = (function() {
 			var status;
 			var next_chat_url;
 			var user_data = {};
+			var current_users = null;
 			if (typeof latest_time == "number") { latest_time = latest_time * 1000 }
 			var latest_date = user.meta.show_timestamps ? new Date(latest_time) : null;
 			var new_messages = [];
@@ -660,7 +681,14 @@ var msparp = (function() {
 				if (ws && ws.readyState != 3) { return; }
 				status = "connecting";
 
-				ws = new WebSocket(ws_protocol + "live." + location.host + "/" + chat.id + "?after=" + latest_message_id);
+				var ws_url = ws_protocol + "live." + location.host + "/" + chat.id + "?after=" + latest_message_id;
+				// Connection tokens only work once. The live server sends a new
+				// one after each successful connection for the next reconnect.
+				if (connection_token) {
+					ws_url += "&token=" + connection_token;
+					connection_token = null;
+				}
+				ws = new WebSocket(ws_url);
 				ws.onopen = function(e) { ws_works = true; ws_connected_time = Date.now(); enter(); }
 				ws.onmessage = function(e) { receive_messages(JSON.parse(e.data)); }
 				ws.onclose = function(e) {
@@ -771,6 +799,7 @@ var msparp = (function() {
 					}
 					return;
 				}
+				if (data.connection_token) { connection_token = data.connection_token; }
 				if (typeof data.chat != "undefined" && chat.type != "pm") {
 					chat = data.chat;
 					if (chat.type == "group") {
@@ -799,7 +828,15 @@ var msparp = (function() {
 						flag_message_level.html(level_names[chat.level]);
 					}
 				}
+				// Group changes on their own get applied to the last user list.
+				if (typeof data.user_groups != "undefined" && typeof data.users == "undefined" && current_users) {
+					for (var number in data.user_groups) {
+						if (user_data[number]) { user_data[number].meta.group = data.user_groups[number]; }
+					}
+					data.users = current_users;
+				}
 				if (typeof data.users != "undefined") {
+					current_users = data.users;
 					var others_online = false;
 					for (var i = 0; i < data.users.length; i++) {
 						// Store user data so we can look it up for action lists.
@@ -853,6 +890,27 @@ var msparp = (function() {
 						}
 					}
 				}
+				if (typeof data.messages != "undefined") {
+					// After a resync the server's backlog can overlap with messages
+					// we've already got, so skip any we've already rendered.
+					data.messages = data.messages.filter(function(message) {
+						return !message.id || $("#message_" + message.id).length == 0;
+					});
+				}
+				// We fell behind and the server replaced what we missed with its
+				// backlog. Say so if the backlog didn't go back far enough.
+				if (data.resync && data.missed) {
+					render_message({
+						"acronym": "",
+						"color": "000000",
+						"id": null,
+						"name": "",
+						"posted": Math.floor(Date.now() / 1000),
+						"text": "Your connection fell behind, so some messages were missed. They can be found in the log.",
+						"type": "chat_meta",
+						"user_number": null,
+					});
+				}
 				if (typeof data.messages != "undefined" && data.messages.length != 0) {
 					var scroll_after_render = is_at_bottom();
 					data.messages.forEach(render_message);
@@ -2,11 +2,11 @@ import datetime
 import json
 
 from celery.utils.log import get_task_logger
-from sqlalchemy import and_
+from sqlalchemy import and_, bindparam
 
 from newparp.model import Chat, ChatUser, GroupChat, User
 from newparp.model.connections import session_scope, NewparpRedis, redis_chat_pool
-from newparp.model.user_list import UserListStore
+from newparp.model.user_list import DraftStore, UserListStore
 from newparp.tasks import celery, WorkerTask
 
 logger = get_task_logger(__name__)
@@ -115,3 +115,37 @@ def update_user_meta():
                 }, synchronize_session=False)
 
     redis.delete("lock:metaupdate")
+
+
+@celery.task(base=WorkerTask, queue="worker")
+def flush_drafts():
+    redis = flush_drafts.redis
+
+    if redis.exists("lock:drafts"):
+        return
+    redis.setex("lock:drafts", 60, 1)
+
+    draft_store = DraftStore(NewparpRedis(connection_pool=redis_chat_pool))
+    drafts = draft_store.queued()
+
+    # Drafts stay queued until they've been committed, so they're retried
+    # next time if this fails.
+    if any(text is not None for chat_id, user_id, text in drafts):
+        with session_scope() as db:
+            db.execute(
+                ChatUser.__table__.update()
+                .where(and_(
+                    ChatUser.chat_id == bindparam("draft_chat_id"),
+                    ChatUser.user_id == bindparam("draft_user_id"),
+                ))
+                .values(draft=bindparam("draft_text")),
+                [
+                    {"draft_chat_id": chat_id, "draft_user_id": user_id, "draft_text": text}
+                    for chat_id, user_id, text in drafts
+                    if text is not None
+                ],
+            )
+
+    draft_store.dequeue(drafts)
+
+    redis.delete("lock:drafts")
@@ -63,6 +63,10 @@ CELERYBEAT_SCHEDULE = {
         "task": "newparp.tasks.background.update_user_meta",
         "schedule": datetime.timedelta(seconds=10),
     },
+    "flush_drafts": {
+        "task": "newparp.tasks.background.flush_drafts",
+        "schedule": datetime.timedelta(seconds=60),
+    },
     "generate_searching_counter": {
         "task": "newparp.tasks.matchmaker.generate_searching_counter",
         "schedule": datetime.timedelta(seconds=10),
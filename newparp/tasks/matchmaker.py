@@ -1,24 +1,49 @@
 from celery import chord
 from celery.utils.log import get_task_logger
+from collections import OrderedDict
 from random import shuffle
-from sqlalchemy import and_, func, or_
 from uuid import uuid4
 
-from newparp.helpers.matchmaker import fetch_searcher, option_messages
-from newparp.model import Block, ChatUser, Message, SearchedChat, User
+from newparp.helpers.filters import FilterMatcher
+from newparp.helpers.matchmaker import (
+    fetch_searcher,
+    get_blocked_user_ids,
+    load_blocked_user_ids,
+    option_messages,
+)
+from newparp.model import ChatUser, Message, SearchedChat, User
 from newparp.model.connections import session_scope
 from newparp.tasks import celery, WorkerTask
 
 logger = get_task_logger(__name__)
 
 
+# Compiled search filters, keyed by searcher ID. A searcher's filters can't
+# change after it's been created, so these never need to be invalidated, and
+# the least recently used ones are dropped when there are too many.
+filter_matchers = OrderedDict()
+max_filter_matchers = 1000
+
+
+def get_filter_matcher(searcher):
+    try:
+        filter_matchers.move_to_end(searcher.id)
+        return filter_matchers[searcher.id]
+    except KeyError:
+        pass
+    filter_matcher = filter_matchers[searcher.id] = FilterMatcher(searcher.filters)
+    if len(filter_matchers) > max_filter_matchers:
+        filter_matchers.popitem(last=False)
+    return filter_matcher
+
+
 @celery.task(base=WorkerTask, queue="worker")
 def generate_searching_counter():
     redis = generate_searching_counter.redis
 
     pipe = redis.pipeline()
     for searcher_id in redis.smembers("searchers"):
-        pipe.get("searcher:%s:session_id" % searcher_id)
+        pipe.hget("searcher:%s" % searcher_id, "session_id")
 
     for session_id in set(pipe.execute()):
         if session_id:
@@ -108,20 +133,14 @@ def compare(searcher_id_1, searcher_id_2):
         return None, None
 
     # Check filters.
-    s1_name = s1.character["name"].lower().encode("utf8")
-    for search_filter in s2.filters:
-        search_filter = search_filter.encode("utf8")
-        logger.debug("comparing %s and %s" % (s1_name, search_filter))
-        if search_filter in s1_name:
-            logger.debug("FILTER %s MATCHED" % search_filter)
-            return None, None
-    s2_name = s2.character["name"].lower().encode("utf8")
-    for search_filter in s1.filters:
-        search_filter = search_filter.encode("utf8")
-        logger.debug("comparing %s and %s" % (s2_name, search_filter))
-        if search_filter in s2_name:
-            logger.debug("FILTER %s MATCHED" % search_filter)
-            return None, None
+    search_filter = get_filter_matcher(s2).search(s1.character["name"].lower())
+    if search_filter is not None:
+        logger.debug("FILTER %s MATCHED" % search_filter)
+        return None, None
+    search_filter = get_filter_matcher(s1).search(s2.character["name"].lower())
+    if search_filter is not None:
+        logger.debug("FILTER %s MATCHED" % search_filter)
+        return None, None
 
     if (
         # Match if either person has wildcard, or if they're otherwise compatible.
@@ -160,21 +179,25 @@ def comparison_callback(results, searcher_id_1):
         redis.delete("lock:matchmaker")
         return
 
-    with session_scope() as db:
-        # Pick a second searcher from the matches.
-        for searcher_id_2, options in matched_searchers:
-            s2 = fetch_searcher(redis, searcher_id_2)
-            if all(s2[:-3]) and db.query(func.count("*")).select_from(Block).filter(or_(
-                and_(Block.blocking_user_id == s1.user_id, Block.blocked_user_id == s2.user_id),
-                and_(Block.blocking_user_id == s2.user_id, Block.blocked_user_id == s1.user_id),
-            )).scalar() == 0:
-                logger.debug("matched %s" % searcher_id_2)
-                break
-        else:
-            logger.debug("all matches have expired")
-            redis.delete("lock:matchmaker")
-            return
+    # Blocks are cached when the searcher is created, so this should only need
+    # to hit the database if the cache has expired.
+    blocked_user_ids = get_blocked_user_ids(redis, s1.user_id)
+    if blocked_user_ids is None:
+        with session_scope() as db:
+            blocked_user_ids = load_blocked_user_ids(redis, db, s1.user_id)
+
+    # Pick a second searcher from the matches.
+    for searcher_id_2, options in matched_searchers:
+        s2 = fetch_searcher(redis, searcher_id_2)
+        if all(s2[:-3]) and int(s2.user_id) not in blocked_user_ids:
+            logger.debug("matched %s" % searcher_id_2)
+            break
+    else:
+        logger.debug("all matches have expired")
+        redis.delete("lock:matchmaker")
+        return
 
+    with session_scope() as db:
         new_url = str(uuid4()).replace("-", "")
         logger.info("matched %s and %s, sending to %s." % (s1.id, s2.id, new_url))
         new_chat = SearchedChat(url=new_url)
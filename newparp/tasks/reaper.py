@@ -41,7 +41,7 @@ def reap_chat(chat_id):
                 logger.debug("dead: %s" % chat_user)
                 # TODO optimise this when reaping several people at once?
                 if chat_user.computed_group == "silent" or chat.type in ("pm", "roulette"):
-                    send_userlist(user_list, db, chat)
+                    send_userlist(user_list, db, chat.type)
                 else:
                     send_message(db, reap_chat.redis, Message(
                         chat=chat,
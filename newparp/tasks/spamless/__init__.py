@@ -4,14 +4,17 @@ import json
 
 from random import randint
 from celery.utils.log import get_task_logger
-from sqlalchemy import and_
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import and_, or_
 
 from newparp.helpers.chat import send_message
+from newparp.helpers.filters import RegexSet, similarity_bands
 from newparp.model import AnyChat, ChatUser, Message, User, SpamlessFilter
 from newparp.model.connections import session_scope
+from newparp.model.user_list import ConnectionTokenStore
 from newparp.tasks import celery, WorkerTask
 
+# Replaced as a whole by reload_lists(), so take one reference to it and use
+# that throughout a check.
 lists = {"reload": "0"}
 logger = get_task_logger(__name__)
 
@@ -24,148 +27,280 @@ class Silence(Exception):
     pass
 
 
-class CheckSpamTask(WorkerTask):
-    queue = "spamless"
+connection_types = ("join", "disconnect", "timeout", "user_info")
+filtered_types = ("ic", "ooc", "me")
 
-    def load_lists(self):
-        if lists["reload"] == self.redis.get("spamless:reload"):
-            return
 
-        logger.info("reload")
-        lists["reload"] = self.redis.get("spamless:reload")
+def compile_lists(filters):
+    """Compiles a list of (type, regex, points) tuples into RegexSets."""
+    blacklist = [_ for _ in filters if _[0] == "blacklist"]
+    return {
+        "banned_names": RegexSet(
+            [regex for filter_type, regex, points in filters if filter_type == "banned_names"],
+            re.IGNORECASE | re.MULTILINE,
+        ),
+        "blacklist": RegexSet(
+            [regex for filter_type, regex, points in blacklist],
+            re.IGNORECASE | re.MULTILINE,
+            weights=[int(points or 0) for filter_type, regex, points in blacklist],
+        ),
+        "warnlist": RegexSet(
+            [regex for filter_type, regex, points in filters if filter_type == "warnlist"],
+            re.IGNORECASE | re.MULTILINE,
+        ),
+    }
 
-        with session_scope() as db:
-            filters = db.query(SpamlessFilter).all()
-
-            lists["banned_names"] = [
-                re.compile(_.regex, re.IGNORECASE | re.MULTILINE)
-                for _ in filters if _.type == "banned_names"
-            ]
-            lists["blacklist"] = [
-                (re.compile(_.regex, re.IGNORECASE | re.MULTILINE), _.points)
-                for _ in filters if _.type == "blacklist"
-            ]
-            lists["warnlist"] = [
-                re.compile(_.regex, re.IGNORECASE | re.MULTILINE)
-                for _ in filters if _.type == "warnlist"
-            ]
 
-    def run(self, chat_id, data):
-        if len(data["messages"]) == 0:
-            return
+def reload_lists(redis):
+    """
+    Compiles the filters from the database and swaps them all in at once, so
+    checks never see a mix of old and new lists.
+    """
+    global lists
+    logger.info("reload")
+    version = redis.get("spamless:reload")
 
-        self.load_lists()
+    with session_scope() as db:
+        filters = db.query(SpamlessFilter.type, SpamlessFilter.regex, SpamlessFilter.points).all()
 
-        for message in data["messages"]:
-            if message["user_number"] is None:
-                continue
+    new_lists = compile_lists(filters)
+    new_lists["reload"] = version
+    lists = new_lists
 
-            self.redis.set("spamless:last_id", message["id"])
 
+def lists_version():
+    """Returns the version of the filters which are loaded."""
+    return lists["reload"]
+
+
+class SpamChecker(object):
+    """
+    Checks batches of messages for spam, with one Redis round trip for the
+    counters and one database transaction for the flags per batch.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def load_lists(self):
+        """
+        Reloads the filters if the version in Redis has changed. The spamless
+        worker gets told about changes instead, so this is only needed by
+        CheckSpamTask.
+        """
+        if lists["reload"] != self.redis.get("spamless:reload"):
+            reload_lists(self.redis)
+
+    # Near-duplicate messages are counted together in buckets keyed by their
+    # similarity bands, and the busiest bucket counts as the similar attempts.
+    increment_attempts_script = """
+        local message_attempts = redis.call("incrby", ARGV[1], ARGV[3])
+        redis.call("expire", ARGV[1], 60)
+        local user_attempts = redis.call("incrby", ARGV[2], ARGV[3])
+        redis.call("expire", ARGV[2], 10)
+        local similar_attempts = 0
+        for i = 4, #ARGV do
+            similar_attempts = math.max(similar_attempts, redis.call("incrby", ARGV[i], ARGV[3]))
+            redis.call("expire", ARGV[i], 60)
+        end
+        return {message_attempts, user_attempts, similar_attempts}
+    """
+
+    def check_messages(self, messages):
+        """Checks a list of (chat_id, message) pairs and flags any spam."""
+        marks, silences = self.classify(messages)
+        if marks or silences:
+            self.flag(marks, silences)
+
+    def classify(self, messages):
+        """
+        Runs the checks on a list of (chat_id, message) pairs and updates the
+        counters, without flagging anything. Returns lists of
+        (chat_id, message, reason) for the messages to mark and silence.
+        """
+        messages = [_ for _ in messages if _[1]["user_number"] is not None]
+        if not messages:
+            return [], []
+        current_lists = lists
+
+        # Queue the counters for the whole batch. The blacklist counters are
+        # skipped for banned names, because those get silenced anyway.
+        pipe = self.redis.pipeline()
+        pipe.set("spamless:last_id", max(message["id"] for chat_id, message in messages))
+        banned_names = []
+        counters = []
+        for chat_id, message in messages:
             message["hash"] = hashlib.md5(
                 ":".join([message["color"], message["acronym"], message["text"]])
                 .encode("utf-8").lower()
             ).hexdigest()
-
+            banned_name = bool(message["name"]) and current_lists["banned_names"].search(message["name"].lower()) is not None
+            banned_names.append(banned_name)
+            if message["type"] in connection_types:
+                pipe.incr("spamless:join:%s:%s" % (chat_id, message["user_number"]))
+                pipe.expire("spamless:join:%s:%s" % (chat_id, message["user_number"]), 5)
+                counters.append("connection")
+            elif message["type"] in filtered_types and not banned_name:
+                pipe.eval(
+                    self.increment_attempts_script, 0,
+                    "spamless:message:%s" % message["hash"],
+                    "spamless:blacklist:%s:%s" % (chat_id, message["user_number"]),
+                    current_lists["blacklist"].score(message["text"]) + 1,
+                    *["spamless:similar:%s" % _ for _ in similarity_bands(message["text"])]
+                )
+                counters.append("filter")
+            else:
+                counters.append(None)
+
+        results = iter(pipe.execute()[1:])
+        marks = []
+        silences = []
+        for (chat_id, message), banned_name, counter in zip(messages, banned_names, counters):
+            attempts = None
+            if counter == "connection":
+                attempts, expired = next(results), next(results)
+            elif counter == "filter":
+                attempts = next(results)
             try:
-                self.check_connection_spam(chat_id, message)
-                self.check_banned_names(chat_id, message)
-                self.check_message_filter(chat_id, message)
-                self.check_warnlist(chat_id, message)
-
+                self.check_connection_spam(message, attempts)
+                if banned_name:
+                    raise Silence("name")
+                self.check_message_filter(message, attempts)
+                self.check_warnlist(current_lists, message)
             except Mark as e:
-                with session_scope() as db:
-                    q = db.query(Message).filter(Message.id == message["id"]).update({"spam_flag": str(e)})
-                    message.update({"spam_flag": str(e)})
-                    self.redis.publish("spamless:live", json.dumps(message))
-
+                marks.append((chat_id, message, str(e)))
             except Silence as e:
-                with session_scope() as db:
-                    # XXX maybe cache this?
-                    try:
-                        chat_user, user, chat = db.query(
-                            ChatUser, User, AnyChat,
-                        ).join(
-                            User, ChatUser.user_id == User.id,
-                        ).join(
-                            AnyChat, ChatUser.chat_id == AnyChat.id,
-                        ).filter(and_(
-                            ChatUser.chat_id == chat_id,
-                            ChatUser.number == message["user_number"],
-                        )).one()
-                    except NoResultFound:
-                        continue
-
-                    if chat.type != "group":
-                        flag_suffix = chat.type.upper()
-                    elif chat_user.computed_group in ("admin", "creator"):
-                        flag_suffix = chat_user.computed_group.upper()
-                    else:
-                        flag_suffix = "SILENCED"
-
-                    db.query(Message).filter(Message.id == message["id"]).update({
-                        "spam_flag": str(e) + " " + flag_suffix,
-                    })
-
-                    message.update({"spam_flag": str(e) + " " + flag_suffix})
-                    self.redis.publish("spamless:live", json.dumps(message))
-
-                    if flag_suffix == "SILENCED":
-                        db.query(ChatUser).filter(and_(
-                            ChatUser.chat_id == chat_id,
-                            ChatUser.number == message["user_number"]
-                        )).update({"group": "silent"})
-                        send_message(db, self.redis, Message(
-                            chat_id=chat_id,
-                            type="spamless",
-                            name="The Spamless",
-                            acronym="\u264b",
-                            text="Spam has been detected and silenced. Please come [url=http://help.msparp.com/]here[/url] or ask a chat moderator to unsilence you if this was an accident.",
-                            color="626262"
-                        ), force_userlist=True)
-
-    def check_connection_spam(self, chat_id, message):
-        if message["type"] not in ("join", "disconnect", "timeout", "user_info"):
+                silences.append((chat_id, message, str(e)))
+
+        return marks, silences
+
+    def flag(self, marks, silences):
+        silenced = {}
+        silenced_user_ids = set()
+        with session_scope() as db:
+            # Admins, creators and people in PMs and roulette don't actually
+            # get silenced, so note that in the flag instead.
+            flagged = list(marks)
+            senders = self.senders(db, silences)
+            for chat_id, message, reason in silences:
+                try:
+                    chat_type, user_group, user_id = senders[chat_id, message["user_number"]]
+                except KeyError:
+                    continue
+                if chat_type != "group":
+                    flag_suffix = chat_type.upper()
+                elif user_group in ("admin", "creator"):
+                    flag_suffix = user_group.upper()
+                else:
+                    flag_suffix = "SILENCED"
+                    silenced.setdefault(chat_id, set()).add(message["user_number"])
+                    silenced_user_ids.add((user_id, chat_id))
+                flagged.append((chat_id, message, reason + " " + flag_suffix))
+
+            flags = {}
+            for chat_id, message, flag in flagged:
+                flags.setdefault(flag, []).append(message["id"])
+                message.update({"spam_flag": flag})
+            for flag, message_ids in flags.items():
+                db.query(Message).filter(Message.id.in_(message_ids)).update(
+                    {"spam_flag": flag}, synchronize_session=False,
+                )
+
+            if silenced:
+                db.query(ChatUser).filter(or_(*[
+                    and_(ChatUser.chat_id == chat_id, ChatUser.number.in_(user_numbers))
+                    for chat_id, user_numbers in silenced.items()
+                ])).update({"group": "silent"}, synchronize_session=False)
+
+            for chat_id in silenced:
+                send_message(db, self.redis, Message(
+                    chat_id=chat_id,
+                    type="spamless",
+                    name="The Spamless",
+                    acronym="\u264b",
+                    text="Spam has been detected and silenced. Please come [url=http://help.msparp.com/]here[/url] or ask a chat moderator to unsilence you if this was an accident.",
+                    color="626262"
+                ))
+
+        pipe = self.redis.pipeline()
+        for chat_id, message, flag in flagged:
+            pipe.publish("spamless:live", json.dumps(message))
+        # Connection tokens remember the group, so silenced people need to
+        # go through the full checks when they reconnect.
+        token_store = ConnectionTokenStore(pipe)
+        for user_id, chat_id in silenced_user_ids:
+            token_store.invalidate_connection_token(user_id, chat_id)
+        # Tell each chat once, and only send the group changes rather than
+        # the whole user list.
+        for chat_id, user_numbers in silenced.items():
+            pipe.publish("channel:%s" % chat_id, json.dumps({
+                "messages": [],
+                "user_groups": {user_number: "silent" for user_number in user_numbers},
+            }))
+        pipe.execute()
+
+    def senders(self, db, silences):
+        """
+        Looks up the chat type, group and user ID of everyone being silenced
+        in one query. Returns a dict keyed by chat ID and user number. The
+        groups are looked up here rather than when the message is sent, so
+        they're current and sending messages doesn't need to load them.
+        """
+        if not silences:
+            return {}
+        keys = {(chat_id, message["user_number"]) for chat_id, message, reason in silences}
+        return {
+            (chat_user.chat_id, chat_user.number): (chat.type, chat_user.computed_group, user.id)
+            for chat_user, user, chat in db.query(
+                ChatUser, User, AnyChat,
+            ).join(
+                User, ChatUser.user_id == User.id,
+            ).join(
+                AnyChat, ChatUser.chat_id == AnyChat.id,
+            ).filter(or_(*[
+                and_(ChatUser.chat_id == chat_id, ChatUser.number == user_number)
+                for chat_id, user_number in keys
+            ]))
+        }
+
+    def check_connection_spam(self, message, attempts):
+        if message["type"] not in connection_types:
             return
-        attempts = self.redis.increx("spamless:join:%s:%s" % (chat_id, message["user_number"]), expire=5)
         if attempts <= 10:
             return
         raise Silence("connection")
 
-    def check_banned_names(self, chat_id, message):
-        if not message["name"]:
-            return
-        lower_name = message["name"].lower()
-        for name in lists["banned_names"]:
-            if name.search(lower_name):
-                raise Silence("name")
-
-    def check_message_filter(self, chat_id, message):
-
-        if message["type"] not in ("ic", "ooc", "me"):
+    def check_message_filter(self, message, attempts):
+        if message["type"] not in filtered_types:
             return
 
-        message_key = "spamless:message:%s" % message["hash"]
-        user_key = "spamless:blacklist:%s:%s" % (chat_id, message["user_number"])
-
-        for phrase, points in lists["blacklist"]:
-            total_points = len(phrase.findall(message["text"])) * int(points)
-            self.redis.increx(message_key, expire=60, incr=total_points)
-            self.redis.increx(user_key, expire=10, incr=total_points)
-
-        message_attempts = self.redis.increx(message_key, expire=60)
-        user_attempts = self.redis.increx(user_key, expire=10)
+        message_attempts, user_attempts, similar_attempts = attempts
 
         if message_attempts >= randint(10, 35) or user_attempts >= 15:
             raise Silence("x%s" % max(message_attempts, user_attempts))
         elif message_attempts >= 10 or user_attempts >= 10:
             raise Mark("x%s" % max(message_attempts, user_attempts))
+        # Similar messages are counted across the whole site, so they can
+        # include common text like rules and templates posted by unrelated
+        # people. They only get marked for a moderator to look at.
+        elif similar_attempts >= 10:
+            raise Mark("similar x%s" % similar_attempts)
 
-    def check_warnlist(self, chat_id, message):
+    def check_warnlist(self, current_lists, message):
         if message["type"] in ("join", "disconnect", "timeout"):
             return
-        lower_text = message["text"].lower()
-        for phrase in lists["warnlist"]:
-            if phrase.search(lower_text):
-                raise Mark("warnlist")
+        if current_lists["warnlist"].search(message["text"].lower()):
+            raise Mark("warnlist")
 
+
+class CheckSpamTask(WorkerTask):
+    """
+    Spam checks are done by the spamless worker now, but this is kept so
+    anything still in the Celery queue gets checked.
+    """
+    queue = "spamless"
+
+    def run(self, chat_id, data):
+        checker = SpamChecker(self.redis)
+        checker.load_lists()
+        checker.check_messages([(chat_id, _) for _ in data["messages"]])
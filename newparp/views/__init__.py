@@ -2,14 +2,14 @@ import os
 import json
 from flask import abort, g, jsonify, make_response, render_template, request, redirect, url_for
 from sqlalchemy import and_, func
-from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from newparp.helpers import alt_formats
 from newparp.helpers.auth import admin_required
+from newparp.helpers.search_characters import load_fandom_tree
 from newparp.model import (
     AgeGroup, case_options, level_options, allowed_level_options, Character,
-    GroupChat, Fandom, SearchCharacterGroup, SearchCharacter,
+    GroupChat, SearchCharacter,
     SearchCharacterChoice, User,
 )
 from newparp.model.connections import use_db, db_connect, NewparpRedis, redis_chat_pool
@@ -27,15 +27,6 @@ def home():
 
     characters = g.db.query(Character).filter(Character.user_id == g.user.id).order_by(Character.title).all()
 
-    fandoms = (
-        g.db.query(Fandom)
-        .order_by(Fandom.name)
-        .options(
-            joinedload(Fandom.groups)
-            .joinedload(SearchCharacterGroup.characters)
-        ).all()
-    )
-
     picky = set(_[0] for _ in g.db.query(
         SearchCharacterChoice.search_character_id,
     ).filter(
@@ -44,7 +35,7 @@ def home():
     return render_template(
         "home_search.html",
         characters=characters,
-        fandoms=fandoms,
+        fandom_tree=load_fandom_tree(),
         case_options=case_options,
         level_options=level_options,
         AgeGroup=AgeGroup,
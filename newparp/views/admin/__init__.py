@@ -3,8 +3,9 @@ import paginate
 import time
 
 from collections import OrderedDict, namedtuple
+from ipaddress import ip_network
 from flask import abort, g, jsonify, redirect, render_template, request, url_for
-from sqlalchemy import func, literal
+from sqlalchemy import func, literal, tuple_
 from sqlalchemy.exc import DataError
 from sqlalchemy.orm import joinedload, joinedload_all
 from sqlalchemy.orm.exc import NoResultFound
@@ -26,8 +27,8 @@ from newparp.model import (
     User,
     UserNote,
 )
-from newparp.model.connections import use_db, NewparpRedis, redis_chat_pool
-from newparp.model.user_list import UserListStore
+from newparp.model.connections import use_db
+from newparp.model.user_list import ConnectionTokenStore
 from newparp.model.validators import color_validator
 from newparp.tasks import celery
 
@@ -71,7 +72,17 @@ def announcements_post():
 @use_db
 @permission_required("broadcast")
 def broadcast_get():
-    return render_template("admin/broadcast.html")
+    # Show how the last broadcast was delivered, if we've just sent one.
+    delivery = None
+    if "broadcast_id" in request.args:
+        delivery = g.redis.hgetall("broadcast:%s" % request.args["broadcast_id"])
+        latencies = [float(value) for key, value in delivery.items() if key.startswith("latency:")]
+        delivery = {
+            "workers": int(delivery.get("workers", 0)),
+            "sockets": int(delivery.get("sockets", 0)),
+            "max_latency": max(latencies) if latencies else None,
+        }
+    return render_template("admin/broadcast.html", delivery=delivery)
 
 
 @use_db
@@ -103,7 +114,10 @@ def broadcast_post():
         description=text,
     ))
 
+    # This goes out on one global channel which every live worker listens to.
+    broadcast_id = str(uuid4())
     message_json = json.dumps({
+        "broadcast": {"id": broadcast_id, "sent": time.time()},
         "messages": [{
             "id": None,
             "user_number": None,
@@ -119,10 +133,9 @@ def broadcast_post():
         }]
     })
 
-    for chat_id in UserListStore.scan_active_chats(NewparpRedis(connection_pool=redis_chat_pool)):
-        g.redis.publish("channel:%s" % chat_id, message_json)
+    g.redis.publish("global", message_json)
 
-    return redirect(url_for("admin_broadcast"))
+    return redirect(url_for("admin_broadcast", broadcast_id=broadcast_id))
 
 
 def _filter_users(query):
@@ -137,8 +150,11 @@ def _filter_users(query):
         query = query.filter(func.lower(User.username).like("%" + request.args["username"].strip().lower() + "%"))
 
     if request.args.get("ip"):
-        # XXX VALIDATE THIS
-        query = query.filter(User.last_ip.op("<<=")(request.args["ip"]))
+        try:
+            ip_network(request.args["ip"].strip(), strict=False)
+        except ValueError:
+            abort(400)
+        query = query.filter(User.last_ip.op("<<=")(request.args["ip"].strip()))
 
     if request.args.get("email"):
         query = query.filter(func.lower(User.email_address).like("%" + request.args["email"].strip().lower() + "%"))
@@ -146,15 +162,26 @@ def _filter_users(query):
     return query
 
 
-user_order = namedtuple("user_order", ("name", "column"))
+def _estimate_count(query):
+    """
+    Returns the planner's estimate of how many rows a query will return,
+    which is much cheaper than counting them on a big table.
+    """
+    statement = query.statement.compile(dialect=g.db.bind.dialect)
+    plan = g.db.connection().execute("EXPLAIN (FORMAT JSON) " + str(statement), statement.params).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+user_order = namedtuple("user_order", ("name", "column", "descending"))
 user_orders = OrderedDict([
-    ("id", user_order("#", User.id)),
-    ("username", user_order("Username", func.lower(User.username))),
-    ("group", user_order("Group", User.group)),
-    ("created", user_order("Created", User.created.desc())),
-    ("last_online", user_order("Last online", User.last_online.desc())),
-    ("last_ip", user_order("Last IP", User.last_ip)),
-    ("timezone", user_order("Time zone", User.timezone)),
+    ("id", user_order("#", User.id, False)),
+    ("username", user_order("Username", func.lower(User.username), False)),
+    ("group", user_order("Group", User.group, False)),
+    ("created", user_order("Created", User.created, True)),
+    ("last_online", user_order("Last online", User.last_online, True)),
+    ("last_ip", user_order("Last IP", User.last_ip, False)),
+    # Coalesced so the after_id cursor can compare against it.
+    ("timezone", user_order("Time zone", func.coalesce(User.timezone, ""), False)),
 ])
 
 
@@ -163,52 +190,73 @@ user_orders = OrderedDict([
 @permission_required("user_list")
 def user_list(fmt=None):
 
+    after_id = None
     try:
-        page = int(request.args.get("page", 1))
-    except ValueError:
-        abort(404)
+        after_id = int(request.args["after_id"])
+    except (KeyError, ValueError):
+        pass
+
+    order = user_orders.get(request.args.get("order"), user_orders["id"])
 
     users = g.db.query(User).options(joinedload(User.admin_tier))
     users = _filter_users(users)
 
-    if request.args.get("order") in user_orders:
-        users = users.order_by(user_orders[request.args["order"]].column)
+    # Pages start after the last user of the previous page, in the current
+    # order. IDs break ties so every user has a unique position.
+    if order.column is User.id:
+        sort_key = User.id
+    else:
+        sort_key = tuple_(order.column, User.id)
+
+    if after_id:
+        if order.column is User.id:
+            after_key = after_id
+        else:
+            try:
+                after_value = g.db.query(order.column).filter(User.id == after_id).one()[0]
+            except NoResultFound:
+                abort(404)
+            after_key = tuple_(literal(after_value, order.column.type), literal(after_id))
+        users = users.filter(sort_key < after_key if order.descending else sort_key > after_key)
+
+    if order.column is User.id:
+        users = users.order_by(User.id.desc() if order.descending else User.id)
+    elif order.descending:
+        users = users.order_by(order.column.desc(), User.id.desc())
     else:
-        users = users.order_by(user_orders["id"].column)
+        users = users.order_by(order.column, User.id)
 
+    # The exact count has to look at every matching user, so it's only done
+    # on request.
+    count_exact = request.args.get("count") == "exact"
     try:
-        users = users.offset((page - 1) * 50).limit(50).all()
+        users = users.limit(50).all()
+        if count_exact:
+            user_count = _filter_users(g.db.query(func.count('*')).select_from(User)).scalar()
+        else:
+            user_count = _estimate_count(_filter_users(g.db.query(User.id)))
     except DataError:
         abort(400)
 
-    if len(users) == 0 and page != 1:
+    if len(users) == 0 and after_id:
         abort(404)
 
-    user_count = g.db.query(func.count('*')).select_from(User)
-    user_count = _filter_users(user_count)
-    user_count = user_count.scalar()
-
     if fmt == "json":
         return jsonify({
             "total": user_count,
+            "total_exact": count_exact,
             "users": [_.to_dict() for _ in users],
         })
 
-    paginator_args = {k: v for k, v in list(request.args.items()) if k != "page"}
-    paginator = paginate.Page(
-        [],
-        page=page,
-        items_per_page=50,
-        item_count=user_count,
-        url_maker=lambda page: url_for("admin_user_list", page=page, **paginator_args),
-    )
-
     return render_template(
         "admin/user_list.html",
         User=User,
         users=users,
-        paginator=paginator,
-        group_link_args={k: v for k, v in list(request.args.items()) if k not in ("page", "group")},
+        user_count=user_count,
+        count_exact=count_exact,
+        after_id=after_id,
+        page_link_args={k: v for k, v in list(request.args.items()) if k != "after_id"},
+        group_link_args={k: v for k, v in list(request.args.items()) if k not in ("after_id", "group")},
         user_orders=user_orders,
     )
 
@@ -297,6 +345,7 @@ def user_set_group(username):
 
         if user.group != "active":
             user.admin_tier_id = None
+            ConnectionTokenStore(g.redis).invalidate_all_tokens_for_user(user.id)
 
         g.db.add(AdminLogEntry(
             action_user=g.user,
@@ -9,13 +9,13 @@ from sqlalchemy.orm import joinedload
 from newparp.helpers import alt_formats
 from newparp.helpers.auth import permission_required
 from newparp.model import AdminLogEntry, Message, SpamlessFilter
-from newparp.model.connections import use_db
+from newparp.model.connections import after_commit, use_db
 
 
 @alt_formats({"json"})
 @use_db
 @permission_required("spamless")
-def home(fmt=None, page=1):
+def home(fmt=None):
 
     try:
         last_spamless_message_id = int(g.redis.get("spamless:last_id"))
@@ -35,10 +35,12 @@ def home(fmt=None, page=1):
     except (KeyError, ValueError):
         pass
 
+    # Ordered by ID so the before_id cursor and the messages_spam_flag index
+    # line up.
     messages = (
         g.db.query(Message)
         .filter(Message.spam_flag != None)
-        .order_by(Message.posted.desc())
+        .order_by(Message.id.desc())
         .options(
             joinedload(Message.chat),
             joinedload(Message.user),
@@ -49,7 +51,8 @@ def home(fmt=None, page=1):
         messages = messages.filter(Message.id < before_id)
     messages = messages.limit(200).all()
 
-    if len(messages) == 0 and page != 1:
+    # An empty page is only expected on the first one.
+    if len(messages) == 0 and before_id:
         abort(404)
 
     if fmt == "json":
@@ -118,7 +121,15 @@ def _list_post(spamlist, **kwargs):
 
     handle_command(request.form["command"], phrase, spamlist, score)
 
-    g.redis.set("spamless:reload", str(time.time()))
+    # Tell the spamless workers once the change has been committed.
+    redis = g.redis
+    version = str(time.time())
+    def notify_reload():
+        pipe = redis.pipeline()
+        pipe.set("spamless:reload", version)
+        pipe.publish("spamless:reload", version)
+        pipe.execute()
+    after_commit(g.db, notify_reload)
 
     return redirect(url_for("spamless_" + spamlist))
 
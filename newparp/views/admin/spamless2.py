@@ -1,8 +1,6 @@
-import paginate
 import re
 
-from flask import abort, g, jsonify, redirect, render_template, request, url_for
-from sqlalchemy import func
+from flask import abort, g, jsonify, redirect, render_template, request
 from sqlalchemy.orm import joinedload_all
 
 from newparp.helpers import alt_formats
@@ -14,7 +12,13 @@ from newparp.model.connections import use_db
 @alt_formats({"json"})
 @use_db
 @permission_required("spamless")
-def home(fmt=None, page=1):
+def home(fmt=None):
+
+    before_id = None
+    try:
+        before_id = int(request.args["before_id"])
+    except (KeyError, ValueError):
+        pass
 
     flags = (
         g.db.query(SpamFlag)
@@ -24,29 +28,28 @@ def home(fmt=None, page=1):
             joinedload_all(SpamFlag.message, Message.chat_user),
             joinedload_all(SpamFlag.message, Message.user),
         )
-        .offset((page - 1) * 50).limit(50).all()
     )
-    if not flags and page != 1:
+    if before_id:
+        flags = flags.filter(SpamFlag.id < before_id)
+    flags = flags.limit(50).all()
+
+    # An empty page is only expected on the first one.
+    if not flags and before_id:
         abort(404)
 
-    flag_count = g.db.query(func.count("*")).select_from(SpamFlag).scalar()
+    # There may be more if this page is full.
+    next_before_id = flags[-1].id if len(flags) == 50 else None
 
     if fmt == "json":
         return jsonify({
             "flags": [_.to_dict() for _ in flags],
+            "next_before_id": next_before_id,
         })
 
-    paginator = paginate.Page(
-        [],
-        page=page,
-        items_per_page=50,
-        item_count=flag_count,
-        url_maker=lambda page: url_for("spamless2_home", page=page, **request.args),
-    )
-
     return render_template(
         "admin/spamless2/home.html",
         flags=flags,
-        paginator=paginator,
+        before_id=before_id,
+        next_before_id=next_before_id,
     )
 
@@ -1,12 +1,12 @@
 import json
 
 from flask import g, jsonify, redirect, request, render_template, url_for
-from sqlalchemy.orm import joinedload
 
 from newparp.helpers import alt_formats
 from newparp.helpers.auth import activation_required
 from newparp.helpers.characters import character_query, save_character_from_form, validate_character_form
-from newparp.model import case_options, Character, CharacterTag, Fandom, SearchCharacter, SearchCharacterGroup
+from newparp.helpers.search_characters import load_fandom_tree
+from newparp.model import case_options, Character, CharacterTag, SearchCharacter
 from newparp.model.connections import use_db
 
 
@@ -32,17 +32,10 @@ def character_list(fmt=None):
 @activation_required
 def new_character_get():
 
-    fandoms = (
-        g.db.query(Fandom)
-        .order_by(Fandom.name)
-        .options(
-            joinedload(Fandom.groups)
-            .joinedload(SearchCharacterGroup.characters)
-        ).all()
-    )
+    fandom_tree = load_fandom_tree()
 
     character_defaults = {_.name: _.default.arg for _ in Character.__table__.columns if _.default}
-    character_defaults["search_character"] = fandoms[0].groups[0].characters[0]
+    character_defaults["search_character"] = fandom_tree.fandoms[0].groups[0].characters[0]
 
     return render_template(
         "characters/character.html",
@@ -50,7 +43,7 @@ def new_character_get():
         replacements=[],
         regexes=[],
         character_tags={},
-        fandoms=fandoms,
+        fandom_tree=fandom_tree,
         case_options=case_options,
     )
 
@@ -70,15 +63,6 @@ def character(character_id, fmt=None):
 
     character = character_query(character_id, join_tags=True)
 
-    fandoms = (
-        g.db.query(Fandom)
-        .order_by(Fandom.name)
-        .options(
-            joinedload(Fandom.groups)
-            .joinedload(SearchCharacterGroup.characters)
-        ).all()
-    )
-
     if fmt == "json":
         return jsonify(character.to_dict(include_default=True, include_options=True))
 
@@ -91,7 +75,7 @@ def character(character_id, fmt=None):
             tag_type: ", ".join(tag["alias"] for tag in tags)
             for tag_type, tags in character.tags_by_type().items()
         },
-        fandoms=fandoms,
+        fandom_tree=load_fandom_tree(),
         case_options=case_options,
     )
 
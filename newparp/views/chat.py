@@ -18,8 +18,12 @@ from newparp.helpers.chat import (
     BadAgeException,
     TooManyPeopleException,
     authorize_joining,
+    chat_user_options,
+    invalidate_chat_access,
+    join_details,
     send_message,
 )
+from newparp.helpers.search_characters import load_fandom_tree
 from newparp.model import (
     AgeGroup,
     case_options,
@@ -29,16 +33,14 @@ from newparp.model import (
     Character,
     Chat,
     ChatUser,
-    Fandom,
     GroupChat,
     Invite,
     Message,
     PMChat,
-    SearchCharacterGroup,
     User,
 )
 from newparp.model.connections import use_db, NewparpRedis, redis_chat_pool
-from newparp.model.user_list import UserListStore
+from newparp.model.user_list import ConnectionTokenStore, UserListStore
 from newparp.model.validators import url_validator
 
 
@@ -125,7 +127,7 @@ def get_chat(f):
         g.chat_id = chat.id
         g.user_list = UserListStore(NewparpRedis(connection_pool=redis_chat_pool), chat.id)
         try:
-            authorize_joining(g.db, g)
+            authorize_joining(g.db, g.redis, g)
         except BannedException:
             if request.endpoint != "rp_chat" or chat.url == "theoubliette":
                 abort(403)
@@ -252,7 +254,7 @@ def chat(chat, pm_user, url, fmt=None):
 
         return jsonify({
             "chat": chat_dict,
-            "chat_user": chat_user.to_dict(include_options=True),
+            "chat_user": chat_user_options(g.user_list, chat_user),
             "messages": [
                 _.to_dict() for _ in messages
             ],
@@ -262,14 +264,16 @@ def chat(chat, pm_user, url, fmt=None):
     # Character and search character info for settings form.
     characters = g.db.query(Character).filter(Character.user_id == g.user.id).order_by(Character.title).all()
     character_shortcuts = {_.shortcut: _.id for _ in characters if _.shortcut is not None}
-    fandoms = (
-        g.db.query(Fandom)
-        .order_by(Fandom.name)
-        .options(
-            joinedload(Fandom.groups)
-            .joinedload(SearchCharacterGroup.characters)
-        ).all()
-    )
+
+    # They've just been through authorize_joining, so let the live server skip
+    # checking them again and join them without loading them from the
+    # database.
+    connection_token = None
+    if g.user.group == "active":
+        connection_token = ConnectionTokenStore(g.redis).create_connection_token(
+            g.session_id, chat_user.number, getattr(chat, "publicity", None),
+            join_details(chat_user, g.user, chat),
+        )
 
     return render_template(
         "chat/chat.html",
@@ -278,7 +282,7 @@ def chat(chat, pm_user, url, fmt=None):
         pm_user=pm_user,
         chat_dict=chat_dict,
         chat_user=chat_user,
-        chat_user_dict=chat_user.to_dict(include_options=True),
+        chat_user_dict=chat_user_options(g.user_list, chat_user),
         messages=messages,
         latest_message_id=latest_message_id,
         latest_time=latest_time,
@@ -286,7 +290,8 @@ def chat(chat, pm_user, url, fmt=None):
         level_options=level_options,
         characters=characters,
         character_shortcuts=character_shortcuts,
-        fandoms=fandoms,
+        connection_token=connection_token,
+        fandom_tree=load_fandom_tree(),
         themes=themes,
         MAX_LENGTH=Message.MAX_LENGTH,
     )
@@ -639,6 +644,7 @@ def invite(chat, pm_user, url, fmt):
         Invite.chat_id == chat.id, Invite.user_id == invite_user.id,
     )).scalar() == 0:
         g.db.add(Invite(chat_id=chat.id, user_id=invite_user.id, creator_id=g.user.id))
+        invalidate_chat_access(g.db, g.redis, chat.id)
         # Subscribe them to the chat and make it unread so they get a notification about it.
         try:
             invite_chat_user = g.db.query(ChatUser).filter(and_(
@@ -709,6 +715,8 @@ def uninvite(chat, pm_user, url, fmt):
         g.db.query(Invite).filter(and_(
            Invite.chat_id == chat.id, Invite.user_id == invite_user.id,
         )).delete()
+        invalidate_chat_access(g.db, g.redis, chat.id)
+        ConnectionTokenStore(g.redis).invalidate_connection_token(invite_user.id, chat.id)
         # Unsubscribing is impossible if they don't have access to the chat, so
         # we need to force-unsubscribe them here.
         try:
@@ -773,6 +781,7 @@ def unban(chat, pm_user, url, fmt):
         abort(404)
 
     g.db.delete(ban)
+    invalidate_chat_access(g.db, g.redis, chat.id)
 
     send_message(g.db, g.redis, Message(
         chat_id=chat.id,
@@ -8,13 +8,18 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from newparp.helpers.characters import validate_character_form
 from newparp.helpers.chat import (
+    chat_user_options,
     group_chat_only,
     require_socket,
     send_message,
     send_temporary_message,
     send_userlist,
     send_quit_message,
+    invalidate_chat_access,
+    invalidate_chat_tokens,
+    invalidate_user_tokens,
 )
+from newparp.helpers.matchmaker import invalidate_blocked_user_ids
 from newparp.model import (
     case_options,
     level_options,
@@ -28,12 +33,16 @@ from newparp.model import (
     User,
 )
 from newparp.model.connections import (
+    after_commit,
     get_chat_user,
     use_db_chat,
     db_connect,
     db_commit,
     db_disconnect,
+    NewparpRedis,
+    redis_chat_pool,
 )
+from newparp.model.user_list import ConnectionTokenStore, DraftStore, UserListStore
 from newparp.model.validators import color_validator
 
 
@@ -74,6 +83,7 @@ def send():
         }))
 
     g.chat_user.draft = ""
+    DraftStore(g.user_list.redis).save(g.chat.id, g.user.id, "")
 
     send_message(g.db, g.redis, Message(
         chat_id=g.chat.id,
@@ -88,10 +98,20 @@ def send():
     return "", 204
 
 
-@use_db_chat
-@require_socket
 def draft():
-    g.chat_user.draft = request.form.get("text", "").strip()[:Message.MAX_LENGTH]
+    # Drafts are saved every few seconds, so this only checks the socket
+    # rather than loading the chat user. Having a socket open means they've
+    # already been allowed in.
+    if g.user_id is None:
+        abort(403)
+    try:
+        chat_id = int(request.form["chat_id"])
+    except (KeyError, ValueError):
+        abort(400)
+    redis_chat = NewparpRedis(connection_pool=redis_chat_pool)
+    if not UserListStore(redis_chat, chat_id).session_has_open_socket(g.session_id, g.user_id):
+        abort(403)
+    DraftStore(redis_chat).save(chat_id, g.user_id, request.form.get("text", "").strip()[:Message.MAX_LENGTH])
     return "", 204
 
 
@@ -125,6 +145,10 @@ def block():
             chat_id=g.chat.id,
             reason=reason if reason else None,
         ))
+        # Only once it's committed, or the old blocks could be cached again.
+        redis = g.redis
+        user_ids = (g.user.id, blocked_chat_user.user_id)
+        after_commit(g.db, lambda: invalidate_blocked_user_ids(redis, *user_ids))
 
     return "", 204
 
@@ -194,6 +218,7 @@ def set_group():
         message = ("%s [%s] silenced %s [%s].")
 
     set_chat_user.group = set_group
+    invalidate_user_tokens(g.db, g.redis, set_chat_user.user_id, g.chat.id)
 
     send_message(g.db, g.redis, Message(
         chat_id=g.chat.id,
@@ -275,6 +300,7 @@ def user_action():
             # Don't send a message if there wasn't an invite.
             if not deleted:
                 return "", 204
+            invalidate_chat_access(g.db, g.redis, g.chat.id)
             ban_message = (
                 "%s [%s] un-invited %s [%s] from the chat."
             ) % (
@@ -297,6 +323,7 @@ def user_action():
                 creator_id=g.user.id,
                 reason=reason,
             ))
+            invalidate_chat_access(g.db, g.redis, g.chat.id)
             if request.form.get("reason") is not None:
                 ban_message = (
                     "%s [%s] banned %s [%s] from the chat. Reason: %s"
@@ -317,6 +344,7 @@ def user_action():
             "{\"exit\":\"ban\"}",
         )
 
+        ConnectionTokenStore(g.redis).invalidate_connection_token(set_user.id, g.chat.id)
         g.user_list.user_disconnect(set_user.id, set_chat_user.number)
 
         send_message(g.db, g.redis, Message(
@@ -401,6 +429,10 @@ def set_flag():
     else:
         abort(400)
 
+    # Connection tokens were checked against the old settings.
+    if flag in ("level", "publicity"):
+        invalidate_chat_tokens(g.db, g.redis, g.chat.id)
+
     send_message(g.db, g.redis, Message(
         chat_id=g.chat.id,
         user_id=g.user.id,
@@ -502,8 +534,9 @@ def save():
 
     # Send a message if name or acronym has changed.
     if g.chat_user.name != old_name or g.chat_user.acronym != old_acronym:
+        invalidate_user_tokens(g.db, g.redis, g.user.id, g.chat.id)
         if g.chat_user.computed_group == "silent":
-            send_userlist(g.user_list, g.db, g.chat)
+            send_userlist(g.user_list, g.db, g.chat.type)
         else:
             send_message(g.db, g.redis, Message(
                 chat_id=g.chat.id,
@@ -517,9 +550,9 @@ def save():
             ), g.user_list)
     # Just refresh the user list if the color has changed.
     elif g.chat_user.color != old_color:
-        send_userlist(g.user_list, g.db, g.chat)
+        send_userlist(g.user_list, g.db, g.chat.type)
 
-    return jsonify(g.chat_user.to_dict(include_options=True))
+    return jsonify(chat_user_options(g.user_list, g.chat_user))
 
 
 @use_db_chat
@@ -555,8 +588,9 @@ def save_from_character():
     g.chat_user.regexes = character.regexes
 
     if changed:
+        invalidate_user_tokens(g.db, g.redis, g.user.id, g.chat.id)
         if g.chat_user.computed_group == "silent":
-            send_userlist(g.user_list, g.db, g.chat)
+            send_userlist(g.user_list, g.db, g.chat.type)
         else:
             send_message(g.db, g.redis, Message(
                 chat_id=g.chat.id,
@@ -569,7 +603,7 @@ def save_from_character():
                 ),
             ), g.user_list)
 
-    return jsonify(g.chat_user.to_dict(include_options=True))
+    return jsonify(chat_user_options(g.user_list, g.chat_user))
 
 
 @use_db_chat
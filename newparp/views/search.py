@@ -11,6 +11,7 @@ from uuid import uuid4
 from newparp.helpers import tags_to_set
 from newparp.helpers.auth import activation_required
 from newparp.helpers.characters import validate_character_form
+from newparp.helpers.matchmaker import load_blocked_user_ids, store_searcher
 from newparp.model import AgeGroup, case_options, level_options, SearchCharacter, SearchCharacterChoice, User
 from newparp.model.connections import use_db, db_commit, db_disconnect
 from newparp.model.validators import color_validator
@@ -73,51 +74,41 @@ def search_save():
 
 
 def _create_searcher():
-    pipe = g.redis.pipeline()
-
     searcher_id = str(uuid4())
-    pipe.set("searcher:%s:session_id" % searcher_id, g.session_id)
-    pipe.expire("searcher:%s:session_id" % searcher_id, 30)
-
-    pipe.set("searcher:%s:search_character_id" % searcher_id, g.user.search_character_id)
-    pipe.expire("searcher:%s:search_character_id" % searcher_id, 30)
-
-    pipe.hmset("searcher:%s:character" % searcher_id, {
-        "name": g.user.name,
-        "acronym": g.user.acronym,
-        "color": g.user.color,
-        "quirk_prefix": g.user.quirk_prefix,
-        "quirk_suffix": g.user.quirk_suffix,
-        "case": g.user.case,
-        "replacements": g.user.replacements,
-        "regexes": g.user.regexes,
-    })
-    pipe.expire("searcher:%s:character" % searcher_id, 30)
-
-    pipe.set("searcher:%s:style" % searcher_id, g.user.search_style)
-    pipe.expire("searcher:%s:style" % searcher_id, 30)
-
-    pipe.sadd("searcher:%s:levels" % searcher_id, *g.user.search_levels)
-    pipe.expire("searcher:%s:levels" % searcher_id, 30)
-
-    if g.user.age_group != AgeGroup.unknown and g.user.search_age_restriction:
-        pipe.set("searcher:%s:age_group" % searcher_id, g.user.age_group.value)
-        pipe.expire("searcher:%s:age_group" % searcher_id, 30)
-
-    if g.user.search_filters:
-        pipe.rpush("searcher:%s:filters" % searcher_id, *g.user.search_filters) # XXX why is this a list and not a set?
-    pipe.expire("searcher:%s:filters" % searcher_id, 30)
 
     choices = [_[0] for _ in g.db.query(
         SearchCharacterChoice.search_character_id,
     ).filter(
         SearchCharacterChoice.user_id == g.user.id,
     ).all()]
-    if choices:
-        pipe.sadd("searcher:%s:choices" % searcher_id, *choices)
-    pipe.expire("searcher:%s:choices" % searcher_id, 30)
 
-    pipe.execute()
+    store_searcher(
+        g.redis, searcher_id,
+        session_id=g.session_id,
+        search_character_id=g.user.search_character_id,
+        character={
+            "name": g.user.name,
+            "acronym": g.user.acronym,
+            "color": g.user.color,
+            "quirk_prefix": g.user.quirk_prefix,
+            "quirk_suffix": g.user.quirk_suffix,
+            "case": g.user.case,
+            "replacements": g.user.replacements,
+            "regexes": g.user.regexes,
+        },
+        style=g.user.search_style,
+        levels=g.user.search_levels,
+        age_group=(
+            g.user.age_group
+            if g.user.age_group != AgeGroup.unknown and g.user.search_age_restriction
+            else None
+        ),
+        filters=g.user.search_filters,
+        choices=choices,
+    )
+
+    # Cache blocks now so the matchmaker doesn't have to query them.
+    load_blocked_user_ids(g.redis, g.db, g.user.id)
 
     return searcher_id
 
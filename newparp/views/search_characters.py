@@ -2,11 +2,11 @@ import json
 
 from flask import abort, g, make_response, redirect, render_template, request, url_for
 from sqlalchemy import func
-from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from newparp.helpers.auth import permission_required
 from newparp.helpers.characters import validate_character_form
+from newparp.helpers.search_characters import invalidate_fandom_tree, load_fandom_tree
 from newparp.model import case_options, Character, Fandom, SearchCharacterGroup, SearchCharacter, SearchCharacterChoice, User
 from newparp.model.connections import use_db, db_connect
 
@@ -23,14 +23,7 @@ def search_character_query(id):
 def search_character_list():
     return render_template(
         "search_characters/search_character_list.html",
-        fandoms=(
-            g.db.query(Fandom)
-            .order_by(Fandom.name)
-            .options(
-                joinedload(Fandom.groups)
-                .joinedload(SearchCharacterGroup.characters)
-            ).all()
-        )
+        fandom_tree=load_fandom_tree(),
     )
 
 
@@ -41,6 +34,7 @@ def new_fandom_post():
     if len(name) == 0:
         abort(400)
     g.db.add(Fandom(name=name))
+    invalidate_fandom_tree()
     return redirect(url_for("rp_search_character_list"))
 
 
@@ -62,6 +56,7 @@ def new_search_character_group_post():
         .scalar() or 0
     ) + 1
     g.db.add(SearchCharacterGroup(fandom_id=fandom.id, name=name, order=order))
+    invalidate_fandom_tree()
 
     return redirect(url_for("rp_search_character_list"))
 
@@ -69,8 +64,6 @@ def new_search_character_group_post():
 @use_db
 @permission_required("search_characters")
 def new_search_character_get():
-    fandoms = g.db.query(Fandom).order_by(Fandom.name).options(joinedload(Fandom.groups)).all()
-
     character_defaults = {_.name: _.default.arg for _ in SearchCharacter.__table__.columns if _.default}
 
     return render_template(
@@ -78,7 +71,7 @@ def new_search_character_get():
         character=character_defaults,
         replacements=[],
         regexes=[],
-        fandoms=fandoms,
+        fandom_tree=load_fandom_tree(),
         case_options=case_options,
     )
 
@@ -107,6 +100,7 @@ def new_search_character_post():
         **new_details
     )
     g.db.add(new_search_character)
+    invalidate_fandom_tree()
     return redirect(url_for("rp_search_character_list"))
 
 
@@ -139,6 +133,20 @@ def search_character_json(id):
     return resp
 
 
+def search_characters_bundle(bundle_hash):
+    fandom_tree = load_fandom_tree()
+
+    # Old URLs are sent to the current bundle rather than cached.
+    if bundle_hash != fandom_tree.bundle_hash:
+        return redirect(url_for("rp_search_characters_bundle", bundle_hash=fandom_tree.bundle_hash))
+
+    resp = make_response(fandom_tree.bundle)
+    resp.headers["Content-type"] = "application/json"
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    resp.set_etag(fandom_tree.bundle_hash)
+    return resp.make_conditional(request)
+
+
 @use_db
 @permission_required("search_characters")
 def save_search_character(id):
@@ -158,6 +166,7 @@ def save_search_character(id):
     character.text_preview = request.form["text_preview"]
     # Remember to clear the cache
     g.redis.delete("search_character:%s" % id)
+    invalidate_fandom_tree()
     return redirect(url_for("rp_search_character_list"))
 
 
@@ -192,5 +201,6 @@ def delete_search_character_post(id):
     # Don't use g.db.delete(character) because it does a load of extra queries
     # for foreign keys and stuff.
     g.db.query(SearchCharacter).filter(SearchCharacter.id == id).delete()
+    invalidate_fandom_tree()
     return redirect(url_for("rp_search_character_list"))
 
@@ -8,8 +8,9 @@ from sqlalchemy.orm.exc import NoResultFound
 from newparp.helpers import alt_formats, themes
 from newparp.helpers.auth import log_in_required
 from newparp.helpers.email import send_email
+from newparp.helpers.matchmaker import invalidate_blocked_user_ids
 from newparp.model import AgeGroup, Block, EmailBan, User
-from newparp.model.connections import use_db
+from newparp.model.connections import after_commit, use_db
 from newparp.model.validators import email_validator
 
 
@@ -250,10 +251,17 @@ def blocks(fmt=None):
 @use_db
 @log_in_required
 def unblock():
-    g.db.query(Block).filter(and_(
+    blocks = g.db.query(Block).filter(and_(
         Block.blocking_user_id == g.user.id,
         # created date because the client mustn't know the blocked_user_id
         Block.created == request.form["created"],
-    )).delete()
+    ))
+    blocked_user_ids = [_.blocked_user_id for _ in blocks]
+    if blocked_user_ids:
+        blocks.delete()
+        # Only once it's committed, or the old blocks could be cached again.
+        redis = g.redis
+        user_ids = [g.user.id] + blocked_user_ids
+        after_commit(g.db, lambda: invalidate_blocked_user_ids(redis, *user_ids))
     return redirect(url_for("settings_blocks"))
 
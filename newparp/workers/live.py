@@ -2,21 +2,27 @@
 
 
 import asyncio
+import collections
+import hmac
 import json
 import os
 import re
 import signal
+import subprocess
 import sys
 import time
 
 import asyncio_redis
+import tornado
 
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from socket import fromfd, gethostname, SOCK_STREAM
 from sqlalchemy import and_
 from sqlalchemy.orm.exc import NoResultFound
 from tornado.gen import coroutine
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.platform.asyncio import AsyncIOMainLoop
 from tornado.web import Application, RequestHandler
 from tornado.websocket import WebSocketHandler, WebSocketClosedError
@@ -28,26 +34,80 @@ from newparp.helpers.chat import (
     BadAgeException,
     TooManyPeopleException,
     KickedException,
+    JoinDetails,
     authorize_joining,
+    authorize_reconnecting,
     get_userlist,
+    join_details,
     kick_check,
     send_join_message,
     send_userlist,
     send_quit_message,
 )
-from newparp.helpers.matchmaker import validate_searcher_exists, refresh_searcher
+from newparp.helpers.matchmaker import delete_searcher, validate_searcher_exists, refresh_searcher
 from newparp.helpers.users import queue_user_meta
 from newparp.model import sm, AnyChat, ChatUser, User, SearchCharacter
 from newparp.model.connections import redis_pool, redis_chat_pool, NewparpRedis
-from newparp.model.user_list import UserListStore, PingTimeoutException
+from newparp.model.user_list import ConnectionTokenStore, InvalidToken, UserListStore, PingTimeoutException
 from newparp.tasks.matchmaker import new_searcher
+from newparp.workers.live_metrics import Histogram, Rate, TimedThreadPoolExecutor
 
 
 redis      = NewparpRedis(connection_pool=redis_pool)
 redis_chat = NewparpRedis(connection_pool=redis_chat_pool)
 
 
-thread_pool = ThreadPoolExecutor()
+thread_pool = TimedThreadPoolExecutor()
+
+# Closing sockets gets its own smaller pool, so a wave of disconnects can't
+# hold up new connections or take every database connection.
+close_pool = TimedThreadPoolExecutor(max_workers=int(os.environ.get("CLOSE_POOL_SIZE", 4)))
+closing = set()
+
+
+# Served by MetricsHandler.
+metrics = {
+    "loop_lag": Histogram(),
+    "pubsub_in": Rate(),
+    "pubsub_out": Rate(),
+    "publish_to_write": Histogram(),
+    "prepare": Histogram(),
+    "open": Histogram(),
+    "on_close": Histogram(),
+    "coalesced": Rate(),
+    "resyncs": Rate(),
+    "message_bytes_out": Rate(),
+    "wire_bytes_out": Rate(),
+    "write_time": Histogram(),
+}
+
+# Matches the published time along with one of its separators, so it can be
+# cut out before messages go to clients.
+published_regex = re.compile(r', "published": ([0-9.]+)|"published": ([0-9.]+)(, )?')
+
+# /metrics is only served to requests with this token.
+metrics_token = os.environ.get("LIVE_METRICS_TOKEN")
+
+
+# permessage-deflate for chat sockets whose browsers support it. Each socket
+# keeps its compression window between messages, so the keys and user lists
+# which every message repeats compress against the earlier frames. That costs
+# memory per socket, which mem_level limits.
+compression_options = None
+if os.environ.get("LIVE_COMPRESSION"):
+    compression_options = {
+        "compression_level": int(os.environ.get("LIVE_COMPRESSION_LEVEL", 6)),
+        "mem_level": int(os.environ.get("LIVE_COMPRESSION_MEM_LEVEL", 5)),
+    }
+# Frames smaller than this are sent uncompressed.
+compression_min_size = int(os.environ.get("LIVE_COMPRESSION_MIN_SIZE", 64))
+
+# Skipping compression and counting bytes uses private attributes of
+# Tornado's WebSocketProtocol13, so it's only done on Tornado versions which
+# tests/live/test_tornado_internals.py has passed on. Other versions compress
+# every frame and don't count bytes.
+tornado_internals = ("_compressor", "_message_bytes_out", "_wire_bytes_out")
+use_tornado_internals = tornado.version_info[:2] in {(4, 5)}
 
 
 origin_regex = re.compile("^https?:\/\/%s$" % os.environ["BASE_DOMAIN"].replace(".", "\."))
@@ -59,6 +119,13 @@ DEBUG = "DEBUG" in os.environ or "--debug" in sys.argv
 
 
 class ChatHandler(WebSocketHandler):
+    # Messages wait in the outbound queue while the client is still receiving
+    # earlier ones. If clients fall further behind than this, the queue is
+    # replaced with a resync containing the cached backlog and the latest
+    # user list.
+    max_queue_length = 100
+    max_buffered_bytes = 1024 * 1024
+
     @property
     def db(self):
         if hasattr(self, "_db") and self._db is not None:
@@ -71,8 +138,8 @@ class ChatHandler(WebSocketHandler):
     def loop(self):
         return asyncio.get_event_loop()
 
-    def get_chat_user(self):
-        return self.db.query(
+    def get_chat_user(self, db=None):
+        return (db or self.db).query(
             ChatUser, User, AnyChat,
         ).join(
             User, ChatUser.user_id == User.id,
@@ -93,11 +160,169 @@ class ChatHandler(WebSocketHandler):
                 "typing": self.user_list.user_numbers_typing(),
             }))
 
-    def write_message(self, *args, **kwargs):
+    def get_compression_options(self):
+        return compression_options
+
+    def write_message(self, message, binary=False):
+        connection = self.ws_connection
+        internals = use_tornado_internals and all(hasattr(connection, _) for _ in tornado_internals)
+        if internals:
+            wire_bytes = connection._wire_bytes_out
+            message_bytes = connection._message_bytes_out
+
+        # Tornado compresses every frame once compression has been
+        # negotiated, so hide the compressor from small ones. Uncompressed
+        # frames are allowed alongside compressed ones.
+        compressor = connection._compressor if internals else None
+        skip_compression = compressor is not None and len(message) < compression_min_size
+        if skip_compression:
+            connection._compressor = None
+
+        started = time.perf_counter()
         try:
-            super().write_message(*args, **kwargs)
+            future = super().write_message(message, binary)
         except WebSocketClosedError:
             return
+        finally:
+            if skip_compression:
+                connection._compressor = compressor
+
+        metrics["write_time"].observe(time.perf_counter() - started)
+        metrics["pubsub_out"].add()
+        if internals:
+            metrics["message_bytes_out"].add(connection._message_bytes_out - message_bytes)
+            metrics["wire_bytes_out"].add(connection._wire_bytes_out - wire_bytes)
+        return future
+
+    @property
+    def buffered_bytes(self):
+        return self.outbound_bytes + self.writing_bytes
+
+    def send(self, message):
+        """
+        Sends a message once the client has received the ones before it.
+        While the client is behind, updates which only matter in their latest
+        version are merged with queued ones.
+        """
+        if not self.ws_connection:
+            return
+
+        if not self.outbound and not self.writing_bytes:
+            self.write_next(message)
+            return
+
+        data = json.loads(message)
+        self.coalesce(data)
+        self.outbound.append((self.queued_kind(data), self.first_message_id(data), message))
+        self.outbound_bytes += len(message)
+
+        if len(self.outbound) > self.max_queue_length or self.buffered_bytes > self.max_buffered_bytes:
+            self.resync()
+
+    @staticmethod
+    def queued_kind(data):
+        """
+        Outbound queue entries are (kind, first message ID, message) tuples,
+        so coalescing doesn't need to parse the queued messages again. kind
+        is "typing" or "users" for messages which only contain a typing or
+        user list update, and None for anything else.
+        """
+        keys = set(data) - {"published"}
+        if keys == {"typing"}:
+            return "typing"
+        if "users" in data and not data.get("messages") and keys <= {"messages", "users"}:
+            return "users"
+        return None
+
+    @staticmethod
+    def first_message_id(data):
+        message_ids = [_["id"] for _ in data.get("messages", ()) if _.get("id")]
+        return min(message_ids) if message_ids else None
+
+    def coalesce(self, data):
+        """
+        Drops queued typing and user list updates which the new message
+        replaces.
+        """
+        replaced = {_ for _ in ("typing", "users") if _ in data}
+        if not replaced:
+            return
+
+        kept = collections.deque()
+        for kind, message_id, queued in self.outbound:
+            if kind in replaced:
+                self.outbound_bytes -= len(queued)
+                metrics["coalesced"].add()
+                continue
+            kept.append((kind, message_id, queued))
+        self.outbound = kept
+
+    def write_next(self, message):
+        # The published time is only for our metrics, so clients don't get it.
+        published = published_regex.search(message)
+        if published:
+            message = message[:published.start()] + message[published.end():]
+
+        self.writing_bytes = len(message)
+        future = self.write_message(message)
+        if future is None:
+            self.writing_bytes = 0
+            return
+        future.add_done_callback(self.on_written)
+
+        if published:
+            published_time = float(published.group(1) or published.group(2))
+            metrics["publish_to_write"].observe(max(time.time() - published_time, 0))
+
+    def on_written(self, future):
+        self.writing_bytes = 0
+        if future.exception() is not None:
+            self.outbound.clear()
+            self.outbound_bytes = 0
+            return
+        if self.outbound:
+            kind, message_id, message = self.outbound.popleft()
+            self.outbound_bytes -= len(message)
+            self.write_next(message)
+
+    def resync(self):
+        """
+        Replaces everything queued for a client which has fallen too far
+        behind with a single resync message. This has the cached messages
+        from the first one it missed onwards, and the latest user list and
+        chat details from the dropped messages. If the cache doesn't go back
+        far enough, "missed" is set so the client can say so.
+        """
+        if DEBUG:
+            print("socket too far behind: %s %s bytes" % (self.id, self.buffered_bytes))
+        metrics["resyncs"].add()
+
+        dropped = self.outbound
+        self.outbound = collections.deque()
+        self.outbound_bytes = 0
+
+        resync = {"resync": True, "messages": [], "missed": False}
+
+        message_ids = [message_id for kind, message_id, message in dropped if message_id is not None]
+        if message_ids:
+            first_id = min(message_ids)
+            cached = redis_chat.zrangebyscore("chat:%s" % self.chat_id, "-inf", "+inf", withscores=True)
+            resync["messages"] = [json.loads(message) for message, score in cached if score >= first_id]
+            resync["missed"] = not cached or cached[0][1] > first_id
+
+        for kind, message_id, message in reversed(dropped):
+            if kind == "typing":
+                continue
+            data = json.loads(message)
+            for key in ("users", "chat"):
+                if key in data and key not in resync:
+                    resync[key] = data[key]
+            if "users" in resync and "chat" in resync:
+                break
+
+        message = json.dumps(resync)
+        self.outbound.append(("resync", None, message))
+        self.outbound_bytes += len(message)
 
     def check_origin(self, origin):
         if "localhost" in os.environ["BASE_DOMAIN"].lower():
@@ -105,15 +330,62 @@ class ChatHandler(WebSocketHandler):
 
         return origin_regex.match(origin) is not None
 
+    def use_token(self):
+        """
+        Checks for a connection token from the chat page or an earlier
+        connection. Returns True if there's a valid one and it passes the
+        checks which don't need the database, in which case the token has
+        everything needed for joining.
+        """
+        token = self.get_query_argument("token", None)
+        if token is None:
+            return False
+        try:
+            token = ConnectionTokenStore(redis).use_connection_token(token)
+        except InvalidToken:
+            return False
+        if token["session_id"] != self.session_id or token["chat_id"] != self.chat_id:
+            return False
+        if not authorize_reconnecting(redis, self.user_list, token):
+            return False
+        self.user_id = token["user_id"]
+        self.user_number = token["user_number"]
+        self.chat_type = token["chat_type"]
+        self.publicity = token["publicity"]
+        self.join_details = JoinDetails(**{_: token[_] for _ in JoinDetails._fields})
+        return True
+
     @coroutine
     def prepare(self):
+        started = time.time()
+        try:
+            yield self.authenticate()
+        finally:
+            metrics["prepare"].observe(time.time() - started)
+
+    @coroutine
+    def authenticate(self):
         self.id = str(uuid4())
         self.joined = False
+        self.outbound = collections.deque()
+        self.outbound_bytes = 0
+        self.writing_bytes = 0
         try:
             self.session_id = self.cookies["newparp"].value
             self.chat_id = int(self.path_args[0])
+        except (KeyError, ValueError):
+            self.send_error(400)
+            return
+
+        self.user_list = UserListStore(redis_chat, self.chat_id)
+
+        if self.use_token():
+            queue_user_meta(self, redis, self.request.headers.get("X-Forwarded-For", self.request.remote_ip))
+            return
+
+        try:
             self.user_id = int(redis.get("session:%s" % self.session_id))
-        except (KeyError, TypeError, ValueError):
+        except (TypeError, ValueError):
             self.send_error(400)
             return
         try:
@@ -125,25 +397,38 @@ class ChatHandler(WebSocketHandler):
         # Remember the user number so typing notifications can refer to it
         # without reopening the database session.
         self.user_number = self.chat_user.number
+        self.chat_type = self.chat.type
+        self.publicity = getattr(self.chat, "publicity", None)
         queue_user_meta(self, redis, self.request.headers.get("X-Forwarded-For", self.request.remote_ip))
 
-        self.user_list = UserListStore(redis_chat, self.chat_id)
-
         try:
             if self.user.group != "active":
                 raise BannedException
 
-            yield thread_pool.submit(authorize_joining, self.db, self)
+            yield thread_pool.submit(authorize_joining, self.db, redis, self)
         except (UnauthorizedException, BannedException, BadAgeException, TooManyPeopleException):
             self.send_error(403)
             return
 
+        self.join_details = join_details(self.chat_user, self.user, self.chat)
+
     @coroutine
     def open(self, chat_id):
+        started = time.time()
+        try:
+            yield self.join()
+        finally:
+            # The socket's session is only needed for joining. Closing it
+            # here means it's never touched after join() has finished.
+            self.close_db()
+            metrics["open"].observe(time.time() - started)
+
+    @coroutine
+    def join(self):
 
         sockets.add(self)
         if DEBUG:
-            print("socket opened: %s %s %s" % (self.id, self.chat.url, self.user.username))
+            print("socket opened: %s %s %s" % (self.id, self.chat_id, self.user_id))
 
         try:
             yield thread_pool.submit(kick_check, redis, self)
@@ -159,7 +444,7 @@ class ChatHandler(WebSocketHandler):
             "typing": "channel:%s:typing" % self.chat_id,
         }
 
-        if self.chat.type == "pm":
+        if self.chat_type == "pm":
             self.channels["pm"] = "channel:pm:%s" % self.user_id
 
         self.redis_task = asyncio.ensure_future(self.redis_listen())
@@ -170,10 +455,14 @@ class ChatHandler(WebSocketHandler):
         except (KeyError, IndexError, ValueError):
             after = 0
         messages = redis_chat.zrangebyscore("chat:%s" % self.chat_id, "(%s" % after, "+inf")
-        self.write_message(json.dumps({
-            "chat": self.chat.to_dict(),
-            "messages": [json.loads(_) for _ in messages],
-        }))
+        backlog = {"messages": [json.loads(_) for _ in messages]}
+
+        # Connections with a token haven't loaded the chat. Changes to it are
+        # sent as chat_meta messages, which are in the backlog.
+        if hasattr(self, "chat"):
+            backlog["chat"] = self.chat.to_dict()
+
+        self.send(json.dumps(backlog))
 
         online_state_changed = self.user_list.socket_join(self.id, self.session_id, self.user_id)
         self.joined = True
@@ -181,13 +470,17 @@ class ChatHandler(WebSocketHandler):
         # Send  a join message to everyone if we just joined, otherwise send the
         # user list to the client.
         if online_state_changed:
-            yield thread_pool.submit(send_join_message, self.user_list, self.db, redis, self)
+            yield thread_pool.submit(send_join_message, self.user_list, self.db, redis, self.join_details)
         else:
             userlist = yield thread_pool.submit(get_userlist, self.user_list, self.db)
-            self.write_message(json.dumps({"users": userlist}))
+            self.send(json.dumps({"users": userlist}))
 
         self.db.commit()
-        self.db.close()
+
+        # Give them a new token so they can reconnect without the database.
+        self.send(json.dumps({"connection_token": ConnectionTokenStore(redis).create_connection_token(
+            self.session_id, self.user_number, self.publicity, self.join_details,
+        )}))
 
     def on_message(self, message):
         if DEBUG:
@@ -215,17 +508,15 @@ class ChatHandler(WebSocketHandler):
         else:
             message_type = "timeout"
 
-        if self.joined and self.user_list.socket_disconnect(self.id, self.user_number):
-            try:
-                send_quit_message(self.user_list, self.db, *self.get_chat_user(), type=message_type)
-            except NoResultFound:
-                send_userlist(self.user_list, self.db, self.chat)
-            self.db.commit()
+        if hasattr(self, "outbound"):
+            self.outbound.clear()
+            self.outbound_bytes = 0
 
-        # Delete the database connection here and on_finish just to be sure.
-        if hasattr(self, "_db"):
-            self._db.close()
-            del self._db
+        # Everything else involves the database or Redis, so do it in the
+        # close pool to keep the event loop free for the other sockets.
+        future = asyncio.wrap_future(close_pool.submit(self.disconnect, message_type))
+        closing.add(future)
+        future.add_done_callback(partial(finish_closing, time.time()))
 
         if DEBUG:
             print("socket closed: %s" % self.id)
@@ -236,10 +527,33 @@ class ChatHandler(WebSocketHandler):
             pass
 
     def on_finish(self):
+        self.close_db()
+
+    def close_db(self):
         if hasattr(self, "_db"):
             self._db.close()
             del self._db
 
+    def disconnect(self, message_type):
+        """
+        Takes the socket out of the user list and sends a quit message if the
+        user has gone offline. This runs in the close pool, with its own
+        database session in case open() is still using the socket's one.
+        open() closes that one itself.
+        """
+        if not self.joined or not self.user_list.socket_disconnect(self.id, self.user_number):
+            return
+
+        db = sm()
+        try:
+            try:
+                send_quit_message(self.user_list, db, *self.get_chat_user(db), type=message_type)
+            except NoResultFound:
+                send_userlist(self.user_list, db, self.chat_type)
+            db.commit()
+        finally:
+            db.close()
+
     async def redis_listen(self):
         self.redis_client = await asyncio_redis.Connection.create(
             host=os.environ["REDIS_HOST"],
@@ -255,21 +569,27 @@ class ChatHandler(WebSocketHandler):
 
             while self.ws_connection:
                 message = await subscriber.next_published()
-                asyncio.ensure_future(self.on_redis_message(message))
+                metrics["pubsub_in"].add()
+                self.on_redis_message(message)
         finally:
             self.redis_client.close()
 
-    async def on_redis_message(self, message):
+    def on_redis_message(self, message):
         if DEBUG:
             print("redis message: %s" % str(message))
 
-        self.write_message(message.value)
-
         if message.channel == self.channels["user"]:
             data = json.loads(message.value)
             if "exit" in data:
+                # Skip anything queued so they find out straight away.
+                self.outbound.clear()
+                self.outbound_bytes = 0
+                self.write_message(message.value)
                 self.joined = False
                 self.close()
+                return
+
+        self.send(message.value)
 
 
 class SearchHandler(WebSocketHandler):
@@ -302,14 +622,13 @@ class SearchHandler(WebSocketHandler):
 
     @coroutine
     def open(self, searcher_id):
+        sockets.add(self)
         self.redis_task = asyncio.ensure_future(self.redis_listen())
         redis.sadd("searchers", searcher_id)
         new_searcher.delay(searcher_id)
 
     def on_message(self, message):
-        result = refresh_searcher(redis, self.searcher_id)
-        if not all(result[:-3]): # -3 because filters and choices are optional
-            # TODO make that a method
+        if not all(refresh_searcher(redis, self.searcher_id)):
             self.close()
 
     async def redis_listen(self):
@@ -342,16 +661,7 @@ class SearchHandler(WebSocketHandler):
         if hasattr(self, "redis_client"):
             self.redis_client.close()
 
-        pipe = redis.pipeline()
-        pipe.srem("searchers", self.searcher_id)
-        pipe.delete("searcher:%s:session_id" % self.searcher_id)
-        pipe.delete("searcher:%s:search_character_id" % self.searcher_id)
-        pipe.delete("searcher:%s:character" % self.searcher_id)
-        pipe.delete("searcher:%s:style" % self.searcher_id)
-        pipe.delete("searcher:%s:levels" % self.searcher_id)
-        pipe.delete("searcher:%s:filters" % self.searcher_id)
-        pipe.delete("searcher:%s:choices" % self.searcher_id)
-        pipe.execute()
+        delete_searcher(redis, self.searcher_id)
 
         if DEBUG:
             print("socket closed: %s" % (self.searcher_id))
@@ -389,14 +699,147 @@ class HealthHandler(RequestHandler):
         self.write("ok")
 
 
+def metrics_snapshot():
+    buffered_bytes = [_.buffered_bytes for _ in sockets if isinstance(_, ChatHandler) and hasattr(_, "outbound")]
+    return {
+        "pid": os.getpid(),
+        "sockets": collections.Counter(type(_).__name__ for _ in sockets),
+        "closing": len(closing),
+        "loop_lag": metrics["loop_lag"].to_dict(),
+        "thread_pool": thread_pool.to_dict(),
+        "close_pool": close_pool.to_dict(),
+        "pubsub": {
+            "in": metrics["pubsub_in"].to_dict(),
+            "out": metrics["pubsub_out"].to_dict(),
+        },
+        "publish_to_write": metrics["publish_to_write"].to_dict(),
+        "buffered_bytes": {
+            "total": sum(buffered_bytes),
+            "max": max(buffered_bytes, default=0),
+            "sockets_behind": len([_ for _ in buffered_bytes if _ > 0]),
+        },
+        "bytes_out": {
+            "compression": compression_options,
+            "message": metrics["message_bytes_out"].to_dict(),
+            "wire": metrics["wire_bytes_out"].to_dict(),
+        },
+        "write_time": metrics["write_time"].to_dict(),
+        "coalesced": metrics["coalesced"].to_dict(),
+        "resyncs": metrics["resyncs"].to_dict(),
+        "phases": {
+            phase: metrics[phase].to_dict()
+            for phase in ("prepare", "open", "on_close")
+        },
+    }
+
+
+def host_metrics():
+    keys = list(redis.scan_iter("live:metrics:%s:*" % gethostname()))
+    return [json.loads(_) for _ in redis.mget(keys) if _ is not None] if keys else []
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Shows this process's metrics, or with ?all=1 the latest metrics from
+    every live process on this host. This needs LIVE_METRICS_TOKEN in the
+    X-Metrics-Token header, and isn't served at all without it.
+    """
+    async def get(self):
+        token = self.request.headers.get("X-Metrics-Token", "")
+        if not metrics_token or not hmac.compare_digest(token.encode("utf8"), metrics_token.encode("utf8")):
+            self.send_error(404)
+            return
+        if not self.get_query_argument("all", None):
+            self.write(metrics_snapshot())
+            return
+        processes = await asyncio.get_event_loop().run_in_executor(thread_pool, host_metrics)
+        self.write({"processes": processes})
+
+
+def finish_closing(started, future):
+    closing.discard(future)
+    metrics["on_close"].observe(time.time() - started)
+    if not future.cancelled() and future.exception() is not None:
+        print("error closing socket: %s" % future.exception())
+
+
 def sig_handler(sig, frame):
     print("Caught signal %s." % sig)
     ioloop.add_callback_from_signal(shutdown)
 
 
+async def global_listen():
+    """
+    Subscribes to the global channel once for the whole process, and sends
+    broadcasts to every chat socket here. Each worker reports how many
+    sockets it reached and how long the broadcast took to get to them.
+    """
+    while True:
+        redis_client = None
+        try:
+            redis_client = await asyncio_redis.Connection.create(
+                host=os.environ["REDIS_HOST"],
+                port=int(os.environ["REDIS_PORT"]),
+                db=int(os.environ["REDIS_DB"]),
+            )
+            subscriber = await redis_client.start_subscribe()
+            await subscriber.subscribe(["global"])
+            while True:
+                message = await subscriber.next_published()
+                metrics["pubsub_in"].add()
+                chat_sockets = [_ for _ in sockets if isinstance(_, ChatHandler) and hasattr(_, "channels")]
+                for socket in chat_sockets:
+                    socket.send(message.value)
+
+                broadcast = json.loads(message.value).get("broadcast")
+                if broadcast:
+                    delivery_key = "broadcast:%s" % broadcast["id"]
+                    pipe = redis.pipeline()
+                    pipe.hincrby(delivery_key, "workers", 1)
+                    pipe.hincrby(delivery_key, "sockets", len(chat_sockets))
+                    pipe.hset(delivery_key, "latency:%s" % os.getpid(), round((time.time() - broadcast["sent"]) * 1000, 1))
+                    pipe.expire(delivery_key, 86400)
+                    pipe.execute()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("global channel error: %s" % e)
+            await asyncio.sleep(5)
+        finally:
+            if redis_client is not None:
+                redis_client.close()
+
+
+async def measure_loop_lag(interval=0.5):
+    """
+    Sleeps repeatedly and records how much later than asked the loop woke
+    us up. Anything blocking the loop shows up here.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        metrics["loop_lag"].observe(max(loop.time() - started - interval, 0))
+
+
+async def report_metrics(interval=10):
+    """
+    Saves this process's metrics in Redis so /metrics?all=1 can show every
+    process on the host, whichever one it reaches.
+    """
+    key = "live:metrics:%s:%s" % (gethostname(), os.getpid())
+    while True:
+        redis.setex(key, interval * 3, json.dumps(metrics_snapshot()))
+        await asyncio.sleep(interval)
+
+
 def shutdown():
     print("Shutting down.")
 
+    # Stop accepting connections, so the other processes take new ones while
+    # this one drains.
+    http_server.stop()
+
     for socket in sockets:
         ioloop.add_callback(socket.close)
 
@@ -407,14 +850,16 @@ def shutdown():
 
     def stop_loop():
         now = time.time()
-        if now < deadline and len(sockets) != 0:
+        if now < deadline and (len(sockets) != 0 or len(closing) != 0):
             ioloop.add_timeout(now + 0.1, stop_loop)
         else:
             ioloop.stop()
 
     stop_loop()
 
-if __name__ == "__main__":
+
+def run_worker():
+    global ioloop, http_server
 
     AsyncIOMainLoop().install()
     ioloop = IOLoop.instance()
@@ -422,14 +867,112 @@ if __name__ == "__main__":
     application = Application([
         (r"/(\d+)", ChatHandler),
         (r"/search/([0-9a-z]{8}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{12})", SearchHandler),
-        (r"/health", HealthHandler)
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
     ])
 
     http_server = HTTPServer(application)
-    http_server.listen(int(os.environ.get("LISTEN_PORT", 5000)))
+    if "LIVE_LISTEN_FDS" in os.environ:
+        # Started by the supervisor, so use its listening sockets.
+        for listen_fd in os.environ["LIVE_LISTEN_FDS"].split(","):
+            fd, family = (int(_) for _ in listen_fd.split(":"))
+            listen_socket = fromfd(fd, family, SOCK_STREAM)
+            os.close(fd)
+            http_server.add_socket(listen_socket)
+    else:
+        http_server.listen(int(os.environ.get("LISTEN_PORT", 5000)))
 
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
+    asyncio.ensure_future(global_listen())
+    asyncio.ensure_future(measure_loop_lag())
+    asyncio.ensure_future(report_metrics())
+
     ioloop.start()
 
+
+class Supervisor(object):
+    """
+    Runs several live processes sharing one listening socket, so a host can
+    use all its cores.
+
+    The supervisor binds the port and passes the sockets to each process,
+    which is started fresh so it picks up new code. Processes which die are
+    replaced. SIGHUP replaces them one at a time, starting the new process
+    before the old one drains, and SIGTERM/SIGINT drain them all and exit.
+    """
+    drain_time = 15
+
+    def __init__(self, process_count):
+        self.process_count = process_count
+        self.listen_sockets = bind_sockets(int(os.environ.get("LISTEN_PORT", 5000)))
+        self.processes = []
+        self.restarting = False
+        self.stopping = False
+
+    def start_process(self):
+        listen_fds = ",".join("%s:%s" % (_.fileno(), int(_.family)) for _ in self.listen_sockets)
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+            env=dict(os.environ, LIVE_LISTEN_FDS=listen_fds, LIVE_PROCESSES="1"),
+            pass_fds=[_.fileno() for _ in self.listen_sockets],
+        )
+        print("Started live process %s." % process.pid)
+        return process
+
+    def wait_for_process(self, process):
+        try:
+            process.wait(timeout=self.drain_time)
+        except subprocess.TimeoutExpired:
+            print("Live process %s didn't stop in time, killing it." % process.pid)
+            process.kill()
+            process.wait()
+
+    def rolling_restart(self):
+        for index, process in enumerate(list(self.processes)):
+            if self.stopping:
+                return
+            self.processes[index] = self.start_process()
+            process.terminate()
+            self.wait_for_process(process)
+
+    def handle_signal(self, sig, frame):
+        print("Caught signal %s." % sig)
+        if sig == signal.SIGHUP:
+            self.restarting = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_signal)
+
+        self.processes = [self.start_process() for _ in range(self.process_count)]
+
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                self.rolling_restart()
+            for index, process in enumerate(self.processes):
+                if not self.stopping and process.poll() is not None:
+                    print("Live process %s exited with %s, replacing it." % (process.pid, process.returncode))
+                    self.processes[index] = self.start_process()
+            time.sleep(1)
+
+        print("Shutting down.")
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            self.wait_for_process(process)
+
+
+if __name__ == "__main__":
+
+    # LIVE_PROCESSES=0 means one per core.
+    process_count = int(os.environ.get("LIVE_PROCESSES", 1)) or os.cpu_count()
+    if process_count > 1:
+        Supervisor(process_count).run()
+    else:
+        run_worker()
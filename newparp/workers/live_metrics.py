@@ -0,0 +1,110 @@
+import bisect
+import collections
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Histogram(object):
+    """
+    Counts timings into fixed buckets, in seconds. This is thread safe so
+    the thread pools can record into it.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+        self.last   = None
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            self.last = value
+
+    def to_dict(self):
+        """
+        Returns the histogram with cumulative bucket counts, keyed by their
+        upper bounds.
+        """
+        with self.lock:
+            cumulative = 0
+            buckets = {}
+            for upper_bound, count in zip(self.buckets + ("+Inf",), self.counts):
+                cumulative += count
+                buckets[str(upper_bound)] = cumulative
+            return {
+                "count": self.count,
+                "sum": round(self.sum, 6),
+                "max": round(self.max, 6),
+                "last": self.last,
+                "buckets": buckets,
+            }
+
+
+class Rate(object):
+    """
+    Counts events and gives the average rate per second over the last
+    minute. This is only used from the event loop so it isn't locked.
+    """
+    window = 60
+
+    def __init__(self):
+        self.total   = 0
+        self.seconds = collections.deque()
+
+    def add(self, count=1):
+        now = int(time.time())
+        self.total += count
+        if self.seconds and self.seconds[-1][0] == now:
+            self.seconds[-1][1] += count
+        else:
+            self.seconds.append([now, count])
+            self.trim(now)
+
+    def trim(self, now):
+        while self.seconds and self.seconds[0][0] <= now - self.window:
+            self.seconds.popleft()
+
+    def to_dict(self):
+        self.trim(int(time.time()))
+        return {
+            "total": self.total,
+            "per_second": round(sum(count for second, count in self.seconds) / self.window, 3),
+        }
+
+
+class TimedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor which records how long jobs wait for a thread, and
+    can report how many are waiting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_time = Histogram()
+
+    def submit(self, fn, *args, **kwargs):
+        queued = time.monotonic()
+        def timed_fn(*args, **kwargs):
+            self.wait_time.observe(time.monotonic() - queued)
+            return fn(*args, **kwargs)
+        return super().submit(timed_fn, *args, **kwargs)
+
+    @property
+    def queue_depth(self):
+        return self._work_queue.qsize()
+
+    def to_dict(self):
+        return {
+            "threads": self._max_workers,
+            "queue_depth": self.queue_depth,
+            "wait_time": self.wait_time.to_dict(),
+        }
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+import json
+import os
+import signal
+import time
+import traceback
+
+from socket import gethostname
+from threading import Thread
+
+from newparp.model.connections import redis_pool, NewparpRedis
+from newparp.tasks.spamless import lists_version, reload_lists, SpamChecker
+
+
+redis = NewparpRedis(connection_pool=redis_pool)
+
+batch_size = int(os.environ.get("SPAMLESS_BATCH_SIZE", 100))
+
+# Messages are pushed onto the head of spamless:queue and taken from the
+# tail. The batch being checked is kept here until it's done, so it can be
+# checked again if the worker dies part way through.
+processing_key = "spamless:processing:%s" % os.environ.get("SPAMLESS_WORKER_NAME", gethostname())
+
+running = True
+
+
+fetch_script = """
+    local messages = {}
+    for i = 1, tonumber(ARGV[3]) do
+        local message = redis.call("rpoplpush", ARGV[1], ARGV[2])
+        if not message then break end
+        messages[#messages + 1] = message
+    end
+    return messages
+"""
+
+
+def fetch_batch():
+    """
+    Waits for messages on the spamless queue, then moves up to batch_size of
+    them onto the processing list at once.
+    """
+    first = redis.brpoplpush("spamless:queue", processing_key, timeout=1)
+    if first is None:
+        return []
+    rest = redis.eval(fetch_script, 0, "spamless:queue", processing_key, batch_size - 1)
+    return [json.loads(_) for _ in [first] + rest]
+
+
+def finish_batch():
+    # Only the current batch is in the processing list.
+    redis.delete(processing_key)
+
+
+requeue_script = """
+    local messages = redis.call("lrange", ARGV[1], 0, -1)
+    for i = 1, #messages do
+        redis.call("rpush", ARGV[2], messages[i])
+    end
+    redis.call("del", ARGV[1])
+    return #messages
+"""
+
+
+def requeue_unfinished():
+    """
+    Puts back any messages from a batch which was being checked when this
+    worker last stopped, so they're checked first.
+    """
+    count = redis.eval(requeue_script, 0, processing_key, "spamless:queue")
+    if count:
+        print("Requeued %s unchecked messages." % count)
+
+
+def listen_for_reloads():
+    """
+    Reloads the filters whenever they're changed. The version key is checked
+    too in case a notification was missed while we were disconnected.
+    """
+    while running:
+        try:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe("spamless:reload")
+            while running:
+                message = pubsub.get_message(timeout=60)
+                if message is not None or lists_version() != redis.get("spamless:reload"):
+                    reload_lists(redis)
+        except Exception:
+            traceback.print_exc()
+            time.sleep(5)
+
+
+def sig_handler(sig, frame):
+    global running
+    print("Caught signal %s." % sig)
+    running = False
+
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGTERM, sig_handler)
+    signal.signal(signal.SIGINT, sig_handler)
+
+    reload_lists(redis)
+    requeue_unfinished()
+    Thread(target=listen_for_reloads, daemon=True).start()
+
+    checker = SpamChecker(redis)
+
+    while running:
+        batch = fetch_batch()
+        if not batch:
+            continue
+        try:
+            checker.check_messages([(_["chat_id"], _["message"]) for _ in batch])
+        except Exception:
+            traceback.print_exc()
+        finish_batch()
+
+    print("Shutting down.")
@@ -0,0 +1,124 @@
+import random
+import uuid
+
+from newparp.helpers.filters import FilterMatcher
+from newparp.helpers.matchmaker import (
+    delete_searcher,
+    fetch_searcher,
+    get_blocked_user_ids,
+    invalidate_blocked_user_ids,
+    load_blocked_user_ids,
+    refresh_searcher,
+    store_searcher,
+    validate_searcher_exists,
+)
+from newparp.model import AgeGroup, Block
+from tests import create_user
+
+
+def test_blocked_user_ids(db, redis):
+    user, blocked_user, blocking_user, other_user = [create_user(db) for x in range(0, 4)]
+    db.add(Block(blocking_user_id=user.id, blocked_user_id=blocked_user.id))
+    db.add(Block(blocking_user_id=blocking_user.id, blocked_user_id=user.id))
+    db.commit()
+
+    invalidate_blocked_user_ids(redis, user.id, other_user.id)
+    assert get_blocked_user_ids(redis, user.id) is None
+
+    # Blocks in both directions should be cached.
+    assert load_blocked_user_ids(redis, db, user.id) == {blocked_user.id, blocking_user.id}
+    assert get_blocked_user_ids(redis, user.id) == {blocked_user.id, blocking_user.id}
+
+    # Users with no blocks should still be cached.
+    assert load_blocked_user_ids(redis, db, other_user.id) == set()
+    assert get_blocked_user_ids(redis, other_user.id) == set()
+
+    invalidate_blocked_user_ids(redis, user.id)
+    assert get_blocked_user_ids(redis, user.id) is None
+
+
+def test_filter_matcher():
+    assert FilterMatcher([]).search("anything") is None
+    assert FilterMatcher(["strider", "serket"]).search("vriska serket") == "serket"
+    assert FilterMatcher(["strider", "serket"]).search("john egbert") is None
+
+    # Overlapping phrases need the failure links to find them.
+    assert FilterMatcher(["abcd", "bc"]).search("abce") == "bc"
+
+    # It should always agree with checking each phrase in turn.
+    for x in range(0, 1000):
+        phrases = ["".join(random.choice("abc") for y in range(random.randint(1, 4))) for z in range(random.randint(0, 8))]
+        text = "".join(random.choice("abcd") for y in range(random.randint(0, 12)))
+        assert (FilterMatcher(phrases).search(text) is not None) == any(_ in text for _ in phrases)
+
+
+def test_searcher_record(redis):
+    searcher_id = str(uuid.uuid4())
+    session_id = str(uuid.uuid4())
+    redis.setex("session:%s" % session_id, 60, 1)
+
+    store_searcher(
+        redis, searcher_id,
+        session_id=session_id,
+        search_character_id=1,
+        character={"name": "anonymous", "acronym": "??"},
+        style="script",
+        levels={"sfw", "nsfwv"},
+        age_group=AgeGroup.over_18,
+        filters=["strider"],
+        choices=[2, 1],
+    )
+    redis.sadd("searchers", searcher_id)
+
+    # Everything should be in one key.
+    assert redis.keys("searcher:%s*" % searcher_id) == ["searcher:%s" % searcher_id]
+
+    searcher = fetch_searcher(redis, searcher_id)
+    assert all(searcher[:-3])
+    assert searcher.session_id == session_id
+    assert searcher.user_id == "1"
+    assert searcher.search_character_id == 1
+    assert searcher.character == {"name": "anonymous", "acronym": "??"}
+    assert searcher.style == "script"
+    assert searcher.levels == {"sfw", "nsfwv"}
+    assert searcher.age_group == AgeGroup.over_18
+    assert searcher.filters == ["strider"]
+    assert searcher.choices == {1, 2}
+
+    assert validate_searcher_exists(redis, searcher_id)[0] == session_id
+    assert all(refresh_searcher(redis, searcher_id))
+
+    delete_searcher(redis, searcher_id)
+    assert not all(validate_searcher_exists(redis, searcher_id))
+    assert not all(refresh_searcher(redis, searcher_id))
+    assert not all(fetch_searcher(redis, searcher_id)[:-3])
+
+
+def test_legacy_searcher(redis):
+    searcher_id = str(uuid.uuid4())
+    session_id = str(uuid.uuid4())
+    redis.setex("session:%s" % session_id, 60, 1)
+
+    redis.set("searcher:%s:session_id" % searcher_id, session_id)
+    redis.set("searcher:%s:search_character_id" % searcher_id, 1)
+    redis.hmset("searcher:%s:character" % searcher_id, {"name": "anonymous", "acronym": "??"})
+    redis.set("searcher:%s:style" % searcher_id, "script")
+    redis.sadd("searcher:%s:levels" % searcher_id, "sfw")
+    redis.rpush("searcher:%s:filters" % searcher_id, "strider")
+    redis.sadd("searcher:%s:choices" % searcher_id, 1, 2)
+    redis.sadd("searchers", searcher_id)
+
+    searcher = fetch_searcher(redis, searcher_id)
+    assert all(searcher[:-3])
+    assert searcher.search_character_id == 1
+    assert searcher.character == {"name": "anonymous", "acronym": "??"}
+    assert searcher.levels == {"sfw"}
+    assert searcher.age_group is None
+    assert searcher.filters == ["strider"]
+    assert searcher.choices == {1, 2}
+
+    assert validate_searcher_exists(redis, searcher_id)[0] == session_id
+    assert all(refresh_searcher(redis, searcher_id))
+
+    delete_searcher(redis, searcher_id)
+    assert redis.keys("searcher:%s*" % searcher_id) == []
@@ -0,0 +1,194 @@
+import random
+import re
+import string
+import uuid
+
+from newparp.helpers.filters import RegexSet, similarity_bands
+from newparp.model import ChatUser, SpamlessFilter
+from newparp.tasks import spamless
+from newparp.tasks.spamless import reload_lists, SpamChecker
+
+
+flags = re.IGNORECASE | re.MULTILINE
+
+
+def test_regex_set_search():
+    assert RegexSet([], flags).search("anything") is None
+    assert RegexSet(["spam", "e+ggs"], flags).search("green EEGGS and ham")
+    assert RegexSet(["spam", "e+ggs"], flags).search("green eggs and ham")
+    assert RegexSet(["^spam$", "e+ggs"], flags).search("more spam") is None
+    assert RegexSet(["^spam$", "e+ggs"], flags).search("hello\nspam\n")
+
+
+def test_regex_set_uncombinable():
+    # Backreferences, named groups and global flags get checked separately.
+    regex_set = RegexSet([r"(a)\1", "(?P<x>b)(?P=x)", "(?s)c.d", "e"], flags)
+    assert len(regex_set.separate) == 3
+    assert regex_set.search("xaax")
+    assert regex_set.search("xbbx")
+    assert regex_set.search("c\nd")
+    assert regex_set.search("ab") is None
+
+
+def test_regex_set_literals():
+    regex_set = RegexSet([r"\bcat\b", r"free\.money"], flags)
+    assert len(regex_set.literal_patterns) == 2
+    assert regex_set.search("a CAT sat")
+    assert regex_set.search("FREE.money")
+    assert regex_set.search("free money") is None
+    # Word boundaries mean the matcher can find something the pattern doesn't.
+    assert regex_set.search("concatenate") is None
+    # Non-ASCII text has to use the patterns because of case folding.
+    assert RegexSet(["k"], flags).search("\u212a")
+    assert RegexSet(["k"], flags).search("caf\u00e9") is None
+
+
+def test_regex_set_score():
+    regex_set = RegexSet(["spam", "sp(a)m", "a+", r"(m)\1"], flags, weights=[1, 10, 100, 0])
+    assert regex_set.score("nothing here") == 0
+    assert regex_set.score("spam spam") == 2 + 20 + 200
+    assert regex_set.score("SPAM") == 1 + 10 + 100
+
+
+def test_regex_set_equivalence():
+    # It should always agree with checking each pattern in turn.
+    atoms = ["a", "b", "c", "ab", "a+", "b?c", "[ac]", "^a", "c$", r"\ba", "(a|b)", "(?:bc)+"]
+    for x in range(0, 1000):
+        patterns = ["".join(random.choice(atoms) for y in range(random.randint(1, 3))) for z in range(random.randint(0, 8))]
+        weights = [random.randint(0, 5) for _ in patterns]
+        text = "".join(random.choice("abcABC \n") for y in range(random.randint(0, 20)))
+        compiled = [re.compile(_, flags) for _ in patterns]
+        regex_set = RegexSet(patterns, flags, weights=weights)
+
+        assert (regex_set.search(text) is not None) == any(_.search(text) for _ in compiled)
+        assert regex_set.score(text) == sum(len(_.findall(text)) * weight for _, weight in zip(compiled, weights))
+
+
+def test_similarity_bands():
+    text = "hey everyone come and join my server at example dot com for free stuff and cool people"
+    bands = set(similarity_bands(text))
+    assert len(bands) >= 4
+    assert similarity_bands("too short to count") == []
+
+    # Small changes should leave most bands alone.
+    for mutated in [text.upper(), text.replace(" ", "  "), text + "!!! 123", text.replace("free", "fr33")]:
+        assert len(bands & set(similarity_bands(mutated))) >= 3
+    assert not bands & set(similarity_bands("a completely different message about rabbits and cats and gardens"))
+
+
+def test_similarity_bands_unrelated_short_messages():
+    # Short messages leave buckets empty, and bands built from those would
+    # be shared by unrelated messages all over the site.
+    rng = random.Random(0)
+    band_texts = {}
+    for x in range(2000):
+        text = "".join(rng.choice(string.ascii_lowercase + "     ") for y in range(rng.randint(40, 80)))
+        for band in similarity_bands(text):
+            assert band_texts.setdefault(band, text) == text
+
+
+def test_message_filter_attempts(redis, monkeypatch):
+    monkeypatch.setattr(spamless, "lists", {
+        "reload": "0",
+        "blacklist": RegexSet(["spam"], flags, weights=[3]),
+        "banned_names": RegexSet([], flags),
+        "warnlist": RegexSet([], flags),
+    })
+    checker = SpamChecker(redis)
+    chat_id = random.randint(1000000, 2000000)
+
+    def message(text):
+        return {
+            "id": 0, "type": "ic", "user_number": 1, "name": "test",
+            "acronym": "TT", "color": "000000", "text": text,
+        }
+
+    # Points and the attempt itself should be added to both counters at once.
+    first = message("spam and spam %s" % uuid.uuid4())
+    checker.check_messages([(chat_id, first)])
+    assert redis.get("spamless:message:%s" % first["hash"]) == "7"
+    assert redis.get("spamless:blacklist:%s:1" % chat_id) == "7"
+    assert 0 < redis.ttl("spamless:message:%s" % first["hash"]) <= 60
+    assert 0 < redis.ttl("spamless:blacklist:%s:1" % chat_id) <= 10
+    assert "spam_flag" not in first
+
+    # A different message takes the user over the limit.
+    second = message("spam %s" % uuid.uuid4())
+    checker.check_messages([(chat_id, second)])
+    assert redis.get("spamless:message:%s" % second["hash"]) == "4"
+    assert redis.get("spamless:blacklist:%s:1" % chat_id) == "11"
+    assert second["spam_flag"] == "x11"
+
+
+def test_reload_lists(db, redis, monkeypatch):
+    monkeypatch.setattr(spamless, "lists", {"reload": None})
+    phrase = "test phrase %s" % uuid.uuid4().hex
+    spamless_filter = SpamlessFilter(type="warnlist", regex=phrase, points=0)
+    db.add(spamless_filter)
+    db.commit()
+    version = str(uuid.uuid4())
+    redis.set("spamless:reload", version)
+
+    reload_lists(redis)
+    assert spamless.lists["reload"] == version
+    assert spamless.lists["warnlist"].search("a %s b" % phrase)
+    assert spamless.lists["blacklist"].search("a %s b" % phrase) is None
+
+    db.delete(spamless_filter)
+    db.commit()
+
+
+def test_near_duplicates(redis, monkeypatch):
+    monkeypatch.setattr(spamless, "lists", {
+        "reload": "0",
+        "banned_names": RegexSet([], flags),
+        "blacklist": RegexSet([], flags),
+        "warnlist": RegexSet([], flags),
+    })
+    checker = SpamChecker(redis)
+    text = "%s come and join my server at example dot com for free stuff" % uuid.uuid4().hex
+
+    # Slightly different messages across different chats should still add up.
+    messages = [(random.randint(1000000, 2000000), {
+        "id": 0, "type": "ic", "user_number": 1, "name": "test",
+        "acronym": "TT", "color": "000000", "text": "%s %s" % (text, "!" * x),
+    }) for x in range(0, 10)]
+    marks, silences = checker.classify(messages)
+    assert [message for chat_id, message, reason in marks] == [messages[-1][1]]
+
+    # They're only marked, because common text can come from unrelated people.
+    marks, silences = checker.classify(messages)
+    assert len(marks) == len(messages)
+    assert silences == []
+
+
+def test_silence(db, redis, group_chat, normal_user, admin_user):
+    chat_user = ChatUser.from_user(normal_user, chat_id=group_chat.id, number=2)
+    creator_chat_user = ChatUser.from_user(admin_user, chat_id=group_chat.id, number=1)
+    db.add_all([chat_user, creator_chat_user])
+    db.commit()
+
+    def message(user_number):
+        return {
+            "id": 0, "type": "ic", "user_number": user_number, "name": "test",
+            "acronym": "TT", "color": "000000", "text": "spam",
+        }
+
+    # Both senders are looked up together when flagging.
+    silenced_message = message(2)
+    admin_message = message(1)
+    SpamChecker(redis).flag([], [
+        (group_chat.id, silenced_message, "x20"),
+        (group_chat.id, admin_message, "x20"),
+    ])
+    assert silenced_message["spam_flag"] == "x20 SILENCED"
+    assert admin_message["spam_flag"] == "x20 ADMIN"
+
+    db.expire_all()
+    assert chat_user.group == "silent"
+    assert creator_chat_user.group == "user"
+
+    # Senders who aren't in the chat any more are skipped.
+    missing_message = message(3)
+    SpamChecker(redis).flag([], [(group_chat.id, missing_message, "name")])
+    assert "spam_flag" not in missing_message
@@ -0,0 +1,103 @@
+import json
+import uuid
+
+from tornado.concurrent import Future
+
+from newparp.workers import live
+
+class SlowChatHandler(live.ChatHandler):
+    # Writes don't finish until the test says so.
+    def write_message(self, message, binary=False):
+        self.written.append(message)
+        future = Future()
+        self.pending.append(future)
+        return future
+
+def make_handler():
+    handler = SlowChatHandler.__new__(SlowChatHandler)
+    handler.id = str(uuid.uuid4())
+    handler.ws_connection = object()
+    handler.outbound = live.collections.deque()
+    handler.outbound_bytes = 0
+    handler.writing_bytes = 0
+    handler.written = []
+    handler.pending = []
+    handler.closed = False
+    handler.close = lambda *args: setattr(handler, "closed", True)
+    return handler
+
+def finish_writes(handler):
+    while handler.pending:
+        handler.pending.pop(0).set_result(None)
+
+def test_messages_wait_for_previous_write():
+    handler = make_handler()
+    handler.send(json.dumps({"messages": [{"id": 1}]}))
+    handler.send(json.dumps({"messages": [{"id": 2}]}))
+
+    assert len(handler.written) == 1
+    assert handler.buffered_bytes > 0
+
+    finish_writes(handler)
+    assert [json.loads(_)["messages"][0]["id"] for _ in handler.written] == [1, 2]
+    assert handler.buffered_bytes == 0
+
+def test_typing_and_user_lists_coalesce():
+    handler = make_handler()
+    handler.send(json.dumps({"messages": [{"id": 1}]}))
+    for typing in ([1], [1, 2], [2]):
+        handler.send(json.dumps({"typing": typing}))
+    for users in (["a"], ["a", "b"]):
+        handler.send(json.dumps({"messages": [], "users": users}))
+    handler.send(json.dumps({"messages": [{"id": 2}], "users": ["b"]}))
+
+    finish_writes(handler)
+    assert [json.loads(_) for _ in handler.written] == [
+        {"messages": [{"id": 1}]},
+        {"typing": [2]},
+        {"messages": [{"id": 2}], "users": ["b"]},
+    ]
+
+def make_resync_handler(cached_ids):
+    handler = make_handler()
+    handler.chat_id = uuid.uuid4().int
+    for message_id in cached_ids:
+        live.redis_chat.zadd("chat:%s" % handler.chat_id, message_id, json.dumps({"id": message_id}))
+    return handler
+
+def test_slow_client_is_resynced():
+    message_ids = range(1, live.ChatHandler.max_queue_length + 3)
+    handler = make_resync_handler(message_ids[-50:])
+    for message_id in message_ids:
+        handler.send(json.dumps({"messages": [{"id": message_id}], "users": [message_id]}))
+
+    assert not handler.closed
+    assert len(handler.outbound) == 1
+
+    finish_writes(handler)
+    resync = json.loads(handler.written[-1])
+    assert resync["resync"] is True
+    assert resync["missed"] is True
+    assert resync["users"] == [message_ids[-1]]
+    assert [_["id"] for _ in resync["messages"]] == list(message_ids[-50:])
+
+def test_resync_with_everything_cached():
+    message_ids = range(1, live.ChatHandler.max_queue_length + 3)
+    handler = make_resync_handler(message_ids)
+    for message_id in message_ids:
+        handler.send(json.dumps({"messages": [{"id": message_id}]}))
+
+    finish_writes(handler)
+    resync = json.loads(handler.written[-1])
+    assert resync["missed"] is False
+    # The first message was being written when the rest were queued.
+    assert [_["id"] for _ in resync["messages"]] == list(message_ids[1:])
+
+def test_published_time_is_not_sent():
+    handler = make_handler()
+    handler.send(json.dumps({"published": 1500000000.25, "messages": [{"id": 1}]}, sort_keys=True))
+    handler.send(json.dumps({"messages": [{"id": 2}], "published": 1500000000.5}, sort_keys=True))
+    handler.send(json.dumps({"published": 1500000000.75}))
+
+    finish_writes(handler)
+    assert [json.loads(_) for _ in handler.written] == [{"messages": [{"id": 1}]}, {"messages": [{"id": 2}]}, {}]
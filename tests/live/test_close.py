@@ -0,0 +1,67 @@
+import asyncio
+import time
+import uuid
+
+from newparp.model import ChatUser, Message
+from newparp.model.connections import NewparpRedis, redis_chat_pool
+from newparp.model.user_list import UserListStore
+from newparp.workers import live
+from tests import create_user
+
+def open_handler(user_list, chat_user):
+    # Skip the websocket setup and just give it what on_close needs.
+    handler = live.ChatHandler.__new__(live.ChatHandler)
+    handler.id = str(uuid.uuid4())
+    handler.chat_id = chat_user.chat_id
+    handler.user_id = chat_user.user_id
+    handler.user_number = chat_user.number
+    handler.user_list = user_list
+    handler.close_code = 1000
+    user_list.socket_join(handler.id, str(uuid.uuid4()), handler.user_id)
+    handler.joined = True
+    live.sockets.add(handler)
+    return handler
+
+def test_mass_close_keeps_loop_responsive(db, group_chat, monkeypatch):
+    user_list = UserListStore(NewparpRedis(connection_pool=redis_chat_pool), group_chat.id)
+    chat_users = []
+    for number in range(1, 21):
+        chat_user = ChatUser.from_user(create_user(db), chat_id=group_chat.id, number=number)
+        db.add(chat_user)
+        chat_users.append(chat_user)
+    db.commit()
+    handlers = [open_handler(user_list, chat_user) for chat_user in chat_users]
+
+    # Make each quit message slow, so closing them all on the event loop
+    # would hold it up for two seconds.
+    send_quit_message = live.send_quit_message
+    def slow_send_quit_message(*args, **kwargs):
+        time.sleep(0.1)
+        return send_quit_message(*args, **kwargs)
+    monkeypatch.setattr(live, "send_quit_message", slow_send_quit_message)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def close_all():
+        lag = []
+        for handler in handlers:
+            handler.on_close()
+        while live.closing:
+            started = loop.time()
+            await asyncio.sleep(0.01)
+            lag.append(loop.time() - started - 0.01)
+        return lag
+
+    try:
+        lag = loop.run_until_complete(close_all())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    assert max(lag) < 0.05
+    assert user_list.user_ids_online() == set()
+    assert db.query(Message).filter(
+        Message.chat_id == group_chat.id,
+        Message.type == "disconnect",
+    ).count() == len(handlers)
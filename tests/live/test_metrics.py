@@ -0,0 +1,41 @@
+import time
+
+from newparp.workers.live_metrics import Histogram, Rate, TimedThreadPoolExecutor
+
+def test_histogram_buckets():
+    histogram = Histogram()
+    for value in (0.0005, 0.02, 0.02, 30):
+        histogram.observe(value)
+
+    result = histogram.to_dict()
+    assert result["count"] == 4
+    assert result["max"] == 30
+    assert result["last"] == 30
+    assert result["buckets"]["0.001"] == 1
+    assert result["buckets"]["0.025"] == 3
+    assert result["buckets"]["10"] == 3
+    assert result["buckets"]["+Inf"] == 4
+
+def test_rate():
+    rate = Rate()
+    rate.add()
+    rate.add(59)
+
+    result = rate.to_dict()
+    assert result["total"] == 60
+    assert result["per_second"] == 1
+
+def test_thread_pool_wait_time():
+    pool = TimedThreadPoolExecutor(max_workers=1)
+    try:
+        futures = [pool.submit(time.sleep, 0.05) for _ in range(3)]
+        for future in futures:
+            future.result()
+        result = pool.to_dict()
+    finally:
+        pool.shutdown()
+
+    assert result["queue_depth"] == 0
+    assert result["wait_time"]["count"] == 3
+    # The last job had to wait for the other two.
+    assert result["wait_time"]["max"] >= 0.09
@@ -0,0 +1,56 @@
+import tornado
+
+from tornado.concurrent import Future
+from tornado.websocket import WebSocketProtocol13
+
+from newparp.workers import live
+
+# ChatHandler.write_message relies on private parts of WebSocketProtocol13.
+# If these fail after upgrading Tornado, check write_message against the new
+# version before adding it to use_tornado_internals.
+
+class FakeStream(object):
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(data)
+        future = Future()
+        future.set_result(None)
+        return future
+
+def make_handler():
+    handler = live.ChatHandler.__new__(live.ChatHandler)
+    handler.request = None
+    handler.stream = FakeStream()
+    handler.ws_connection = WebSocketProtocol13(handler, compression_options={})
+    handler.ws_connection._create_compressors("server", {}, {"compression_level": 6, "mem_level": 5})
+    return handler
+
+def test_tornado_version_is_supported():
+    assert live.use_tornado_internals, "Tornado %s hasn't been checked" % tornado.version
+    handler = make_handler()
+    for attribute in live.tornado_internals:
+        assert hasattr(handler.ws_connection, attribute)
+
+def test_small_frames_are_not_compressed():
+    handler = make_handler()
+    handler.write_message("a" * (live.compression_min_size - 1))
+    handler.write_message("a" * 1000)
+
+    small, large = handler.stream.frames
+    assert not small[0] & WebSocketProtocol13.RSV1
+    assert small[2:] == b"a" * (live.compression_min_size - 1)
+    assert large[0] & WebSocketProtocol13.RSV1
+    assert len(large) < 1000
+    assert handler.ws_connection._compressor is not None
+
+def test_bytes_are_counted():
+    handler = make_handler()
+    message_bytes = live.metrics["message_bytes_out"].total
+    wire_bytes = live.metrics["wire_bytes_out"].total
+
+    handler.write_message("a" * 1000)
+
+    assert live.metrics["message_bytes_out"].total - message_bytes == 1000
+    assert live.metrics["wire_bytes_out"].total - wire_bytes == len(handler.stream.frames[0])
@@ -1,6 +1,9 @@
 import urllib.parse
 import html
 
+from newparp.model import User
+from newparp.model.connections import after_commit
+
 def test_redirect(client):
     INVALID_URL = "http://www.mspaintadventures.com/ACT6ACT6.php?s=6&p=009309"
     urls = {
@@ -17,4 +20,17 @@ def test_redirect(client):
         rv = client.get("/redirect?" + test_encoded)
 
         assert rv.status_code == 200
-        assert html.escape(expected_url).encode("utf8") in rv.data
\ No newline at end of file
+        assert html.escape(expected_url).encode("utf8") in rv.data
+
+def test_after_commit_is_dropped_on_rollback(db):
+    calls = []
+    db.query(User).first()
+    after_commit(db, lambda: calls.append("rolled back"))
+    db.rollback()
+
+    db.query(User).first()
+    after_commit(db, lambda: calls.append("committed"))
+    db.commit()
+    db.commit()
+
+    assert calls == ["committed"]
@@ -5,10 +5,12 @@ import html
 import uuid
 
 from flask import g
+from sqlalchemy import and_
 
-from newparp.model import Message, Chat
+from newparp.model import sm, Message, Chat, ChatUser
 from newparp.model.connections import NewparpRedis, redis_chat_pool
-from newparp.model.user_list import UserListStore
+from newparp.model.user_list import ChatAccessStore, DraftStore, UserListStore
+from newparp.tasks.background import flush_drafts
 
 def join(client, chat: Chat):
     client.get("/" + chat.url)
@@ -94,6 +96,20 @@ def test_flag_publicity_private_invited(user_client, admin_client, group_chat):
     rv = user_client.get("/" + group_chat.url)
     assert rv.status_code == 200
 
+def test_flag_publicity_private_uninvited_after_invite(user_client, admin_client, group_chat):
+    join(admin_client, group_chat)
+    set_flag(admin_client, group_chat.id, "publicity", "private")
+    admin_client.post("/" + group_chat.url + "/invite", data={
+        "username": user_client.user.username
+    })
+    assert user_client.get("/" + group_chat.url).status_code == 200
+
+    admin_client.post("/" + group_chat.url + "/uninvite", data={
+        "username": user_client.user.username
+    })
+    rv = user_client.get("/" + group_chat.url)
+    assert rv.status_code == 403
+
 # Bans
 
 def test_action_ban_user(user_client, admin_client, group_chat):
@@ -103,6 +119,40 @@ def test_action_ban_user(user_client, admin_client, group_chat):
     rv = user_client.get("/" + group_chat.url)
     assert rv.status_code == 302
 
+def test_unban_user(user_client, admin_client, group_chat):
+    join(admin_client, group_chat)
+    ban_id = json.loads(user_client.get("/" + group_chat.url + ".json").data.decode("utf8"))["chat_user"]["meta"]["number"]
+    user_action(admin_client, group_chat.id, "ban", ban_id, "Unittest chat ban.")
+    assert user_client.get("/" + group_chat.url).status_code == 302
+
+    admin_client.post("/" + group_chat.url + "/unban", data={"number": ban_id})
+    rv = user_client.get("/" + group_chat.url)
+    assert rv.status_code == 200
+
+def test_chat_access_load_after_change_is_discarded(redis, group_chat):
+    access = ChatAccessStore(redis, group_chat.id)
+    banned, invited, version = access.check(1)
+    assert banned is None
+
+    # A ban commits between reading the bans and caching them.
+    access.invalidate()
+    access.load_bans(version, [])
+    assert access.check(1)[0] is None
+
+    banned, invited, version = access.check(1)
+    access.load_bans(version, [1])
+    assert access.check(1)[0] is True
+
+def test_chat_access_check_for_guests(redis, group_chat):
+    access = ChatAccessStore(redis, group_chat.id)
+    assert access.check(None)[:2] == (None, None)
+
+    # Guests are never in the sets, so they don't need looking up.
+    banned, invited, version = access.check(None)
+    access.load_bans(version, [1])
+    access.load_invites(version, [1])
+    assert access.check(None)[:2] == (False, False)
+
 # Messages
 
 def test_send_messages(user_client, group_chat):
@@ -119,6 +169,37 @@ def test_send_messages(user_client, group_chat):
         })
         assert rv.status_code == 204
 
+def test_draft(user_client, group_chat):
+    join(user_client, group_chat)
+
+    rv = user_client.post("/chat_api/draft", data={
+        "chat_id": group_chat.id,
+        "text": "This is a unit test draft.",
+    })
+    assert rv.status_code == 204
+
+    # The draft is in Redis until it's flushed to the database.
+    chat_user = json.loads(user_client.get("/" + group_chat.url + ".json").data.decode("utf8"))["chat_user"]
+    assert chat_user["draft"] == "This is a unit test draft."
+
+    flush_drafts()
+
+    draft_store = DraftStore(NewparpRedis(connection_pool=redis_chat_pool))
+    db = sm()
+    assert db.query(ChatUser.draft).filter(and_(
+        ChatUser.chat_id == group_chat.id,
+        ChatUser.user_id == user_client.user.id,
+    )).scalar() == "This is a unit test draft."
+    assert not draft_store.redis.sismember(draft_store.queue_key, "%s:%s" % (group_chat.id, user_client.user.id))
+
+def test_draft_saved_during_flush_stays_queued(user_client, group_chat):
+    draft_store = DraftStore(NewparpRedis(connection_pool=redis_chat_pool))
+    draft_store.save(group_chat.id, user_client.user.id, "Old draft.")
+    drafts = draft_store.queued()
+    draft_store.save(group_chat.id, user_client.user.id, "New draft.")
+    draft_store.dequeue(drafts)
+    assert (group_chat.id, user_client.user.id, "New draft.") in draft_store.queued()
+
 def test_set_topic(user_client, admin_client, group_chat):
     topics = [
         "Unit testing topic created on %s" % (str(datetime.datetime.now())),